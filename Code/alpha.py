@@ -0,0 +1,215 @@
+import os
+import json
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import managerSQL
+import regression
+
+
+class AlphaStore:
+    """ Dense (date x symbol) float32 array of alpha forecasts, memory-mapped from root/alpha.f32.
+        root/index.json lists its dates (rows) and symbols (columns). Missing forecasts are nan.
+        Rows are only appended. Columns have room for capacity symbols, the file is rewritten when it is full.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.data_path = os.path.join(root, 'alpha.f32')
+        self.index_path = os.path.join(root, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as json_file:
+                index = json.load(json_file)
+        else:
+            index = {'dates': [], 'symbols': [], 'capacity': 0}
+        self.dates = index['dates']
+        self.symbols = index['symbols']
+        self.capacity = index['capacity']
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as json_file:
+            json.dump({'dates': self.dates, 'symbols': self.symbols, 'capacity': self.capacity}, json_file)
+        os.replace(tmp, self.index_path)
+
+    def matrix(self):
+        """ Read-only memory map (dates x symbols). """
+        if len(self.dates) == 0:
+            return np.zeros((0, len(self.symbols)), dtype=np.float32)
+        data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(len(self.dates), self.capacity))
+        return data[:, :len(self.symbols)]
+
+    def read(self, date=None):
+        """ Alpha of every symbol on the last date up to date (last date by default), as a Series. """
+        position = len(self.dates) if date is None else np.searchsorted(self.dates, str(date), 'right')
+        if position == 0:
+            return pd.Series(dtype=float)
+        return pd.Series(np.array(self.matrix()[position - 1]), index=self.symbols)
+
+    def append(self, dates, symbols, values):
+        """ Adds rows dates, after the last one, with the values (dates x symbols) of symbols. """
+        dates = [str(date) for date in dates]
+        if len(self.dates) > 0 and dates[0] <= self.dates[-1]:
+            raise ValueError('Dates must be after ' + self.dates[-1])
+        new = [symbol for symbol in symbols if symbol not in self.symbol_index]
+        if len(self.symbols) + len(new) > self.capacity:
+            self._resize(max(2 * self.capacity, len(self.symbols) + len(new), 1024))
+        self.symbols += new
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+        n_rows = len(self.dates) + len(dates)
+        with open(self.data_path, 'ab') as data_file:
+            data_file.truncate(n_rows * self.capacity * 4)
+        data = np.memmap(self.data_path, dtype=np.float32, mode='r+', shape=(n_rows, self.capacity))
+        block = np.full((len(dates), self.capacity), np.nan, dtype=np.float32)
+        block[:, [self.symbol_index[symbol] for symbol in symbols]] = values
+        data[len(self.dates):] = block
+        data.flush()
+        del data
+        self.dates += dates
+        self._save_index()
+
+    def _resize(self, capacity):
+        """ Rewrites the rows with room for capacity symbols. """
+        tmp = self.data_path + '.tmp'
+        if len(self.dates) > 0:
+            old = self.matrix()
+            data = np.memmap(tmp, dtype=np.float32, mode='w+', shape=(len(self.dates), capacity))
+            data[:] = np.nan
+            data[:, :old.shape[1]] = old
+            data.flush()
+            del data, old
+        else:
+            open(tmp, 'wb').close()
+        os.replace(tmp, self.data_path)
+        self.capacity = capacity
+        self._save_index()
+
+    def truncate(self, last_date):
+        """ Forgets the rows after last_date (rows of a run that failed before saving its state). """
+        self.dates = [date for date in self.dates if date <= str(last_date)]
+        self._save_index()
+
+
+class Alpha:
+    """ Expected returns of every symbol: exposures to factors (styles of reg_factors_scaled and industries) times a
+        blend of signals, means of the past factor returns of reg_factor_returns. Signals are rolling means over window dates or exponentially
+        weighted means, both updated date by date from a state saved with the store, so each run only adds new dates.
+    """
+    def __init__(self, params):
+        self.params = params['alpha']
+        self.sql_manager = managerSQL.ManagerSQL(params['db'])
+        self.styles = self.params.get('styles', ['mcap', 'pb', 'mom'])
+        self.factors = self.params.get('factors', self.styles)
+        self.signals = self.params.get('signals', [{'type': 'ewm', 'half_life': 120, 'weight': 1.0}])
+        root = self.params.get('store_path', '../Alpha')
+        self.state_path = os.path.join(root, 'state.npz')
+        if self.params.get('clean_alpha', False):
+            for name in ['alpha.f32', 'index.json', 'state.npz']:
+                if os.path.exists(os.path.join(root, name)):
+                    os.remove(os.path.join(root, name))
+        self.store = AlphaStore(root)
+        self.industries = regression.get_industries(self.sql_manager, self.params.get('industry', 'office'))
+        self.load_state()
+
+    def load_state(self):
+        k = len(self.factors)
+        self.state = {'last_date': ''}
+        for i, signal in enumerate(self.signals):
+            if signal['type'] == 'rolling':
+                self.state.update({str(i) + '_buffer': np.zeros((signal['window'], k)), str(i) + '_sum': np.zeros(k),
+                                   str(i) + '_count': 0})
+            else:
+                self.state.update({str(i) + '_sum': np.zeros(k), str(i) + '_weight': 0.0})
+        if os.path.exists(self.state_path):
+            with np.load(self.state_path, allow_pickle=False) as state:
+                self.state.update({key: state[key] for key in state.files})
+            self.state['last_date'] = str(self.state['last_date'])
+        self.store.truncate(self.state['last_date'])
+
+    def save_state(self):
+        tmp = self.state_path + '.tmp.npz'
+        np.savez(tmp, **self.state)
+        os.replace(tmp, self.state_path)
+
+    def update(self, f):
+        """ Adds the factor returns f of a new date to every signal, in O(k). Returns the blended mean. """
+        state = self.state
+        mean = np.zeros(len(self.factors))
+        for i, signal in enumerate(self.signals):
+            key = str(i)
+            if signal['type'] == 'rolling':
+                window = signal['window']
+                count = int(state[key + '_count'])
+                position = count % window
+                state[key + '_sum'] = state[key + '_sum'] + f - state[key + '_buffer'][position]
+                state[key + '_buffer'][position] = f
+                if position == window - 1:
+                    # Avoids drift of the running sum
+                    state[key + '_sum'] = state[key + '_buffer'].sum(axis=0)
+                state[key + '_count'] = count + 1
+                mean += signal['weight'] * state[key + '_sum'] / min(count + 1, window)
+            else:
+                decay = 0.5 ** (1.0 / signal['half_life'])
+                state[key + '_sum'] = decay * state[key + '_sum'] + f
+                state[key + '_weight'] = decay * float(state[key + '_weight']) + 1
+                mean += signal['weight'] * state[key + '_sum'] / state[key + '_weight']
+        return mean
+
+    def get_date_blocks(self):
+        """ [start, end] of every year from start_date to end_date, after the last date of the state. """
+        start = pd.Timestamp(self.params['start_date'])
+        end = pd.Timestamp(self.params['end_date'])
+        if self.state['last_date'] != '':
+            start = max(start, pd.Timestamp(self.state['last_date']) + pd.Timedelta(days=1))
+        blocks = []
+        for year in range(start.year, end.year + 1):
+            block_start = max(start, pd.Timestamp(year, 1, 1))
+            block_end = min(end, pd.Timestamp(year, 12, 31))
+            if block_start <= block_end:
+                blocks.append([str(block_start.date()), str(block_end.date())])
+        return blocks
+
+    def process(self):
+        """ Main execution of Alpha class. Dates are processed in order, each year is appended to the store. """
+        for block in self.get_date_blocks():
+            self.process_block(block)
+
+    def process_block(self, block):
+        t0 = datetime.now()
+        label = '{0}..{1}'.format(block[0], block[1])
+
+        try:
+            dates_range = "date >= '{0}' and date <= '{1}'".format(block[0], block[1])
+            factor_returns = self.sql_manager.select_query(
+                'select date, factor, ret from reg_factor_returns where ' + dates_range)
+
+            if factor_returns.shape[0] > 0:
+                returns = factor_returns.pivot(index='date', columns='factor', values='ret').sort_index()
+                returns = returns.reindex(columns=self.factors).fillna(0)
+                styles = [factor for factor in self.factors if factor in self.styles]
+                df = self.sql_manager.select_query(
+                    'select symbol, date, ' + ', '.join(styles) + ' from reg_factors_scaled where ' + dates_range)
+                df = df[df.date.isin(returns.index)]
+
+                # Blended factor means of every date, then alpha = exposures . means
+                means = np.array([self.update(f) for f in returns.values])
+                codes = returns.index.get_indexer(df.date)
+                exposures = regression.exposure_matrix(df, self.industries, self.factors, styles)
+                alpha = np.einsum('ij,ij->i', exposures, means[codes])
+
+                symbols, columns = np.unique(df.symbol.values, return_inverse=True)
+                values = np.full((returns.shape[0], len(symbols)), np.nan, dtype=np.float32)
+                values[codes, columns] = alpha
+                self.store.append(returns.index, list(symbols), values)
+                self.state['last_date'] = str(returns.index[-1])
+                self.save_state()
+
+            t1 = datetime.now()
+            print('Processing successful for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+
+        except Exception:
+            t1 = datetime.now()
+            print('Processing failed for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+            raise
@@ -0,0 +1,1016 @@
+import sys
+import os
+import io
+import sqlite3
+import tempfile
+import contextlib
+import json
+import zipfile
+import resource
+import subprocess
+import threading
+import asyncio
+import collections
+import time
+from datetime import datetime
+from aiohttp import web
+import pandas as pd
+import numpy as np
+from statsmodels.stats import stattools
+import statsmodels.api as sm
+import managerSQL
+import dataProcessing
+import robustStats
+import regression
+import riskModel
+import optimizer
+import cvxpy as cp
+import webScraper
+from downloader import AsyncDownloader
+import factors
+from factors import FactorEngine
+from pointInTime import PointInTime
+from tradingCalendar import get_calendar
+
+
+class LocalManagerSQL(managerSQL.ManagerSQL):
+    """ SQLite stand-in for the PostgreSQL database, used by the benchmarks. """
+    def __init__(self, path, store=None, cache_mb=0):
+        self.sql_params = (path, store, cache_mb)
+        self.db_url = 'sqlite:///' + path
+
+        def connect():
+            return sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.pool = managerSQL.get_pool(self.db_url, connect, 4)
+        self.con = None
+        self.store = managerSQL.get_store(store)
+        # Off unless asked for, so that repeated reads of the other benchmarks hit the database
+        self.cache = managerSQL.get_cache(self.db_url, 256, cache_mb)
+        self.upload_mode = 'insert'
+        self.chunk_size = 100000
+        self.upsert = None
+        self.schema_path = '../Queries'
+        self.column_dtypes = {}
+
+    def __setstate__(self, state):
+        self.__init__(*state['sql_params'])
+
+    def _view_tables(self):
+        return {}
+
+    def _to_sql(self, table, df):
+        with self.pool.connection() as cnxn:
+            df.to_sql(name=table, con=cnxn, if_exists='append', index=False)
+            self._commit(cnxn)
+
+    def copy_df(self, table, df, chunk_size=None, upsert=None):
+        """ SQLite has no COPY. The bulk path is a single executemany per chunk of rows, in one transaction. """
+        chunk_size = chunk_size or self.chunk_size
+        verb = {None: 'insert', 'ignore': 'insert or ignore', 'update': 'insert or replace'}[upsert]
+        sql = verb + ' into ' + table + ' (' + ', '.join(df.columns) + ') values (' + \
+            ', '.join(['?'] * df.shape[1]) + ')'
+        with self.pool.connection() as cnxn:
+            for start in range(0, df.shape[0], chunk_size):
+                chunk = df.iloc[start:start + chunk_size].astype(object)
+                cnxn.executemany(sql, chunk.where(pd.notna(chunk), None).values.tolist())
+            self._commit(cnxn)
+        self._invalidate(table, df)
+
+    def create_index(self, table, columns):
+        self.query('create index if not exists ix_' + table + ' on ' + table + ' (' + ', '.join(columns) + ')')
+
+
+def synthetic_prices(n_symbols, n_years=2, seed=0):
+    """ Random walk prices shaped like the prices table, on the sessions of the trading calendar.
+        Symbols are listed at random dates.
+    """
+    rng = np.random.RandomState(seed)
+    sessions = get_calendar().sessions
+    dates = sessions[sessions <= '2018-12-31'][-int(n_years * 252):]
+    n_dates = len(dates)
+    frames = []
+    for i in range(n_symbols):
+        start = rng.randint(0, n_dates // 2) if rng.rand() < 0.3 else 0
+        n = n_dates - start
+        ret = rng.normal(0.0003, 0.02, n)
+        close = np.round(20 * np.exp(np.cumsum(ret)), 2)
+        frames.append(pd.DataFrame({
+            'symbol': 'S{0:05d}'.format(i),
+            'date': dates[start:].date,
+            'open': close,
+            'close': close,
+            'volume': rng.randint(1000, 10 ** 6, n),
+            'adjclose': close,
+            'divcash': 0.0,
+            'split': 1.0}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def synthetic_fundamentals(prices, seed=0):
+    """ Quarterly equity and shares for every symbol of prices, with ddate at quarter ends. """
+    rng = np.random.RandomState(seed)
+    symbols = prices.symbol.unique()
+    quarters = pd.date_range(pd.Timestamp(prices.date.min()) - pd.DateOffset(months=6),
+                             pd.Timestamp(prices.date.max()), freq='Q')
+    n = len(quarters)
+    df = pd.DataFrame({
+        'symbol': np.repeat(symbols, n),
+        'ddate': np.tile(quarters.date, len(symbols))})
+    df['filed'] = (pd.to_datetime(df.ddate) + pd.DateOffset(days=45)).dt.date
+    df['equity'] = np.round(rng.lognormal(12, 1, df.shape[0]))
+    df['shares_basic'] = np.round(rng.lognormal(10, 1, df.shape[0]))
+    # Missing filings
+    df = df[rng.rand(df.shape[0]) > 0.1]
+    equity = df[['symbol', 'ddate', 'filed', 'equity']].reset_index(drop=True)
+    shares = df[['symbol', 'ddate', 'filed', 'shares_basic']].reset_index(drop=True)
+    return equity, shares
+
+
+# Shape of sec_tags_main: tag, col, tab
+SEC_TAGS = pd.DataFrame([
+    ['StockholdersEquity', 'equity', 'bal'],
+    ['Assets', 'assets', 'bal'],
+    ['Liabilities', 'liabilities', 'bal'],
+    ['Revenues', 'revenue', 'res'],
+    ['NetIncomeLoss', 'net_income', 'res'],
+    ['OperatingIncomeLoss', 'operating_income', 'res'],
+    ['WeightedAverageNumberOfSharesOutstandingBasic', 'shares_basic', 'shr'],
+    ['WeightedAverageNumberOfDilutedSharesOutstanding', 'shares_diluted', 'shr']], columns=['tag', 'col', 'tab'])
+
+
+def synthetic_sec_zip(path, n_rows=2000000, n_filings=6000, n_tags=3000, seed=0):
+    """ Quarterly SEC zip file with sub.txt and num.txt shaped like the real data sets.
+        About 10% of num.txt rows have tags in SEC_TAGS, the rest are other tags.
+    """
+    rng = np.random.RandomState(seed)
+    adsh = np.array(['0000{0:06d}-19-{1:06d}'.format(rng.randint(10 ** 6), i) for i in range(n_filings)])
+    sub = pd.DataFrame({
+        'adsh': adsh,
+        'cik': rng.randint(1000, 1700000, n_filings),
+        'name': ['COMPANY {0}'.format(i) for i in range(n_filings)],
+        'sic': rng.choice([1000, 2834, 3571, 6022, 7372], n_filings),
+        'countryba': 'US',
+        'stprba': 'CA',
+        'fye': '1231',
+        'form': rng.choice(['10-Q', '10-K'], n_filings, p=[0.8, 0.2]),
+        'period': rng.choice(['20181231', '20190331'], n_filings),
+        'fy': 2019,
+        'fp': 'Q1',
+        'filed': rng.choice(['20190215', '20190301', '20190510'], n_filings)})
+    tags = np.concatenate([SEC_TAGS.tag.values, ['Tag{0:04d}'.format(i) for i in range(n_tags)]])
+    main = rng.rand(n_rows) < 0.1
+    tag_idx = np.where(main, rng.randint(0, SEC_TAGS.shape[0], n_rows), rng.randint(SEC_TAGS.shape[0], len(tags), n_rows))
+    tag = tags[tag_idx]
+    shares = np.isin(tag, SEC_TAGS.tag[SEC_TAGS.tab == 'shr'])
+    qtrs = np.where(np.isin(tag, SEC_TAGS.tag[SEC_TAGS.tab == 'bal']), 0, rng.choice([0, 1, 4], n_rows))
+    num = pd.DataFrame({
+        'adsh': adsh[rng.randint(0, n_filings, n_rows)],
+        'tag': tag,
+        'version': 'us-gaap/2018',
+        'ddate': rng.choice(['20181231', '20190331'], n_rows),
+        'qtrs': qtrs,
+        'uom': np.where(shares, 'shares', 'USD'),
+        'coreg': np.where(rng.rand(n_rows) < 0.02, 'SUBSIDIARY', ''),
+        'value': np.round(rng.lognormal(15, 2, n_rows), 0),
+        'footnote': ''})
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('sub.txt', sub.to_csv(sep='\t', index=False))
+        zip_file.writestr('num.txt', num.to_csv(sep='\t', index=False))
+    return path
+
+
+def local_sec_scraper(path, scraper_config=None):
+    """ SecScraper working on the local database, with SEC_TAGS as sec_tags_main. """
+    scraper = webScraper.SecScraper.__new__(webScraper.SecScraper)
+    scraper.scraper_config = scraper_config or {}
+    scraper.sql_manager = LocalManagerSQL(path)
+    scraper.limit_reached = False
+    scraper.sub_files = []
+    scraper.tags = dict(zip(SEC_TAGS.tag, SEC_TAGS.col))
+    scraper.col_bal = list(SEC_TAGS[SEC_TAGS.tab == 'bal'].col)
+    scraper.col_res = list(SEC_TAGS[SEC_TAGS.tab == 'res'].col)
+    scraper.col_shr = list(SEC_TAGS[SEC_TAGS.tab == 'shr'].col)
+    scraper.cik_symbol = {}
+    return scraper
+
+
+def peak_rss_mb():
+    """ Peak resident memory of the process. ru_maxrss survives fork + exec on Linux, VmHWM doesn't. """
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    """ Resets the peak resident memory of the process to the current one (Linux), so that peak_rss_mb measures
+        what comes next instead of the setup.
+    """
+    if os.path.exists('/proc/self/clear_refs'):
+        try:
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            pass
+
+
+def sec_ingest_worker(mode, zip_path, db_path):
+    """ Ingests a quarter in a fresh process and prints its peak RSS, so that modes don't share the peak. """
+    streaming = mode == 'stream'
+    scraper = local_sec_scraper(db_path, {'streaming': streaming, 'chunk_size': 250000})
+    base = peak_rss_mb()
+    t0 = datetime.now()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if streaming:
+            with open(zip_path, 'rb') as file:
+                scraper.ingest(file, '2019q1')
+        else:
+            with open(zip_path, 'rb') as file:
+                scraper.ingest(io.BytesIO(file.read()), '2019q1')
+    seconds = (datetime.now() - t0).total_seconds()
+    print(json.dumps({'seconds': seconds, 'base_mb': base, 'peak_mb': peak_rss_mb()}))
+
+
+def bench_sec_ingest(sizes):
+    """ Peak RSS of SecScraper.ingest reading num.txt at once vs streaming it in chunks. """
+    print('\nSecScraper.ingest')
+    print('{0:>10} {1:>10} {2:>12} {3:>14} {4:>12} {5:>14}'.format(
+        'rows', 'zip (MB)', 'memory (s)', 'memory (MB)', 'stream (s)', 'stream (MB)'))
+    with tempfile.TemporaryDirectory() as folder:
+        for n_rows in sizes:
+            zip_path = synthetic_sec_zip(os.path.join(folder, '{0}.zip'.format(n_rows)), n_rows)
+            results = {}
+            for mode in ['memory', 'stream']:
+                db_path = os.path.join(folder, '{0}_{1}.db'.format(n_rows, mode))
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), 'sec_ingest_worker', mode,
+                                         zip_path, db_path], stdout=subprocess.PIPE, check=True).stdout
+                results[mode] = json.loads(output.decode().strip().split('\n')[-1])
+            print('{0:>10} {1:>10.1f} {2:>12.2f} {3:>14.0f} {4:>12.2f} {5:>14.0f}'.format(
+                n_rows, os.path.getsize(zip_path) / 2 ** 20,
+                results['memory']['seconds'], results['memory']['peak_mb'] - results['memory']['base_mb'],
+                results['stream']['seconds'], results['stream']['peak_mb'] - results['stream']['base_mb']))
+
+
+def reference_pivot_num(num_df, tags):
+    """ Filter and pivots of SecScraper.upload_num before _pivot_num: masks, dropna and a pivot_table per table. """
+    columns = ['adsh', 'tag', 'version', 'ddate', 'qtrs', 'uom', 'coreg', 'value']
+    data = num_df[columns]
+    data = data[data.tag.isin(tags)]
+    data = data.dropna(subset=['adsh', 'version', 'tag', 'ddate', 'qtrs', 'uom', 'value'])
+    data = data.astype({'ddate': str, 'qtrs': int, 'coreg': str})
+    data_shr = data[data.uom == 'shares']
+    data_mon = data[data.uom != 'shares']
+    data_bal = data_mon[data_mon.qtrs == 0]
+    data_res = data_mon[data_mon.qtrs != 0]
+    return [data_bal.pivot_table(values='value', index=['adsh', 'uom', 'ddate'], columns='tag', aggfunc=np.mean),
+            data_res.pivot_table(values='value', index=['adsh', 'uom', 'ddate', 'qtrs'], columns='tag',
+                                 aggfunc=np.mean),
+            data_shr.pivot_table(values='value', index=['adsh', 'ddate', 'qtrs'], columns='tag', aggfunc=np.mean)]
+
+
+def bench_upload_num(sizes):
+    """ Filter and pivot_table vs SecScraper._filter_num and _pivot_num on num.txt of quarters of sizes rows
+        (a real quarter has 2-3 million rows and about 6000 filings). Checks both give identical tables.
+    """
+    print('\nupload_num pivot')
+    print('{0:>10} {1:>10} {2:>14} {3:>12} {4:>8} {5:>10}'.format(
+        'rows', 'filtered', 'pivot_table (s)', 'codes (s)', 'speedup', 'identical'))
+    num_type = {'adsh': str, 'tag': str, 'version': str, 'ddate': str, 'qtrs': int, 'uom': str,
+                'coreg': str, 'value': float}
+    with tempfile.TemporaryDirectory() as folder:
+        scraper = local_sec_scraper(os.path.join(folder, 'sec.db'))
+        for n_rows in sizes:
+            zip_path = synthetic_sec_zip(os.path.join(folder, '{0}.zip'.format(n_rows)), n_rows)
+            with zipfile.ZipFile(zip_path) as zip_file:
+                num_df = pd.read_csv(zip_file.open('num.txt'), sep='\t', dtype=num_type)
+            t0 = datetime.now()
+            reference = reference_pivot_num(num_df, scraper.tags.keys())
+            t1 = datetime.now()
+            data = scraper._filter_num(num_df)
+            pivots = scraper._pivot_num(data)
+            t2 = datetime.now()
+            identical = all(a.equals(b) and a.columns.equals(b.columns) and a.index.equals(b.index)
+                            for a, b in zip(reference, pivots))
+            print('{0:>10} {1:>10} {2:>14.2f} {3:>12.2f} {4:>8.1f} {5:>10}'.format(
+                n_rows, data.shape[0], (t1 - t0).total_seconds(), (t2 - t1).total_seconds(),
+                (t1 - t0).total_seconds() / (t2 - t1).total_seconds(), str(identical)))
+
+
+def local_processor(path, params=None):
+    """ DataProcessing instance working on the local database, without querying it on construction. """
+    processor = dataProcessing.DataProcessing.__new__(dataProcessing.DataProcessing)
+    processor.params = params or {}
+    processor.sql_manager = LocalManagerSQL(path)
+    processor.incremental = processor.params.get('incremental', False)
+    processor.high_water = {}
+    processor.engine = FactorEngine(processor.params.get('factors'))
+    processor.factors_format = processor.params.get('factors_format', 'wide')
+    processor.factors_table = 'reg_factors_long' if processor.factors_format == 'long' else 'reg_factors'
+    processor.lookback = processor.engine.lookback
+    processor.styles = processor.params.get('styles', ['mcap', 'pb', 'mom'])
+    return processor
+
+
+def bench_manager(path):
+    """ ManagerSQL for the database in config.json if there is one, local SQLite stand-in otherwise. """
+    if os.path.exists('config.json'):
+        with open('config.json') as json_file:
+            params = json.load(json_file)
+        return managerSQL.ManagerSQL(params['db'])
+    return LocalManagerSQL(path)
+
+
+class MockVendor:
+    """ Local HTTP server standing in for a price vendor, in its own thread. /prices/<n> answers a small JSON
+        document after delay seconds. Beyond rate requests in the last second it answers 429, and the first
+        request of every failure_every-th document gets a 503.
+    """
+    def __init__(self, rate, delay=0.02, failure_every=10):
+        self.rate = rate
+        self.delay = delay
+        self.failure_every = failure_every
+        self.accepted = collections.deque()
+        self.seen = set()
+        self.statuses = collections.Counter()
+
+    async def handle(self, request):
+        n = int(request.match_info['n'])
+        now = time.monotonic()
+        while len(self.accepted) > 0 and self.accepted[0] < now - 1:
+            self.accepted.popleft()
+        if len(self.accepted) >= self.rate:
+            self.statuses[429] += 1
+            return web.Response(status=429)
+        self.accepted.append(now)
+        if n % self.failure_every == 0 and n not in self.seen:
+            self.seen.add(n)
+            self.statuses[503] += 1
+            return web.Response(status=503)
+        await asyncio.sleep(self.delay)
+        self.statuses[200] += 1
+        return web.json_response([{'date': '2018-12-31', 'close': 10.0 + n % 7, 'volume': 1000}])
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            app = web.Application()
+            app.router.add_get('/prices/{n}', self.handle)
+            self.runner = web.AppRunner(app)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            self.loop.run_until_complete(site.start())
+            self.url = 'http://127.0.0.1:{0}'.format(site._server.sockets[0].getsockname()[1])
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def bench_downloader(sizes, server_rate=200):
+    """ AsyncDownloader against MockVendor (limit of server_rate requests per second, 20 ms per document, a 503 on
+        one document in 10), for sizes documents: achieved rate and retries without a client rate limit and with
+        one just under the vendor limit.
+    """
+    print('\ndownloader (vendor limit {0} req/s)'.format(server_rate))
+    print('{0:>8} {1:>12} {2:>8} {3:>8} {4:>10} {5:>10} {6:>8} {7:>8} {8:>8}'.format(
+        'docs', 'client rate', 'ok', 'failed', 'seconds', 'docs/s', 'req', '429', 'retries'))
+    for n_docs in sizes:
+        for rate in [None, int(server_rate * 0.9)]:
+            vendor = MockVendor(server_rate).start()
+            downloader = AsyncDownloader(concurrency=16, rate=rate, burst=10, retries=8, backoff=0.05)
+            t0 = datetime.now()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summary = downloader.run(range(1, n_docs + 1), lambda n: vendor.url + '/prices/{0}'.format(n),
+                                         lambda n, payload: payload, lambda n, data: len(data))
+            seconds = (datetime.now() - t0).total_seconds()
+            vendor.stop()
+            print('{0:>8} {1:>12} {2:>8} {3:>8} {4:>10.2f} {5:>10.1f} {6:>8} {7:>8} {8:>8}'.format(
+                n_docs, str(rate), len(summary.results), len(summary.errors), seconds, len(summary.results) / seconds,
+                downloader.stats['requests'], vendor.statuses[429], downloader.stats['retries']))
+
+
+@contextlib.contextmanager
+def local_postgres(folder):
+    """ ManagerSQL of a throwaway PostgreSQL server with its data in folder, started with pgserver
+        (pip install pgserver, not a dependency of the pipeline). None if pgserver isn't installed.
+    """
+    try:
+        import pgserver
+    except ImportError:
+        yield None
+        return
+    server = pgserver.get_server(folder, cleanup_mode='stop')
+    try:
+        yield managerSQL.ManagerSQL({'db_name': 'postgres', 'user': 'postgres', 'password': '', 'port': '5432',
+                                     'host': folder, 'pool_size': 4, 'cache_mb': 0})
+    finally:
+        # Stops the server, closing the connections of the pool
+        server.cleanup()
+
+
+def bench_upload(sizes):
+    """ DataFrame.to_sql vs bulk copy_df on prices rows, appending and then re-uploading with upsert.
+        Runs on the SQLite stand-in, which has no COPY (copy_df is an executemany there), and on PostgreSQL: the
+        database of config.json if there is one, otherwise a local server if pgserver is installed.
+    """
+    columns = 'symbol varchar(10) not null, date date not null, open real, close real, volume integer, ' + \
+              'adjclose real, divcash real, split real, primary key (symbol, date)'
+    with tempfile.TemporaryDirectory() as folder:
+        with contextlib.ExitStack() as stack:
+            managers = [LocalManagerSQL(os.path.join(folder, 'upload.db'))]
+            if os.path.exists('config.json'):
+                managers.append(bench_manager(None))
+            else:
+                postgres = stack.enter_context(local_postgres(os.path.join(folder, 'postgres')))
+                if postgres is None:
+                    print('\npgserver is not installed, upload_df is only measured on SQLite')
+                else:
+                    managers.append(postgres)
+            for manager in managers:
+                print('\nupload_df ({0})'.format('SQLite' if isinstance(manager, LocalManagerSQL) else 'PostgreSQL'))
+                print('{0:>10} {1:>12} {2:>12} {3:>8} {4:>12}'.format(
+                    'rows', 'to_sql (s)', 'copy (s)', 'speedup', 'upsert (s)'))
+                for n_rows in sizes:
+                    prices = synthetic_prices(n_rows // 500 + 1, 2).head(n_rows)
+                    times = {}
+                    for mode in ['insert', 'copy', 'upsert']:
+                        if mode != 'upsert':
+                            manager.query('drop table if exists prices_bench')
+                            manager.query('create table prices_bench (' + columns + ')')
+                        t0 = datetime.now()
+                        if mode == 'insert':
+                            manager.upload_mode = 'insert'
+                            manager.upload_df('prices_bench', prices)
+                        else:
+                            manager.copy_df('prices_bench', prices, upsert='update' if mode == 'upsert' else None)
+                        times[mode] = (datetime.now() - t0).total_seconds()
+                    print('{0:>10} {1:>12.2f} {2:>12.2f} {3:>8.1f} {4:>12.2f}'.format(
+                        n_rows, times['insert'], times['copy'], times['insert'] / times['copy'], times['upsert']))
+                manager.query('drop table if exists prices_bench')
+
+
+def bench_typed_load(sizes):
+    """ Memory of the prices table loaded by pd.read_sql vs ManagerSQL.select_typed, by column.
+        With a config.json the full prices table of the database is loaded (sizes are ignored), otherwise
+        synthetic prices of sizes rows in a local SQLite database.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        manager = bench_manager(os.path.join(folder, 'prices.db'))
+        if isinstance(manager, LocalManagerSQL):
+            manager.query('create table prices (symbol varchar(10) not null, date date not null, '
+                          'open numeric(14,2) not null, close numeric(14,2) not null, volume integer not null, '
+                          'adjclose numeric(14,2), divcash numeric(14,1), split numeric(14,1), '
+                          'primary key (symbol, date))')
+        else:
+            sizes = [None]
+        print('\nprices typed load ({0})'.format(type(manager).__name__))
+        for n_rows in sizes:
+            if n_rows is not None:
+                manager.query('delete from prices')
+                manager.copy_df('prices', synthetic_prices(n_rows // 500 + 1, 2).head(n_rows))
+            t0 = datetime.now()
+            untyped = manager.select('prices')
+            t1 = datetime.now()
+            typed = manager.select_typed('prices')
+            t2 = datetime.now()
+            untyped_mb = untyped.memory_usage(index=False, deep=True) / 1e6
+            typed_mb = typed.memory_usage(index=False, deep=True) / 1e6
+            print('\n{0} rows, read_sql {1:.2f} sec, typed {2:.2f} sec'.format(
+                typed.shape[0], (t1 - t0).total_seconds(), (t2 - t1).total_seconds()))
+            print('{0:<10} {1:>16} {2:>10} {3:>16} {4:>10} {5:>10}'.format(
+                'column', 'read_sql', '(MB)', 'typed', '(MB)', 'reduction'))
+            for column in typed.columns:
+                print('{0:<10} {1:>16} {2:>10.1f} {3:>16} {4:>10.1f} {5:>10.1f}'.format(
+                    column, str(untyped[column].dtype), untyped_mb[column], str(typed[column].dtype),
+                    typed_mb[column], untyped_mb[column] / typed_mb[column]))
+            print('{0:<10} {1:>16} {2:>10.1f} {3:>16} {4:>10.1f} {5:>10.1f}'.format(
+                'total', '', untyped_mb.sum(), '', typed_mb.sum(), untyped_mb.sum() / typed_mb.sum()))
+
+
+def bench_query_cache(sizes, n_readers=20):
+    """ Lookups repeated by n_readers components (symbols list, distinct symbols of prices, last dates) with and
+        without the query cache, for sizes symbols. A write to prices between readers invalidates its lookups.
+    """
+    print('\nquery cache ({0} readers)'.format(n_readers))
+    print('{0:>10} {1:>14} {2:>14} {3:>8} {4:>8} {5:>8}'.format(
+        'symbols', 'uncached (s)', 'cached (s)', 'speedup', 'hits', 'misses'))
+    for n_symbols in sizes:
+        prices = synthetic_prices(n_symbols, 1)
+        last = prices.date == prices.date.max()
+        times = {}
+        with tempfile.TemporaryDirectory() as folder:
+            for cache_mb in [0, 64]:
+                manager = LocalManagerSQL(os.path.join(folder, 'cache{0}.db'.format(cache_mb)), cache_mb=cache_mb)
+                manager.upload_df('symbols', pd.DataFrame({'symbol': prices.symbol.unique()}))
+                manager.upload_df('prices', prices[~last])
+                t0 = datetime.now()
+                for reader in range(n_readers):
+                    if reader == n_readers // 2:
+                        manager.upload_df('prices', prices[last])
+                    manager.select('symbols')
+                    manager.select_distinct_column_list('symbol', 'prices')
+                    manager.select_query('select symbol, max(date) as date from prices group by symbol')
+                times[cache_mb] = (datetime.now() - t0).total_seconds()
+            metrics = manager.cache_metrics()
+            print('{0:>10} {1:>14.2f} {2:>14.2f} {3:>8.1f} {4:>8} {5:>8}'.format(
+                n_symbols, times[0], times[64], times[0] / times[64], metrics['hits'], metrics['misses']))
+
+
+def reference_raw_factors(df_prices, equity, shares):
+    """ compute_raw_factors of one symbol before the FactorEngine: returns and momentum merged from prices on
+        dates shifted along the trading calendar, and point in time equity and shares. The oracle the factors of
+        the FactorEngine are checked against.
+    """
+    # Momentum is forward filled in date order
+    df_prices = df_prices.sort_values('date').reset_index(drop=True)
+
+    # Returns
+    df_prices_1d = df_prices.copy()
+    cols = ['date', 'adjclose']
+    df_prices_1d = df_prices_1d[cols]
+    calendar = get_calendar()
+    df_prices_1d['date'] = calendar.shift(df_prices_1d.date, 1)
+    s1d = ('', '_1d')
+    df_prices = df_prices.merge(df_prices_1d, left_on='date', right_on='date', how='left', suffixes=s1d)
+    df_prices['ret'] = np.log(df_prices.adjclose) - np.log(df_prices.adjclose_1d)
+    df_prices.drop(columns=['adjclose_1d'], inplace=True)
+    col_remains = ['symbol', 'date', 'ret']
+
+    # Equity
+    df_prices = equity.join(df_prices)
+    col_remains.append('equity')
+
+    # Shares
+    df_prices = shares.join(df_prices)
+
+    # Market Price
+    df_prices['mcap'] = df_prices['close'].multiply(df_prices['shares_basic'])
+    col_remains.append('mcap')
+
+    # Price to Book Value
+    df_prices['pb'] = df_prices['mcap'].divide(df_prices['equity'])
+    col_remains.append('pb')
+
+    # Momentum
+    df_prices_12m = df_prices.copy()
+    df_prices_1m = df_prices.copy()
+    cols = ['date', 'adjclose']
+    df_prices_12m = df_prices_12m[cols]
+    df_prices_1m = df_prices_1m[cols]
+    df_prices_12m['date'] = calendar.shift(df_prices_12m.date, factors.YEAR)
+    df_prices_1m['date'] = calendar.shift(df_prices_1m.date, factors.MONTH)
+    s12m = ('', '_12m')
+    s1m = ('', '_1m')
+    df_prices = df_prices.merge(df_prices_12m, left_on='date', right_on='date', how='left', suffixes=s12m)
+    df_prices = df_prices.merge(df_prices_1m, left_on='date', right_on='date', how='left', suffixes=s1m)
+    df_prices['mom'] = np.log(df_prices.adjclose_1m) - np.log(df_prices.adjclose_12m)
+    df_prices['mom'] = df_prices.mom.fillna(method='ffill', limit=5)
+    df_prices.drop(columns=['adjclose_12m', 'adjclose_1m'], inplace=True)
+    col_remains.append('mom')
+
+    # Clean
+    df_prices = df_prices[col_remains].dropna()
+    df_prices['date'] = df_prices.date.dt.date
+    return df_prices
+
+
+def bench_raw_factors(sizes, n_years=2):
+    """ reference_raw_factors (per symbol, with merges) vs compute_raw_factors with the FactorEngine per symbol and
+        in panels. Checks both modes upload the same reg_factors rows as the reference.
+    """
+    columns = ['ret', 'equity', 'mcap', 'pb', 'mom']
+    print('\ncompute_raw_factors ({0} years)'.format(n_years))
+    print('{0:>8} {1:>14} {2:>12} {3:>12} {4:>8} {5:>10}'.format(
+        'symbols', 'reference (s)', 'symbol (s)', 'panel (s)', 'speedup', 'equal'))
+    for n_symbols in sizes:
+        prices = synthetic_prices(n_symbols, n_years)
+        equity, shares = synthetic_fundamentals(prices)
+        times = {}
+        results = {}
+        with tempfile.TemporaryDirectory() as folder:
+            for mode in ['reference', 'symbol', 'panel']:
+                path = os.path.join(folder, mode + '.db')
+                processor = local_processor(path, {'panel_chunk_size': 500})
+                processor.sql_manager.upload_df('prices', prices)
+                processor.sql_manager.create_index('prices', ['symbol'])
+                processor.elements = list(prices.symbol.unique())
+                processor.fundamentals = {'equity': PointInTime(equity, ['equity']),
+                                          'shares_basic': PointInTime(shares, ['shares_basic'])}
+                t0 = datetime.now()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if mode == 'reference':
+                        for symbol in processor.elements:
+                            df_prices = processor.sql_manager.select_partitions('prices', 'symbol', [symbol],
+                                                                                typed=True)
+                            df = reference_raw_factors(df_prices, processor.fundamentals['equity'],
+                                                       processor.fundamentals['shares_basic'])
+                            processor.sql_manager.upload_df('reg_factors', df)
+                    elif mode == 'panel':
+                        for symbols in processor.get_panels():
+                            processor.compute_raw_factors_panel(symbols)
+                    else:
+                        for symbol in processor.elements:
+                            processor.compute_raw_factors(symbol)
+                times[mode] = (datetime.now() - t0).total_seconds()
+                df = processor.sql_manager.select('reg_factors')
+                results[mode] = df.sort_values(['symbol', 'date']).reset_index(drop=True)
+        reference = results['reference']
+        equal = all(results[mode].shape == reference.shape and
+                    (results[mode][['symbol', 'date']] == reference[['symbol', 'date']]).all().all() and
+                    np.allclose(results[mode][columns], reference[columns], equal_nan=True)
+                    for mode in ['symbol', 'panel'])
+        print('{0:>8} {1:>14.2f} {2:>12.2f} {3:>12.2f} {4:>8.1f} {5:>10}'.format(
+            n_symbols, times['reference'], times['symbol'], times['panel'], times['reference'] / times['panel'],
+            str(equal)))
+
+
+def bench_factors(sizes, n_years=2):
+    """ FactorEngine.compute of one factor (mom) vs every factor of the registry, on a panel of sizes symbols.
+        Factors share the matrices of the panel and its intermediates (log prices, returns, market cap).
+    """
+    names = sorted(factors.FACTORS)
+    print('\nfactors ({0} years, {1} factors)'.format(n_years, len(names)))
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>10} {5:>8}'.format(
+        'symbols', 'rows', 'panel (s)', 'mom (s)', 'all (s)', 'all/mom'))
+    for n_symbols in sizes:
+        prices = synthetic_prices(n_symbols, n_years)
+        equity, shares = synthetic_fundamentals(prices)
+        df = PointInTime(shares, ['shares_basic']).join(PointInTime(equity, ['equity']).join(prices))
+        df['date'] = pd.to_datetime(df.date)
+        times = {}
+        t0 = datetime.now()
+        FactorEngine(names).panel(df)
+        times['panel'] = (datetime.now() - t0).total_seconds()
+        for label, selected in [('mom', ['mom']), ('all', names)]:
+            t0 = datetime.now()
+            FactorEngine(selected).compute(df)
+            times[label] = (datetime.now() - t0).total_seconds()
+        print('{0:>8} {1:>10} {2:>10.2f} {3:>10.2f} {4:>10.2f} {5:>8.1f}'.format(
+            n_symbols, df.shape[0], times['panel'], times['mom'], times['all'], times['all'] / times['mom']))
+
+
+def synthetic_factors(n_symbols, n_dates, seed=0):
+    """ Raw factors shaped like reg_factors, with skewed returns and a few extreme values. """
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range(end='2018-12-31', periods=n_dates)
+    n = n_symbols * n_dates
+    ret = rng.standard_t(3, n) * 0.02 + rng.exponential(0.005, n)
+    return pd.DataFrame({
+        'symbol': np.tile(['S{0:05d}'.format(i) for i in range(n_symbols)], n_dates),
+        'date': np.repeat(dates.date, n_symbols),
+        'ret': ret,
+        'equity': np.round(rng.lognormal(12, 1, n)),
+        'mcap': np.round(rng.lognormal(13, 1.5, n)),
+        'pb': rng.lognormal(0, 0.8, n),
+        'mom': rng.normal(0.05, 0.3, n)})
+
+
+def bench_cross_section(sizes, n_dates=250):
+    """ Per-date process_cross_section vs process_cross_section_batch. Checks both upload the same rows. """
+    print('\ncross section ({0} dates)'.format(n_dates))
+    print('{0:>8} {1:>12} {2:>12} {3:>8} {4:>10}'.format('symbols', 'date (s)', 'batch (s)', 'speedup', 'equal'))
+    for n_symbols in sizes:
+        factors = synthetic_factors(n_symbols, n_dates)
+        times = {}
+        results = {}
+        with tempfile.TemporaryDirectory() as folder:
+            for mode in ['date', 'batch']:
+                processor = local_processor(os.path.join(folder, mode + '.db'))
+                processor.sql_manager.upload_df('reg_factors', factors)
+                processor.sql_manager.create_index('reg_factors', ['date'])
+                processor.dates = pd.DatetimeIndex(pd.to_datetime(factors.date.unique()))
+                t0 = datetime.now()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if mode == 'batch':
+                        for dates in processor.get_date_blocks():
+                            processor.process_cross_section_batch(dates)
+                    else:
+                        for date in processor.dates:
+                            processor.process_cross_section(date)
+                times[mode] = (datetime.now() - t0).total_seconds()
+                df = processor.sql_manager.select('reg_factors_scaled')
+                results[mode] = df.sort_values(['symbol', 'date']).reset_index(drop=True)
+        cols = ['ret', 'mcap', 'pb', 'mom', 'weight']
+        equal = results['date'].shape == results['batch'].shape and \
+            np.allclose(results['date'][cols], results['batch'][cols], equal_nan=True)
+        print('{0:>8} {1:>12.2f} {2:>12.2f} {3:>8.1f} {4:>10}'.format(
+            n_symbols, times['date'], times['batch'], times['date'] / times['batch'], str(equal)))
+
+
+def reference_medcouple(y):
+    """ statsmodels medcouple, with its O(n^2) algorithm in versions that also have a faster one. """
+    try:
+        return float(stattools.medcouple(y, use_fast=False))
+    except TypeError:
+        return float(stattools.medcouple(y))
+
+
+def bench_medcouple(sizes):
+    """ robustStats.medcouple vs statsmodels on symmetric, skewed and tied samples.
+        statsmodels builds the n/2 x n/2 kernel matrix, it is skipped above 10000 values.
+    """
+    print('\nmedcouple')
+    print('{0:>8} {1:>10} {2:>14} {3:>12} {4:>8} {5:>10}'.format(
+        'n', 'sample', 'statsmodels (s)', 'fast (s)', 'speedup', 'equal'))
+    rng = np.random.RandomState(0)
+    for n in sizes:
+        samples = {'normal': rng.normal(size=n), 'lognormal': rng.lognormal(0, 1, n),
+                   'ties': np.round(rng.standard_t(3, n) * 5)}
+        for name, y in samples.items():
+            t0 = datetime.now()
+            fast = robustStats.medcouple(y)
+            t_fast = (datetime.now() - t0).total_seconds()
+            if n <= 10000:
+                t0 = datetime.now()
+                reference = reference_medcouple(y)
+                t_reference = (datetime.now() - t0).total_seconds()
+                print('{0:>8} {1:>10} {2:>14.4f} {3:>12.4f} {4:>8.1f} {5:>10}'.format(
+                    n, name, t_reference, t_fast, t_reference / max(t_fast, 1e-6), str(np.isclose(fast, reference))))
+            else:
+                print('{0:>8} {1:>10} {2:>14} {3:>12.4f} {4:>8} {5:>10}'.format(n, name, '-', t_fast, '-', '-'))
+
+
+def synthetic_scaled_factors(n_symbols, n_dates, n_industries=8, seed=0):
+    """ Factors shaped like reg_factors_scaled, with outliers at zero weight, and industries of the symbols. """
+    rng = np.random.RandomState(seed)
+    df = synthetic_factors(n_symbols, n_dates, seed).drop(columns=['equity'])
+    for col in ['mcap', 'pb', 'mom']:
+        df[col] = rng.normal(size=df.shape[0])
+    df['ret'] = 0.01 * df.mcap - 0.005 * df.mom + df.ret
+    df['weight'] = (rng.rand(df.shape[0]) > 0.02).astype(float)
+    symbols = df.symbol.unique()
+    offices = rng.randint(0, n_industries, len(symbols))
+    industries = {s: 'Industry {0}'.format(o) for s, o in zip(symbols, offices) if rng.rand() > 0.05}
+    return df, industries
+
+
+def reference_regression(df, industries, styles):
+    """ statsmodels WLS of every date, as Regression.solve. """
+    rows = []
+    for date, group in df.groupby('date'):
+        group = group[group.weight > 0]
+        dummies = pd.get_dummies(group.symbol.map(industries).fillna('Other')).astype(float)
+        exog = pd.concat([dummies, group[styles]], axis=1)
+        fit = sm.WLS(group.ret, exog, weights=group.weight).fit()
+        rows.append(pd.DataFrame({'date': date, 'factor': exog.columns, 'ret': fit.params.values,
+                                  'tstat': fit.tvalues.values}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def bench_regression(sizes, n_dates=250):
+    """ Stacked Regression.solve vs a loop of statsmodels WLS fits. Checks factor returns and t-stats. """
+    print('\nregression ({0} dates)'.format(n_dates))
+    print('{0:>8} {1:>14} {2:>12} {3:>8} {4:>10}'.format('symbols', 'statsmodels (s)', 'stacked (s)', 'speedup', 'equal'))
+    for n_symbols in sizes:
+        df, industries = synthetic_scaled_factors(n_symbols, n_dates)
+        reg = regression.Regression.__new__(regression.Regression)
+        reg.params = {}
+        reg.styles = ['mcap', 'pb', 'mom']
+        reg.industries = industries
+        t0 = datetime.now()
+        factor_returns, _ = reg.solve(df)
+        t_stacked = (datetime.now() - t0).total_seconds()
+        t0 = datetime.now()
+        reference = reference_regression(df, industries, reg.styles)
+        t_reference = (datetime.now() - t0).total_seconds()
+        merged = reference.merge(factor_returns, on=['date', 'factor'], how='outer', suffixes=('_ref', ''))
+        equal = merged.shape[0] == reference.shape[0] and \
+            np.allclose(merged.ret_ref, merged.ret) and np.allclose(merged.tstat_ref, merged.tstat)
+        print('{0:>8} {1:>14.2f} {2:>12.2f} {3:>8.1f} {4:>10}'.format(
+            n_symbols, t_reference, t_stacked, t_reference / t_stacked, str(equal)))
+
+
+def synthetic_covariance(n_symbols, n_industries=9, seed=0):
+    """ FactorCovariance with industry dummies and three styles, and alpha forecasts. """
+    rng = np.random.RandomState(seed)
+    factors = ['Industry {0}'.format(i) for i in range(n_industries)] + ['mcap', 'pb', 'mom']
+    k = len(factors)
+    exposures = np.zeros((n_symbols, k))
+    exposures[np.arange(n_symbols), rng.randint(0, n_industries, n_symbols)] = 1
+    exposures[:, n_industries:] = rng.normal(size=(n_symbols, 3))
+    returns = rng.normal(0, 0.01, (500, k))
+    cov = np.cov(returns.T)
+    specific = rng.lognormal(np.log(0.02 ** 2), 0.5, n_symbols)
+    alpha = rng.normal(0, 0.001, n_symbols)
+    symbols = ['S{0:05d}'.format(i) for i in range(n_symbols)]
+    return riskModel.FactorCovariance(symbols, factors, exposures, cov, specific), alpha
+
+
+def dense_solve(opt, alpha, cov, w0):
+    """ Optimizer.solve with the (n x n) covariance, the formulation the factor form avoids. """
+    w = cp.Variable(len(alpha))
+    risk = cp.quad_form(w, cp.psd_wrap(cov.dense()))
+    constraints = [cp.sum(w) == 1, w >= 0, w <= opt.max_weight, cp.norm1(w - w0) <= opt.turnover]
+    problem = cp.Problem(cp.Maximize(alpha @ w - opt.risk_aversion * risk), constraints)
+    problem.solve(solver=opt.solver)
+    return w.value
+
+
+def bench_optimizer(sizes):
+    """ Optimizer.solve (factor form) vs the dense covariance. The dense problem is skipped above 3000 symbols. """
+    print('\noptimizer')
+    print('{0:>8} {1:>12} {2:>12} {3:>8} {4:>10}'.format('symbols', 'dense (s)', 'factor (s)', 'speedup', 'equal'))
+    for n_symbols in sizes:
+        cov, alpha = synthetic_covariance(n_symbols)
+        opt = optimizer.Optimizer.__new__(optimizer.Optimizer)
+        opt.risk_aversion = 1.0
+        opt.max_weight = max(0.01, 2.0 / n_symbols)
+        opt.long_only = True
+        opt.turnover = 0.5
+        opt.solver = 'CLARABEL'
+        w0 = np.full(n_symbols, 1.0 / n_symbols)
+        t0 = datetime.now()
+        weights = opt.solve(alpha, cov, w0)
+        t_factor = (datetime.now() - t0).total_seconds()
+        objective = alpha.dot(weights) - opt.risk_aversion * cov.variance(weights)
+        if n_symbols <= 3000:
+            t0 = datetime.now()
+            dense = dense_solve(opt, alpha, cov, w0)
+            t_dense = (datetime.now() - t0).total_seconds()
+            equal = np.isclose(objective, alpha.dot(dense) - opt.risk_aversion * cov.variance(dense), rtol=1e-4)
+            print('{0:>8} {1:>12.2f} {2:>12.2f} {3:>8.1f} {4:>10}'.format(
+                n_symbols, t_dense, t_factor, t_dense / t_factor, str(equal)))
+        else:
+            print('{0:>8} {1:>12} {2:>12.2f} {3:>8} {4:>10}'.format(n_symbols, '-', t_factor, '-', '-'))
+
+
+# Stages of the suite, run one per process so that each has its own peak memory
+SUITE_STAGES = ['upload', 'upload_num', 'raw_factors_symbol', 'raw_factors_panel', 'cross_section_date',
+                'cross_section_batch']
+RESULTS_PATH = os.path.join('..', 'Benchmarks', 'results.jsonl')
+
+
+def suite_data(folder, n_symbols, n_years, n_filings):
+    """ Writes the synthetic inputs of the suite to folder: prices, fundamentals and raw factors (pickles)
+        and a quarterly SEC zip with about 400 num.txt rows per filing.
+    """
+    prices = synthetic_prices(n_symbols, n_years)
+    equity, shares = synthetic_fundamentals(prices)
+    prices.to_pickle(os.path.join(folder, 'prices.pkl'))
+    equity.to_pickle(os.path.join(folder, 'equity.pkl'))
+    shares.to_pickle(os.path.join(folder, 'shares.pkl'))
+    synthetic_factors(n_symbols, int(n_years * 250)).to_pickle(os.path.join(folder, 'factors.pkl'))
+    synthetic_sec_zip(os.path.join(folder, 'sec.zip'), 400 * n_filings, n_filings)
+
+
+def suite_worker(stage, folder):
+    """ Runs stage of the suite on the inputs of folder and prints its time, rows processed and memory as JSON.
+        Inputs are loaded (and uploaded to the local database) before the peak memory is reset.
+    """
+    db_path = os.path.join(folder, stage + '.db')
+    if stage == 'upload':
+        manager = LocalManagerSQL(db_path)
+        manager.upload_mode = 'copy'
+        manager.query('create table prices (symbol varchar(10) not null, date date not null, open real, '
+                      'close real, volume integer, adjclose real, divcash real, split real, primary key (symbol, date))')
+        data = pd.read_pickle(os.path.join(folder, 'prices.pkl'))
+
+        def run():
+            manager.upload_df('prices', data)
+            return data.shape[0]
+    elif stage == 'upload_num':
+        scraper = local_sec_scraper(db_path)
+        num_type = {'adsh': str, 'tag': str, 'version': str, 'ddate': str, 'qtrs': int, 'uom': str,
+                    'coreg': str, 'value': float}
+        with zipfile.ZipFile(os.path.join(folder, 'sec.zip')) as zip_file:
+            num_df = pd.read_csv(zip_file.open('num.txt'), sep='\t', dtype=num_type)
+
+        def run():
+            scraper.upload_num(num_df, '2019q1')
+            return num_df.shape[0]
+    elif stage.startswith('raw_factors'):
+        processor = local_processor(db_path, {'panel_chunk_size': 500})
+        prices = pd.read_pickle(os.path.join(folder, 'prices.pkl'))
+        processor.sql_manager.upload_df('prices', prices)
+        processor.sql_manager.create_index('prices', ['symbol'])
+        processor.elements = list(prices.symbol.unique())
+        processor.fundamentals = {
+            'equity': PointInTime(pd.read_pickle(os.path.join(folder, 'equity.pkl')), ['equity']),
+            'shares_basic': PointInTime(pd.read_pickle(os.path.join(folder, 'shares.pkl')), ['shares_basic'])}
+        n_rows = prices.shape[0]
+        del prices
+
+        def run():
+            if stage == 'raw_factors_panel':
+                for symbols in processor.get_panels():
+                    processor.compute_raw_factors_panel(symbols)
+            else:
+                for symbol in processor.elements:
+                    processor.compute_raw_factors(symbol)
+            return n_rows
+    else:
+        processor = local_processor(db_path)
+        factors = pd.read_pickle(os.path.join(folder, 'factors.pkl'))
+        processor.sql_manager.upload_df('reg_factors', factors)
+        processor.sql_manager.create_index('reg_factors', ['date'])
+        processor.dates = pd.DatetimeIndex(pd.to_datetime(factors.date.unique()))
+        n_rows = factors.shape[0]
+        del factors
+
+        def run():
+            if stage == 'cross_section_batch':
+                for dates in processor.get_date_blocks():
+                    processor.process_cross_section_batch(dates)
+            else:
+                for date in processor.dates:
+                    processor.process_cross_section(date)
+            return n_rows
+
+    reset_peak_rss()
+    base = peak_rss_mb()
+    t0 = datetime.now()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = run()
+    seconds = (datetime.now() - t0).total_seconds()
+    print(json.dumps({'seconds': seconds, 'rows': int(rows), 'base_mb': base, 'peak_mb': peak_rss_mb()}))
+
+
+def git_commit():
+    """ Commit of the working tree, with '+' if tracked files have changes. """
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE).stdout.decode().strip()
+    changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                             stdout=subprocess.PIPE).stdout.decode().strip()
+    return commit + ('+' if changes else '')
+
+
+def bench_suite(sizes):
+    """ Every stage of SUITE_STAGES on synthetic data of sizes = [symbols, years, SEC filings].
+        Results are appended to RESULTS_PATH with the commit, to be compared with bench_compare.
+    """
+    n_symbols, n_years, n_filings = (list(sizes) + [1000, 2, 2000][len(sizes):])[:3]
+    commit = git_commit()
+    print('\nsuite ({0} symbols, {1} years, {2} filings, commit {3})'.format(n_symbols, n_years, n_filings, commit))
+    print('{0:<22} {1:>12} {2:>12} {3:>12} {4:>12}'.format('stage', 'seconds', 'rows', 'rows/s', 'memory (MB)'))
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with tempfile.TemporaryDirectory() as folder:
+        suite_data(folder, n_symbols, n_years, n_filings)
+        for stage in SUITE_STAGES:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), 'suite_worker', stage, folder],
+                                    stdout=subprocess.PIPE, check=True).stdout
+            result = json.loads(output.decode().strip().split('\n')[-1])
+            record = {'date': str(datetime.now().replace(microsecond=0)), 'commit': commit, 'stage': stage,
+                      'n_symbols': n_symbols, 'n_years': n_years, 'n_filings': n_filings,
+                      'seconds': result['seconds'], 'rows': result['rows'],
+                      'memory_mb': result['peak_mb'] - result['base_mb'], 'peak_mb': result['peak_mb']}
+            with open(RESULTS_PATH, 'a') as results_file:
+                results_file.write(json.dumps(record) + '\n')
+            print('{0:<22} {1:>12.2f} {2:>12} {3:>12.0f} {4:>12.0f}'.format(
+                stage, record['seconds'], record['rows'], record['rows'] / max(record['seconds'], 1e-9),
+                record['memory_mb']))
+
+
+def bench_compare(sizes=None):
+    """ Last suite results of every stage and size against the results of the previous commit. """
+    df = pd.read_json(RESULTS_PATH, lines=True)
+    keys = ['stage', 'n_symbols', 'n_years', 'n_filings']
+    print('\ncompare')
+    print('{0:<22} {1:>16} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10}'.format(
+        'stage', 'size', 'old', 'new', 'old (s)', 'new (s)', 'ratio', 'MB ratio'))
+    for key, runs in df.groupby(keys, sort=False):
+        # Last run of every commit, in order
+        runs = runs.drop_duplicates('commit', keep='last')
+        if runs.shape[0] < 2:
+            continue
+        old, new = runs.iloc[-2], runs.iloc[-1]
+        print('{0:<22} {1:>16} {2:>10} {3:>10} {4:>10.2f} {5:>10.2f} {6:>10.2f} {7:>10.2f}'.format(
+            key[0], '{0}x{1}y{2}f'.format(*key[1:]), old.commit, new.commit, old.seconds, new.seconds,
+            new.seconds / old.seconds, new.memory_mb / max(old.memory_mb, 1e-9)))
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        'raw_factors': (bench_raw_factors, [1000, 5000, 8000]),
+        'factors': (bench_factors, [500, 2000, 8000]),
+        'cross_section': (bench_cross_section, [500, 1000, 3000]),
+        'medcouple': (bench_medcouple, [1000, 10000, 100000]),
+        'regression': (bench_regression, [1000, 3000, 8000]),
+        'optimizer': (bench_optimizer, [500, 2000, 8000]),
+        'upload': (bench_upload, [1000000, 3000000]),
+        'downloader': (bench_downloader, [500, 2000]),
+        'typed_load': (bench_typed_load, [1000000, 3000000]),
+        'query_cache': (bench_query_cache, [1000, 5000]),
+        'sec_ingest': (bench_sec_ingest, [1000000, 3000000]),
+        'upload_num': (bench_upload_num, [1000000, 3000000]),
+        'suite': (bench_suite, [1000, 2, 2000]),
+        'compare': (bench_compare, [])}
+    name = sys.argv[1] if len(sys.argv) > 1 else 'raw_factors'
+    if name == 'sec_ingest_worker':
+        sec_ingest_worker(*sys.argv[2:])
+    elif name == 'suite_worker':
+        suite_worker(*sys.argv[2:])
+    else:
+        fun, args = benchmarks[name]
+        fun([int(a) for a in sys.argv[2:]] or args)
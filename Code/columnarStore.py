@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ColumnarStore:
+    """ Local Parquet copy of database tables, one file per partition (symbol for prices, quarter for SEC data sets).
+        The manifest (SQLite, safe across processes) lists the partitions that are complete.
+        Partitions are read memory-mapped, so scanning a panel doesn't go through the database.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, 'manifest.sqlite')
+        self.lock = threading.Lock()
+        with self._manifest() as cnxn:
+            cnxn.execute('create table if not exists partitions '
+                         '(table_name text, column_name text, value text, rows integer, written text, '
+                         'primary key (table_name, value))')
+
+    @contextmanager
+    def _manifest(self):
+        cnxn = sqlite3.connect(self.manifest_path, timeout=60)
+        try:
+            with cnxn:
+                yield cnxn
+        finally:
+            cnxn.close()
+
+    def path(self, table, column, value):
+        return os.path.join(self.root, table, column + '=' + quote(str(value), safe=''), 'part.parquet')
+
+    def partitions(self, table):
+        """ Values of the complete partitions of table. """
+        with self._manifest() as cnxn:
+            rows = cnxn.execute('select value from partitions where table_name = ?', (table,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def write(self, table, column, df, values=None):
+        """ Saves the rows of df as complete partitions of table by column.
+            values lists every partition covered by df, including those without rows.
+        """
+        values = list(df[column].unique()) if values is None else list(values)
+        groups = {value: group for value, group in df.groupby(column)} if column in df.columns else {}
+        written = datetime.now().isoformat()
+        entries = []
+        for value in values:
+            path = self.path(table, column, value)
+            group = groups.get(value, df.iloc[:0]) if column in df.columns else df
+            if group.shape[0] > 0:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+                pq.write_table(pa.Table.from_pandas(group, preserve_index=False), tmp)
+                os.replace(tmp, path)
+            elif os.path.exists(path):
+                os.remove(path)
+            entries.append((table, column, str(value), group.shape[0], written))
+        with self.lock, self._manifest() as cnxn:
+            cnxn.executemany('insert or replace into partitions values (?, ?, ?, ?, ?)', entries)
+
+    def read(self, table, column, values, columns=None, filters=None):
+        """ Rows of the partitions values of table, as a single DataFrame. Empty partitions have no file.
+            filters: pyarrow row filters, e.g. [('date', '>=', date)].
+        """
+        paths = [self.path(table, column, value) for value in values]
+        tables = [pq.read_table(path, columns=columns, memory_map=True, filters=filters)
+                  for path in paths if os.path.exists(path)]
+        if len(tables) == 0:
+            return pd.DataFrame(columns=columns)
+        return pa.concat_tables(tables, promote=True).to_pandas()
+
+    def invalidate(self, table, values=None):
+        """ Removes partitions values of table from the manifest, or the whole table if values is None. """
+        with self.lock, self._manifest() as cnxn:
+            if values is None:
+                cnxn.execute('delete from partitions where table_name = ?', (table,))
+            else:
+                cnxn.executemany('delete from partitions where table_name = ? and value = ?',
+                                 [(table, str(value)) for value in values])
+
+    def tables(self):
+        """ Partition column of every table with partitions. """
+        with self._manifest() as cnxn:
+            rows = cnxn.execute('select distinct table_name, column_name from partitions').fetchall()
+        return {row[0]: row[1] for row in rows}
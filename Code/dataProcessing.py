@@ -2,12 +2,13 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from pandas.tseries.offsets import BDay
-from statsmodels.stats.stattools import medcouple
-from pandas.tseries.offsets import CustomBusinessDay
-from pandas.tseries.holiday import USFederalHolidayCalendar
-from utilities import compute, compute_loop
+from utilities import compute, compute_loop, range_key
 import managerSQL
+import instrumentation
+from pointInTime import PointInTime
+from factors import FactorEngine
+import robustStats
+from tradingCalendar import get_calendar
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -18,193 +19,260 @@ class DataProcessing:
         self.params = params['data_processing']
         self.sql_manager = managerSQL.ManagerSQL(params['db'])
         if self.params['compute_raw_factors']:
+            # Factors of the registry to compute, written as columns of reg_factors (wide) or as rows of
+            # reg_factors_long (long). Long factors are only stored: scaling reads reg_factors.
+            self.engine = FactorEngine(self.params.get('factors'))
+            self.factors_format = self.params.get('factors_format', 'wide')
+            self.factors_table = 'reg_factors_long' if self.factors_format == 'long' else 'reg_factors'
+            if self.factors_format == 'wide':
+                self._check_columns('reg_factors', self.engine.names, "or set factors_format to 'long'")
+            # Sessions of prices needed before a date to compute its factors
+            self.lookback = self.engine.lookback
             if self.params['clean_raw_factors']:
-                self.sql_manager.clean_table('reg_factors')
+                self.sql_manager.clean_table(self.factors_table)
+                self.sql_manager.clean_table('reg_factors_dirty')
+            self.incremental = self.params.get('incremental', False)
+            self.high_water = self.get_high_water() if self.incremental else {}
             self.elements = self.get_elements()
-            self.equity = self._get_equity()
-            self.shares = self._get_shares()
+            key = self.params.get('fundamentals_key', 'ddate')
+            self.fundamentals = {column: PointInTime(self._get_fundamental(column), [column], key)
+                                 for column in self.engine.fundamentals}
         if self.params['scale_factors']:
             if self.params['clean_scaled_factors']:
                 #self.sql_manager.clean_table('reg_factors')
                 pass
+            # Factors of reg_factors scaled to reg_factors_scaled, the styles of the regression
+            self.styles = self.params.get('styles', ['mcap', 'pb', 'mom'])
+            self._check_columns('reg_factors', ['ret'] + self.styles)
+            self._check_columns('reg_factors_scaled', ['ret'] + self.styles)
             self.start_date = self.params['start_date']
             self.end_date = self.params['end_date']
             self.dates = self.get_dates()
 
+    def _check_columns(self, table, names, hint=''):
+        """ Raises ValueError if table exists without a column for every name. """
+        columns = self.sql_manager.columns(table)
+        missing = [name for name in names if name not in columns]
+        if len(columns) > 0 and len(missing) > 0:
+            raise ValueError('Factors {0} are not columns of {1}: add them to the table {2}'.format(
+                ', '.join(missing), table, hint).strip())
+
     def get_elements(self):
         symbols_all = self.sql_manager.select_column_list('symbol', 'symbols')
-        symbols_fund = self.sql_manager.select_distinct_column_list('symbol', 'reg_factors')
+        if self.incremental:
+            # Symbols with prices after their high-water mark. Those without factors go first and the rest
+            # by high-water mark, so that symbols of a panel load similar windows of prices.
+            last_prices = self._last_dates('prices')
+            symbols_new = [s for s in symbols_all if s not in self.high_water]
+            symbols_old = [s for s in symbols_all if s in self.high_water
+                           and last_prices.get(s, self.high_water[s]) > self.high_water[s]]
+            return symbols_new + sorted(symbols_old, key=lambda s: self.high_water[s])
+        symbols_fund = self.sql_manager.select_distinct_column_list('symbol', self.factors_table)
         symbols = [s for s in symbols_all if s not in symbols_fund]
         return symbols
 
+    def get_high_water(self):
+        """ Last date with raw factors of every symbol.
+            Factors after the dates flagged in reg_factors_dirty (new SEC figures) are deleted first, so they are
+            computed again. Both deletes run in a single statement, flags added meanwhile are kept for the next run.
+        """
+        self.sql_manager.query(
+            """
+            with dirty as (delete from reg_factors_dirty returning symbol, date)
+            delete from {0} a
+            using (select symbol, min(date) date from dirty group by symbol) b
+            where a.symbol = b.symbol and a.date > b.date
+            """.format(self.factors_table))
+        return self._last_dates(self.factors_table)
+
+    def _last_dates(self, table):
+        df = self.sql_manager.select_query('select symbol, max(date) date from ' + table + ' group by symbol')
+        return dict(zip(df.symbol, pd.to_datetime(df.date)))
+
+    def _prices_filter(self, symbols):
+        """ Filter of the prices needed to extend the factors of symbols after their high-water marks.
+            None (all prices) if one of them has no factors yet.
+        """
+        if not self.incremental or any(s not in self.high_water for s in symbols):
+            return None
+        start = get_calendar().offset(min(self.high_water[s] for s in symbols), -self.lookback)
+        return 'date', '>=', start.date()
+
+    def _after_high_water(self, df):
+        """ Rows of df after the high-water mark of their symbol. Earlier rows were only loaded as lookback. """
+        if not self.incremental:
+            return df
+        marks = pd.to_datetime(df.symbol.astype(object).map(self.high_water))
+        return df[marks.isna() | (pd.to_datetime(df.date) > marks)]
+
     def get_dates(self):
-        cal = CustomBusinessDay(calendar=USFederalHolidayCalendar())
-        return pd.DatetimeIndex(start=self.start_date, end=self.end_date, freq=cal)
+        return get_calendar().between(self.start_date, self.end_date)
+
+    def get_date_blocks(self):
+        """ self.dates split by year. Each block is loaded and uploaded at once by process_cross_section_batch. """
+        return [list(block) for _, block in pd.Series(self.dates).groupby(self.dates.year)]
+
+    def get_panels(self):
+        """ Splits self.elements in chunks of symbols to be processed as a single panel. """
+        size = self.params.get('panel_chunk_size', 500)
+        return [self.elements[i:i + size] for i in range(0, len(self.elements), size)]
 
     def process(self):
         """ Main execution of DataProcessing class. """
         # Compute daily returns and factor exposures
         if self.params['compute_raw_factors']:
-            compute(self.elements, self.compute_raw_factors)
+            execution = self.params.get('execution', {}).get('raw_factors', {})
+            if self.params.get('raw_factors_mode', 'symbol') == 'panel':
+                compute(self.get_panels(), self.compute_raw_factors_panel, key=range_key, **execution)
+            else:
+                compute(self.elements, self.compute_raw_factors, **execution)
 
         # Scale factors
         if self.params['scale_factors']:
-            compute(self.dates, self.process_cross_section)
-
+            if self.params.get('cross_section_mode', 'date') == 'batch':
+                execution = self.params.get('execution', {}).get('cross_section_batch', {})
+                compute(self.get_date_blocks(), self.process_cross_section_batch, key=range_key, **execution)
+            else:
+                execution = self.params.get('execution', {}).get('cross_section', {})
+                compute(self.dates, self.process_cross_section, **execution)
+
+    @instrumentation.measured('compute_raw_factors')
     def compute_raw_factors(self, symbol):
-        """ Compute price to book value of symbol and upload to database. """
+        """ Compute the factors of symbol and upload them to database. """
+        self._compute_factors([symbol], symbol)
+
+    @instrumentation.measured('compute_raw_factors')
+    def compute_raw_factors_panel(self, symbols):
+        """ compute_raw_factors of a block of symbols at once. Prices of all symbols are loaded with one query and
+            factors are computed on (date x symbol) matrices.
+        """
+        label = '{0}..{1}'.format(symbols[0], symbols[-1]) if len(symbols) > 0 else ''
+        self._compute_factors(symbols, label)
+
+    def _compute_factors(self, symbols, label):
         t0 = datetime.now()
 
         try:
-            df_prices = self.sql_manager.select_query("select * from prices where symbol = '" + symbol + "'")
+            columns = ['symbol', 'date'] + self.engine.prices
+            where = self._prices_filter(symbols)
+            df_prices = self.sql_manager.select_partitions('prices', 'symbol', symbols, columns, where, typed=True)
 
+            instrumentation.count('rows', df_prices.shape[0])
             if df_prices.shape[0] > 0:
+                # Fundamentals known at every date
+                for point_in_time in self.fundamentals.values():
+                    df_prices = point_in_time.join(df_prices)
 
-                # Returns
-                df_prices_1d = df_prices.copy()
-                cols = ['date', 'adjclose']
-                df_prices_1d = df_prices_1d[cols]
-                df_prices_1d['date'] = (df_prices_1d.date + BDay(1)).dt.date
-                s1d = ('', '_1d')
-                df_prices = df_prices.merge(df_prices_1d, left_on='date', right_on='date', how='left', suffixes=s1d)
-                df_prices['ret'] = np.log(df_prices.adjclose) - np.log(df_prices.adjclose_1d)
-                df_prices.drop(columns=['adjclose_1d'], inplace=True)
-                col_remains = ['symbol', 'date', 'ret']
-
-                # Equity
-                df_equity = self.equity[self.equity.symbol == symbol].sort_values('ddate', ascending=False)
-                df_prices['equity'] = np.nan
-                for row in df_equity.index:
-                    ddate = df_equity.ddate[row]
-                    equity = df_equity.equity[row]
-                    df_prices.loc[(df_prices.date > ddate) & pd.isna(df_prices.equity), 'equity'] = equity
-                col_remains.append('equity')
-
-                # Shares
-                df_shares = self.shares[self.shares.symbol == symbol].sort_values('ddate', ascending=False)
-                df_prices['shares'] = np.nan
-                for row in df_shares.index:
-                    ddate = df_shares.ddate[row]
-                    shares = df_shares.shares_basic[row]
-                    df_prices.loc[(df_prices.date > ddate) & pd.isna(df_prices.shares), 'shares'] = shares
-
-                # Market Price
-                # Adjust by dividends paid since last equity published...
-                df_prices['mcap'] = df_prices['close'].multiply(df_prices['shares'])
-                col_remains.append('mcap')
-
-                # Price to Book Value
-                df_prices['pb'] = df_prices['mcap'].divide(df_prices['equity'])
-                col_remains.append('pb')
-
-                # Momentum
-                df_prices_12m = df_prices.copy()
-                df_prices_1m = df_prices.copy()
-                cols = ['date', 'adjclose']
-                df_prices_12m = df_prices_12m[cols]
-                df_prices_1m = df_prices_1m[cols]
-                df_prices_12m['date'] = (df_prices_12m.date + BDay(260)).dt.date
-                df_prices_1m['date'] = (df_prices_1m.date + BDay(20)).dt.date
-                s12m = ('', '_12m')
-                s1m = ('', '_1m')
-                df_prices = df_prices.merge(df_prices_12m, left_on='date', right_on='date', how='left', suffixes=s12m)
-                df_prices = df_prices.merge(df_prices_1m, left_on='date', right_on='date', how='left', suffixes=s1m)
-                df_prices['mom'] = np.log(df_prices.adjclose_1m) - np.log(df_prices.adjclose_12m)
-                df_prices['mom'] = df_prices.mom.fillna(method='ffill', limit=5)
-                df_prices.drop(columns=['adjclose_12m', 'adjclose_1m'], inplace=True)
-                col_remains.append('mom')
+                # Factors
+                df = self.engine.compute(df_prices)
 
                 # Clean
-                df_prices = df_prices[col_remains]
-                df_prices.dropna(inplace=True)
-
-                if df_prices.shape[0] > 0:
+                if self.factors_format == 'long':
+                    df = self.engine.to_long(df)
+                else:
+                    df = df.dropna()
+                df = self._after_high_water(df)
+                df['date'] = df.date.dt.date
+
+                if df.shape[0] > 0:
                     # Upload data to db
-                    self.sql_manager.upload_df('reg_factors', df_prices)
+                    self.sql_manager.upload_df(self.factors_table, df)
 
             t1 = datetime.now()
-            print('Processing successful for {0} ({1:.2f} sec)'.format(symbol, (t1 - t0).total_seconds()))
+            instrumentation.log('Processing successful for {0} ({1:.2f} sec)'.format(
+                label, (t1 - t0).total_seconds()))
 
-        except Exception as e:
+        except Exception:
             t1 = datetime.now()
-            print('Processing failed for {0} ({1:.2f} sec)'.format(symbol, (t1 - t0).total_seconds()))
-            print(e)
+            instrumentation.log('Processing failed for {0} ({1:.2f} sec)'.format(
+                label, (t1 - t0).total_seconds()))
+            raise
 
-    def _get_equity(self):
+    def _get_fundamental(self, column):
+        """ column of the first filing of every symbol and ddate, from sec_fundamentals_pit. """
         query = \
             """
-            select 
-                symbol, cast(ddate as date) ddate, cast(filed as date) filed, equity 
-                from 
-                ( 
-                    select 
-                        symbol, ddate, filed, equity, 
-                        row_number() over(partition by symbol, ddate order by filed) rnk 
-                        from sec_sub a 
-                        inner join sec_cik_symbol b 
-                        on a.cik = b.cik 
-                        left join sec_num_bal c 
-                        on a.adsh = c.adsh and c.uom = 'USD' 
-                        where not equity is null 
-                ) a 
-            where rnk = 1 
-            order by symbol, ddate 
-            """
+            select distinct on (symbol, ddate)
+                symbol, ddate, filed, {0}
+                from sec_fundamentals_pit
+                where not {0} is null
+            order by symbol, ddate, filed
+            """.format(column)
         df = self.sql_manager.select_query(query)
         return df
 
-    def _get_shares(self):
-        query = \
-            """
-            select 
-                symbol, cast(ddate as date) ddate, cast(filed as date) filed, shares_basic 
-                from 
-                ( 
-                    select 
-                        symbol, ddate, filed, shares_basic, 
-                        row_number() over(partition by symbol, ddate order by filed) rnk 
-                        from sec_sub a 
-                        inner join sec_cik_symbol b 
-                        on a.cik = b.cik 
-                        left join sec_num_shr c 
-                        on a.adsh = c.adsh 
-                        where not shares_basic is null and shares_basic <> 0 
-                ) a 
-            where rnk = 1 
-            order by symbol, ddate 
-            """
-        df = self.sql_manager.select_query(query)
-        return df
+    def _scaled_columns(self):
+        """ Columns of reg_factors read by the cross sections. """
+        return ', '.join(['symbol', 'date', 'ret'] + [style for style in self.styles if style != 'ret'])
 
+    @instrumentation.measured('process_cross_section')
     def process_cross_section(self, date):
         t0 = datetime.now()
         date_str = str(date.date())
 
         try:
-            query = "select * from reg_factors where date = '" + date_str + "'"
+            query = "select {0} from reg_factors where date = '{1}'".format(self._scaled_columns(), date_str)
             df = self.sql_manager.select_query(query)
+            instrumentation.count('rows', df.shape[0])
 
             if df.shape[0] > 0:
-                if 'equity' in df.columns:
-                    df.drop(columns=['equity'], inplace=True)
+                # Outliers
+                df['weight'] = 1
+                df = self.remove_outliers(df, a=3, n_sample=self.params.get('medcouple_sample'))
+
+                # Scaling
+                df = self.scale_factors(df, cols=self.styles)
+
+                # Upload data to db
+                self.sql_manager.upload_df('reg_factors_scaled', df)
+
+            t1 = datetime.now()
+            instrumentation.log('Processing successful for {0} ({1:.2f} sec)'.format(
+                date_str, (t1 - t0).total_seconds()))
+
+        except Exception:
+            t1 = datetime.now()
+            instrumentation.log('Processing failed for {0} ({1:.2f} sec)'.format(
+                date_str, (t1 - t0).total_seconds()))
+            raise
+
+    @instrumentation.measured('process_cross_section')
+    def process_cross_section_batch(self, dates):
+        """ Batched process_cross_section. Factors of all dates are loaded with a single query,
+            outliers and scaling are computed grouping by date, and the result is uploaded at once.
+        """
+        t0 = datetime.now()
+        label = '{0}..{1}'.format(dates[0].date(), dates[-1].date()) if len(dates) > 0 else ''
+
+        try:
+            query = "select {0} from reg_factors where date >= '{1}' and date <= '{2}'".format(
+                self._scaled_columns(), dates[0].date(), dates[-1].date())
+            df = self.sql_manager.select_query(query)
+            df = df[pd.to_datetime(df.date).isin(dates)]
+            instrumentation.count('rows', df.shape[0])
+
+            if df.shape[0] > 0:
+                df = df.sort_values(['date', 'symbol']).reset_index(drop=True)
 
                 # Outliers
                 df['weight'] = 1
-                df = self.remove_outliers(df, a=3)
+                df = self.remove_outliers_batch(df, a=3, n_sample=self.params.get('medcouple_sample'))
 
                 # Scaling
-                df = self.scale_factors(df, cols=['mcap', 'pb', 'mom'])
+                df = self.scale_factors_batch(df, cols=self.styles)
 
                 # Upload data to db
                 self.sql_manager.upload_df('reg_factors_scaled', df)
 
             t1 = datetime.now()
-            print('Processing successful for {0} ({1:.2f} sec)'.format(date_str, (t1 - t0).total_seconds()))
+            instrumentation.log('Processing successful for {0} ({1:.2f} sec)'.format(
+                label, (t1 - t0).total_seconds()))
 
-        except Exception as e:
+        except Exception:
             t1 = datetime.now()
-            print('Processing failed for {0} ({1:.2f} sec)'.format(date_str, (t1 - t0).total_seconds()))
-            print(e)
+            instrumentation.log('Processing failed for {0} ({1:.2f} sec)'.format(
+                label, (t1 - t0).total_seconds()))
+            raise
 
     def scale_factors(self, df, cols):
         w = df.weight / df.weight.sum()
@@ -214,19 +282,32 @@ class DataProcessing:
         df[cols] = delta.div(std, axis=1)
         return df
 
-    def remove_outliers(self, df, a=1.5, n_sample=10000):
-        """ Based on https://wis.kuleuven.be/stat/robust/papers/2008/outlierdetectionskeweddata-revision.pdf"""
-        mc = medcouple(df.ret)
+    def remove_outliers(self, df, a=1.5, n_sample=None):
+        """ Based on https://wis.kuleuven.be/stat/robust/papers/2008/outlierdetectionskeweddata-revision.pdf
+            The medcouple is exact, or computed on n_sample order statistics of the returns when there are more.
+        """
+        mc = robustStats.medcouple(robustStats.subsample(df.ret, n_sample))
         percentiles = np.percentile(df.ret, [25, 75])
-        q1 = percentiles[0]
-        q3 = percentiles[1]
-        iqr = q3 - q1
-        if mc > 0:
-            lo = q1 - a * np.exp(-4 * mc) * iqr
-            up = q3 + a * np.exp(3 * mc) * iqr
-        else:
-            lo = q1 - a * np.exp(-3 * mc) * iqr
-            up = q3 + a * np.exp(4 * mc) * iqr
+        lo, up = robustStats.adjusted_fences(percentiles[0], percentiles[1], mc, a)
         df.loc[df.ret < lo, 'weight'] = 0
         df.loc[df.ret > up, 'weight'] = 0
         return df
+
+    def scale_factors_batch(self, df, cols):
+        """ scale_factors of every date of df. """
+        by_date = df.date
+        w = df.weight / df.weight.groupby(by_date).transform('sum')
+        mu = df[cols].mul(w, axis=0).groupby(by_date).transform('sum')
+        delta = df[cols] - mu
+        std = delta.mul(delta, axis=0).mul(w, axis=0).groupby(by_date).transform('sum').apply(np.sqrt)
+        df[cols] = delta.div(std)
+        return df
+
+    def remove_outliers_batch(self, df, a=1.5, n_sample=None):
+        """ remove_outliers of every date of df. """
+        codes, _ = pd.factorize(df.date)
+        mc = robustStats.grouped_medcouple(df.ret, codes, n_sample)
+        percentiles = robustStats.grouped_quantiles(df.ret, codes, [0.25, 0.75])
+        lo, up = robustStats.adjusted_fences(percentiles[:, 0], percentiles[:, 1], mc, a)
+        df.loc[(df.ret.values < lo[codes]) | (df.ret.values > up[codes]), 'weight'] = 0
+        return df
@@ -0,0 +1,150 @@
+import time
+import random
+import json
+import asyncio
+from concurrent import futures
+import aiohttp
+from utilities import ComputeSummary, SerialExecutor
+import instrumentation
+
+
+class LimitReached(Exception):
+    """ The vendor keeps refusing requests after all retries (quota exhausted). """
+    pass
+
+
+class TokenBucket:
+    """ Allows rate requests per second on average, with bursts of up to capacity requests. """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncDownloader:
+    """ Downloads JSON documents with a single keep-alive HTTP session.
+        concurrency: maximum number of requests in flight.
+        rate, burst: token bucket matching the vendor quota (requests per second). No limit if rate is None.
+        retries, backoff: 429 and 5xx responses are retried after backoff * 2^attempt seconds (or Retry-After).
+        queue_size: downloaded data waiting to be written. Downloads pause when the writer falls behind.
+    """
+    def __init__(self, concurrency=8, rate=None, burst=None, retries=5, backoff=1.0, queue_size=64, timeout=60):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.limit_reached = False
+        # Requests sent, 429 and 5xx responses, and retries after them
+        self.stats = {'requests': 0, 'throttled': 0, 'server_errors': 0, 'retries': 0}
+
+    def run(self, elements, request, parse, write):
+        """ Downloads every element and writes it.
+            request(element) returns the url to download, or None to skip the element.
+            parse(element, payload) returns the data to write, or None if there is nothing to write.
+            write(element, data) is blocking (database upload). It runs in a single writer thread.
+        """
+        return asyncio.run(self._run(elements, request, parse, write))
+
+    async def _run(self, elements, request, parse, write):
+        summary = ComputeSummary()
+        t0 = time.monotonic()
+        pending = iter(elements)
+        queue = asyncio.Queue(self.queue_size)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        # Writes of profiled stages block the event loop, in the thread the profile sees
+        writer_thread = SerialExecutor() if instrumentation.serial() else futures.ThreadPoolExecutor(max_workers=1)
+        with writer_thread:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                writer = asyncio.ensure_future(self._write(queue, write, writer_thread, summary))
+                workers = [self._download(session, pending, request, parse, queue, summary)
+                           for _ in range(self.concurrency)]
+                await asyncio.gather(*workers)
+                await queue.put(None)
+                await writer
+        summary.seconds = time.monotonic() - t0
+        print(summary)
+        return summary
+
+    async def _download(self, session, pending, request, parse, queue, summary):
+        for element in pending:
+            if self.limit_reached:
+                break
+            try:
+                url = request(element)
+                if url is None:
+                    continue
+                payload = await self.fetch(session, url)
+                data = parse(element, payload)
+                if data is not None:
+                    await queue.put((element, data))
+                else:
+                    summary.add([(element, None, None)])
+            except LimitReached as e:
+                self.limit_reached = True
+                summary.add([(element, None, 'LimitReached: {0}'.format(e))])
+            except Exception as e:
+                print('Download failed for {}'.format(element[0] if isinstance(element, list) else element))
+                summary.add([(element, None, '{0}: {1}'.format(type(e).__name__, e))])
+
+    async def _write(self, queue, write, writer_thread, summary):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            element, data = item
+            try:
+                result = await loop.run_in_executor(writer_thread, write, element, data)
+                summary.add([(element, result, None)])
+            except Exception as e:
+                summary.add([(element, None, '{0}: {1}'.format(type(e).__name__, e))])
+
+    async def fetch(self, session, url):
+        """ GET url and decode its JSON body, retrying on 429 and 5xx responses. """
+        status = None
+        for attempt in range(self.retries + 1):
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            # Whole request (connection, time to first byte and body). Coroutines share the thread, so requests
+            # are only counted in the totals
+            with instrumentation.timer('network'):
+                async with session.get(url) as response:
+                    status = response.status
+                    self.stats['requests'] += 1
+                    if status == 402:
+                        raise LimitReached('HTTP 402, payment required')
+                    if status != 429 and status < 500:
+                        response.raise_for_status()
+                        body = await response.read()
+                        instrumentation.count('bytes', len(body))
+                        return json.loads(body)
+                    self.stats['throttled' if status == 429 else 'server_errors'] += 1
+                    retry_after = response.headers.get('Retry-After')
+            if attempt < self.retries:
+                self.stats['retries'] += 1
+                if retry_after is not None and retry_after.isdigit():
+                    delay = float(retry_after)
+                else:
+                    delay = self.backoff * 2 ** attempt * (1 + random.random())
+                await asyncio.sleep(delay)
+        if status == 429:
+            raise LimitReached('HTTP 429 after {0} retries'.format(self.retries))
+        raise aiohttp.ClientError('HTTP {0} after {1} retries'.format(status, self.retries))
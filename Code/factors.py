@@ -0,0 +1,284 @@
+import numpy as np
+import pandas as pd
+from tradingCalendar import get_calendar
+
+# Lags in sessions of the trading calendar
+MONTH = 21
+QUARTER = 63
+HALF_YEAR = 126
+YEAR = 252
+
+# Inputs read from the prices table and from sec_fundamentals_pit (attached point in time)
+PRICE_INPUTS = ['open', 'close', 'volume', 'adjclose']
+FUNDAMENTAL_INPUTS = ['equity', 'shares_basic']
+
+# Factors of the original reg_factors table
+DEFAULT_FACTORS = ['ret', 'equity', 'mcap', 'pb', 'mom']
+
+
+class Factor:
+    """ Factor (or intermediate) of the registry. compute(panel) returns a (session x symbol) matrix from the
+        matrices of its inputs, read as panel[name].
+        lookback: sessions of history before a date the computation needs, on top of the lookback of its inputs.
+        fill: forward fill of missing values over the rows of each symbol, up to fill rows.
+    """
+    def __init__(self, name, inputs, compute, lookback=0, fill=None):
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        self.lookback = lookback
+        self.fill = fill
+
+
+FACTORS = {}
+
+
+def factor(name, inputs, lookback=0, fill=None):
+    """ Decorator registering compute(panel) as factor name. """
+    def decorator(compute):
+        FACTORS[name] = Factor(name, inputs, compute, lookback, fill)
+        return compute
+    return decorator
+
+
+def lookback(name):
+    """ Sessions of prices needed before a date to compute factor name, through all its inputs. """
+    if name in PRICE_INPUTS or name in FUNDAMENTAL_INPUTS:
+        return 0
+    if name not in FACTORS:
+        raise ValueError('Unknown factor ' + str(name))
+    f = FACTORS[name]
+    return f.lookback + (f.fill or 0) + max([lookback(input_name) for input_name in f.inputs] + [0])
+
+
+def inputs(name):
+    """ Price and fundamental inputs factor name is computed from, through all its inputs. """
+    if name in PRICE_INPUTS or name in FUNDAMENTAL_INPUTS:
+        return {name}
+    if name not in FACTORS:
+        raise ValueError('Unknown factor ' + str(name))
+    return set().union(*[inputs(input_name) for input_name in FACTORS[name].inputs])
+
+
+def lag(matrix, n):
+    """ matrix shifted n sessions down: row t holds row t - n. """
+    lagged = np.full(matrix.shape, np.nan)
+    if n < matrix.shape[0]:
+        lagged[n:] = matrix[:matrix.shape[0] - n]
+    return lagged
+
+
+def window_sum(matrix, window):
+    """ Sum of every column over the last window sessions (fewer at the start). """
+    cumulative = np.cumsum(matrix, axis=0)
+    total = cumulative.copy()
+    total[window:] -= cumulative[:-window]
+    return total
+
+
+def rolling(matrix, window, stat, min_periods=None):
+    """ Rolling 'mean', 'std' or 'max' of every column over window sessions, skipping missing values.
+        NaN where there are fewer than min_periods values (window by default).
+        All columns at once, with cumulative sums instead of a pass per column.
+    """
+    valid = ~np.isnan(matrix)
+    count = window_sum(valid.astype(float), window)
+    if stat == 'max':
+        output = matrix.copy()
+        for n in range(1, window):
+            output = np.fmax(output, lag(matrix, n))
+    else:
+        values = np.where(valid, matrix, 0.0)
+        total = window_sum(values, window)
+        output = total / count
+        if stat == 'std':
+            squares = window_sum(values * values, window)
+            output = np.sqrt(np.maximum(squares - total * output, 0.0) / (count - 1))
+        elif stat != 'mean':
+            raise ValueError('Unknown statistic ' + str(stat))
+    return np.where(count >= (min_periods or window), output, np.nan)
+
+
+def fill_rows(values, symbols, limit):
+    """ Forward fill of values over consecutive rows of the same symbol (rows sorted by symbol), filling up to
+        limit missing values after the last one present, as groupby(symbol).fillna(method='ffill', limit=limit).
+    """
+    positions = np.arange(len(values))
+    starts = np.r_[True, symbols[1:] != symbols[:-1]] if len(values) > 0 else np.zeros(0, dtype=bool)
+    first = np.maximum.accumulate(np.where(starts, positions, 0))
+    last = np.maximum.accumulate(np.where(np.isnan(values), -1, positions))
+    filled = (last >= first) & (positions - last <= limit)
+    return np.where(filled, values[np.maximum(last, 0)], np.nan)
+
+
+class Panel:
+    """ Inputs of a block of symbols as (session x symbol) matrices on the sessions of the trading calendar,
+        so that lags of n sessions are row shifts of n. Factors and intermediates are computed the first time
+        they are read and shared by every factor that reads them.
+    """
+    def __init__(self, sessions, symbols, values):
+        self.sessions = sessions
+        self.symbols = symbols
+        self.values = dict(values)
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            if name not in FACTORS:
+                raise ValueError('Unknown factor ' + str(name))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.values[name] = FACTORS[name].compute(self)
+        return self.values[name]
+
+
+class FactorEngine:
+    """ Computes the factors names of blocks of symbols from their prices and fundamentals.
+        Only the inputs the factors need are loaded, and intermediates (log prices, returns, market
+        capitalization) are computed once per block.
+    """
+    def __init__(self, names=None):
+        self.names = list(names or DEFAULT_FACTORS)
+        needed = set().union(*[inputs(name) for name in self.names])
+        self.prices = [column for column in PRICE_INPUTS if column in needed]
+        self.fundamentals = [column for column in FUNDAMENTAL_INPUTS if column in needed]
+        self.lookback = max(lookback(name) for name in self.names)
+
+    def panel(self, df):
+        """ Panel of the rows of df (symbol, date, price inputs and fundamental inputs). Returns the panel and
+            the session and symbol of every row (-1 for dates that are not sessions).
+        """
+        dates = pd.to_datetime(df.date)
+        symbols = pd.Index(pd.unique(np.asarray(df.symbol, dtype=object)))
+        sessions = get_calendar().between(dates.min(), dates.max())
+        rows = sessions.get_indexer(dates)
+        cols = symbols.get_indexer(np.asarray(df.symbol, dtype=object))
+        valid = rows >= 0
+        values = {}
+        for column in self.prices + self.fundamentals:
+            matrix = np.full((len(sessions), len(symbols)), np.nan)
+            matrix[rows[valid], cols[valid]] = df[column].values[valid]
+            values[column] = matrix
+        return Panel(sessions, symbols, values), rows, cols
+
+    def compute(self, df):
+        """ Factors of the rows of df, sorted by symbol and date, as a wide frame (symbol, date, names).
+            Rows on dates that are not sessions have no factors.
+        """
+        df = df.sort_values(['symbol', 'date']).reset_index(drop=True)
+        panel, rows, cols = self.panel(df)
+        invalid = rows < 0
+        # Position of every row in the flattened matrices
+        cells = np.maximum(rows, 0) * len(panel.symbols) + cols
+        symbols = np.asarray(df.symbol, dtype=object)
+        output = df[['symbol', 'date']].copy()
+        for name in self.names:
+            values = np.take(panel[name], cells)
+            values[invalid] = np.nan
+            fill = FACTORS[name].fill if name in FACTORS else None
+            output[name] = values if fill is None else fill_rows(values, symbols, fill)
+        return output
+
+    def to_long(self, df):
+        """ Wide factors of compute as long rows (symbol, date, factor, value), without missing values. """
+        df = df.melt(id_vars=['symbol', 'date'], value_vars=self.names, var_name='factor', value_name='value')
+        return df.dropna(subset=['value']).reset_index(drop=True)
+
+
+# Returns and momentum
+
+@factor('log_price', ['adjclose'])
+def log_price(panel):
+    return np.log(panel['adjclose'])
+
+
+@factor('ret', ['log_price'], lookback=1)
+def ret(panel):
+    """ Daily log return. """
+    return panel['log_price'] - lag(panel['log_price'], 1)
+
+
+@factor('mom', ['log_price'], lookback=YEAR, fill=5)
+def mom(panel):
+    """ Return from 12 months to 1 month ago. """
+    return lag(panel['log_price'], MONTH) - lag(panel['log_price'], YEAR)
+
+
+@factor('mom_6m', ['log_price'], lookback=HALF_YEAR, fill=5)
+def mom_6m(panel):
+    """ Return from 6 months to 1 month ago. """
+    return lag(panel['log_price'], MONTH) - lag(panel['log_price'], HALF_YEAR)
+
+
+@factor('reversal', ['log_price'], lookback=MONTH)
+def reversal(panel):
+    """ Return of the last month (short term reversal). """
+    return panel['log_price'] - lag(panel['log_price'], MONTH)
+
+
+# Risk
+
+@factor('volatility', ['ret'], lookback=QUARTER)
+def volatility(panel):
+    """ Standard deviation of daily returns over 3 months, with at least 2 months of returns. """
+    return rolling(panel['ret'], QUARTER, 'std', 2 * MONTH)
+
+
+@factor('volatility_1y', ['ret'], lookback=YEAR)
+def volatility_1y(panel):
+    return rolling(panel['ret'], YEAR, 'std', 8 * MONTH)
+
+
+@factor('max_ret', ['ret'], lookback=MONTH)
+def max_ret(panel):
+    """ Largest daily return of the last month. """
+    return rolling(panel['ret'], MONTH, 'max', MONTH // 2)
+
+
+# Size and value
+
+@factor('mcap', ['close', 'shares_basic'])
+def mcap(panel):
+    return panel['close'] * panel['shares_basic']
+
+
+@factor('size', ['mcap'])
+def size(panel):
+    return np.log(panel['mcap'])
+
+
+@factor('pb', ['mcap', 'equity'])
+def pb(panel):
+    """ Price to book value. """
+    return panel['mcap'] / panel['equity']
+
+
+@factor('bm', ['mcap', 'equity'])
+def bm(panel):
+    """ Book to market value, defined for negative equity unlike log(pb). """
+    return panel['equity'] / panel['mcap']
+
+
+# Liquidity
+
+@factor('dollar_volume', ['close', 'volume'])
+def dollar_volume(panel):
+    return panel['close'] * panel['volume']
+
+
+@factor('liquidity', ['dollar_volume'], lookback=MONTH)
+def liquidity(panel):
+    """ Log of the mean dollar volume of the last month. """
+    return np.log(rolling(panel['dollar_volume'], MONTH, 'mean', MONTH // 2))
+
+
+@factor('turnover', ['volume', 'shares_basic'], lookback=MONTH)
+def turnover(panel):
+    """ Mean volume of the last month over basic shares. """
+    return rolling(panel['volume'], MONTH, 'mean', MONTH // 2) / panel['shares_basic']
+
+
+@factor('illiquidity', ['ret', 'dollar_volume'], lookback=MONTH)
+def illiquidity(panel):
+    """ Amihud illiquidity: mean absolute return per million dollars traded over the last month. """
+    impact = np.abs(panel['ret']) / (panel['dollar_volume'] / 1e6)
+    impact[~np.isfinite(impact)] = np.nan
+    return rolling(impact, MONTH, 'mean', MONTH // 2)
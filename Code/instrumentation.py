@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import threading
+import json
+import functools
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+# Categories of the time of a unit. Compute is the rest of it.
+CATEGORIES = ['network', 'sql_read', 'sql_write']
+
+_lock = threading.Lock()
+_local = threading.local()
+# label: list of (seconds, network, sql_read, sql_write, rows, bytes) of every unit, and first start / last end
+_units = {}
+_spans = {}
+# category or counter: [calls, seconds, amount] of everything, inside units or not
+_totals = {}
+_config = {}
+# Stages running inside profile
+_stages = set()
+
+
+def configure(config):
+    """ Options of the instrumentation block of the config: profile (stages to run with cProfile),
+        tracemalloc (stages to trace memory allocations of), profile_path (where .prof files are written)
+        and summary_path (JSON file with the summary of report).
+    """
+    _config.clear()
+    _config.update(config)
+
+
+def log(message):
+    """ Prints message in a single write, so that lines of concurrent threads don't interleave. """
+    with _lock:
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+
+def _open_units():
+    if not hasattr(_local, 'units'):
+        _local.units = []
+    return _local.units
+
+
+@contextmanager
+def unit(label, name=None):
+    """ Measures a unit of work (a symbol, a quarter, a date) of label, e.g. 'compute_raw_factors'.
+        Timers and counters inside it, in the same thread, are added to it. Units can be nested.
+    """
+    record = {'label': label, 'name': name, 'rows': 0, 'bytes': 0}
+    record.update({category: 0.0 for category in CATEGORIES})
+    units = _open_units()
+    units.append(record)
+    t0 = time.time()
+    try:
+        yield record
+    finally:
+        t1 = time.time()
+        units.pop()
+        values = (t1 - t0, record['network'], record['sql_read'], record['sql_write'], record['rows'],
+                  record['bytes'])
+        with _lock:
+            _units.setdefault(label, []).append(values)
+            start, end = _spans.get(label, (t0, t1))
+            _spans[label] = (min(start, t0), max(end, t1))
+
+
+@contextmanager
+def timer(category, rows=0):
+    """ Time spent in category ('network', 'sql_read', 'sql_write'), added to the open units of the thread.
+        Yields a dict whose rows (rows read or written) can be set inside the block.
+    """
+    calls = {'rows': rows}
+    t0 = time.perf_counter()
+    try:
+        yield calls
+    finally:
+        seconds = time.perf_counter() - t0
+        for record in _open_units():
+            record[category] += seconds
+        _add(category, seconds, calls['rows'])
+
+
+def measured(label):
+    """ Decorator measuring every call of a method as a unit of label, named after its first argument. """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(self, arg, *args, **kwargs):
+            with unit(label, arg):
+                return fun(self, arg, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(counter, amount):
+    """ Adds amount of 'rows' or 'bytes' to the open units of the thread and to the totals. """
+    for record in _open_units():
+        record[counter] += amount
+    _add(counter, 0.0, amount)
+
+
+def _add(key, seconds, amount):
+    with _lock:
+        total = _totals.setdefault(key, [0, 0.0, 0])
+        total[0] += 1
+        total[1] += seconds
+        total[2] += amount
+
+
+def drain():
+    """ Returns the measures taken so far and clears them (process pool workers send them to the parent). """
+    with _lock:
+        data = {'units': dict(_units), 'spans': dict(_spans), 'totals': dict(_totals)}
+        _units.clear()
+        _spans.clear()
+        _totals.clear()
+    return data
+
+
+def merge(data):
+    """ Adds the measures of drain(), taken in another process. """
+    with _lock:
+        for label, values in data['units'].items():
+            _units.setdefault(label, []).extend(values)
+        for label, (start, end) in data['spans'].items():
+            span = _spans.get(label, (start, end))
+            _spans[label] = (min(span[0], start), max(span[1], end))
+        for key, (calls, seconds, amount) in data['totals'].items():
+            total = _totals.setdefault(key, [0, 0.0, 0])
+            total[0] += calls
+            total[1] += seconds
+            total[2] += amount
+
+
+def summary():
+    """ Structured summary: per label, number of units, p50/p95/max seconds per unit, time split by category
+        (summed over units), rows and bytes, and throughput over the wall time from the first unit to the last.
+        Totals have the calls, seconds and amounts of every category and counter.
+    """
+    with _lock:
+        units = {label: np.array(values) for label, values in _units.items()}
+        spans = dict(_spans)
+        totals = {key: list(total) for key, total in _totals.items()}
+    output = {'units': {}, 'totals': {}}
+    for label, values in units.items():
+        seconds = values[:, 0]
+        split = dict(zip(CATEGORIES, values[:, 1:4].sum(axis=0)))
+        split['compute'] = max(seconds.sum() - sum(split.values()), 0.0)
+        wall = max(spans[label][1] - spans[label][0], 1e-9)
+        output['units'][label] = {
+            'n': int(values.shape[0]),
+            'p50': float(np.percentile(seconds, 50)),
+            'p95': float(np.percentile(seconds, 95)),
+            'max': float(seconds.max()),
+            'seconds': {category: float(value) for category, value in split.items()},
+            'rows': int(values[:, 4].sum()),
+            'bytes': int(values[:, 5].sum()),
+            'wall': float(wall),
+            'units_per_sec': float(values.shape[0] / wall),
+            'rows_per_sec': float(values[:, 4].sum() / wall)}
+    for key, (calls, seconds, amount) in totals.items():
+        output['totals'][key] = {'calls': calls, 'seconds': seconds, 'amount': amount}
+    return output
+
+
+def report():
+    """ Prints summary() as a table. """
+    data = summary()
+    lines = ['\nInstrumentation']
+    lines.append('{0:<24}{1:>8}{2:>9}{3:>9}{4:>9}{5:>10}{6:>10}{7:>10}{8:>10}{9:>12}{10:>12}{11:>10}'.format(
+        'unit', 'n', 'p50', 'p95', 'max', 'network', 'sql_read', 'sql_write', 'compute', 'rows', 'MB', 'units/s'))
+    for label, stats in sorted(data['units'].items()):
+        lines.append(
+            '{0:<24}{1:>8}{2:>9.3f}{3:>9.3f}{4:>9.3f}{5:>10.1f}{6:>10.1f}{7:>10.1f}{8:>10.1f}{9:>12}{10:>12.1f}'
+            '{11:>10.2f}'.format(label, stats['n'], stats['p50'], stats['p95'], stats['max'],
+                                 stats['seconds']['network'], stats['seconds']['sql_read'],
+                                 stats['seconds']['sql_write'], stats['seconds']['compute'], stats['rows'],
+                                 stats['bytes'] / 1e6, stats['units_per_sec']))
+    for key, total in sorted(data['totals'].items()):
+        lines.append('{0:<24}{1:>8} calls {2:>10.1f} sec {3:>14} rows/bytes'.format(
+            key, total['calls'], total['seconds'], total['amount']))
+    log('\n'.join(lines))
+    if _config.get('summary_path') is not None:
+        with open(_config['summary_path'], 'w') as json_file:
+            json.dump(data, json_file, indent=4)
+    return data
+
+
+def exclusive(stage):
+    """ True if stage runs under cProfile or tracemalloc. It must run alone: tracemalloc (and cProfile from
+        Python 3.12) sees every thread, so the work of stages running at the same time would be counted in it.
+    """
+    return stage in _config.get('profile', []) or stage in _config.get('tracemalloc', [])
+
+
+def serial():
+    """ True in the thread of a stage under cProfile or tracemalloc: its work (utilities.compute, backfills,
+        downloads) runs in this thread instead of worker threads and processes the profile doesn't see.
+    """
+    return getattr(_local, 'serial', False)
+
+
+@contextmanager
+def profile(stage):
+    """ Runs cProfile and tracemalloc on stage if the config asks for it, with its work in the calling thread.
+        Raises RuntimeError if another stage runs at the same time (see exclusive).
+        The profile is written to profile_path/stage.prof and its top functions are printed.
+    """
+    use_profile = stage in _config.get('profile', [])
+    use_tracemalloc = stage in _config.get('tracemalloc', [])
+    with _lock:
+        if len(_stages) > 0 and (exclusive(stage) or any(exclusive(other) for other in _stages)):
+            raise RuntimeError('Stage {0} can\'t run with {1}: profiled stages run alone'.format(
+                stage, ', '.join(sorted(_stages))))
+        _stages.add(stage)
+    _local.serial = use_profile or use_tracemalloc
+    profiler = cProfile.Profile() if use_profile else None
+    if use_tracemalloc:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if use_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = ['\nMemory of {0}: peak {1:.1f} MB, current {2:.1f} MB'.format(stage, peak / 1e6, current / 1e6)]
+            for stat in snapshot.statistics('lineno')[:10]:
+                lines.append('\t{0}'.format(stat))
+            log('\n'.join(lines))
+        _local.serial = False
+        with _lock:
+            _stages.discard(stage)
+        if profiler is not None:
+            path = _config.get('profile_path', '../Profiles')
+            os.makedirs(path, exist_ok=True)
+            profiler.dump_stats(os.path.join(path, stage + '.prof'))
+            with _lock:
+                print('\nProfile of {0}'.format(stage))
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
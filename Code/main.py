@@ -1,59 +1,33 @@
-
 import json
-import webScraper
-import dataProcessing
-import regression
-
-
-def initialize_crawlers(params):
-    """ Initialization is done avoiding unnecessary processing. """
-    crawlers = {}
-    if params['scrapers']['tiingo']['activate']:
-        crawlers['tiingo'] = webScraper.TiingoScraper(params['scrapers']['tiingo'], params['db'])
-    if params['scrapers']['iex']['activate']:
-        crawlers['iex'] = webScraper.IexScraper(params['scrapers']['iex'], params['db'])
-    if params['scrapers']['sec']['activate']:
-        crawlers['sec'] = webScraper.SecScraper(params['scrapers']['sec'], params['db'])
-    return crawlers
+import pipeline
+import managerSQL
+import instrumentation
 
 
 def main():
     # Config
     with open('config.json') as json_file:
         params = json.load(json_file)
+    instrumentation.configure(params.get('instrumentation', {}))
 
-    # Scrape web: Prices, fundamentals
-    crawlers = initialize_crawlers(params)
-    for crawler in crawlers.values():
-        crawler.build()
-        crawler.process()
-
-    # Data processing: Daily returns, factor exposures and outlier removal
-    if params['data_processing']['activate']:
-        processor = dataProcessing.DataProcessing(params)
-        processor.process()
+    # Stages: scrape web (prices, fundamentals), data processing (raw factors, outlier removal and scaling),
+    # regressions, forecast alpha, forecast risk (covariance matrix and specific risk) and optimizer.
+    # Independent stages run at the same time and completed units are skipped when a run is resumed.
+    done, failed, skipped = pipeline.Pipeline(params).run()
+    print('\nStages done: {0}. Failed: {1}. Skipped: {2}'.format(
+        ', '.join(sorted(done)) or '-', ', '.join(sorted(failed)) or '-', ', '.join(sorted(skipped)) or '-'))
 
-    # Regressions
-    if params['regression']['activate']:
-        reg = regression.Regression(params)
-        reg.process()
+    # Time per unit (network, sql and compute), rows and bytes of the hot paths
+    instrumentation.report()
 
-    # Forecast alpha
+    # Connection pool usage, to size max_workers against pool_size
+    for db, metrics in managerSQL.pool_metrics().items():
+        print('\nConnection pool {0}: {1}'.format(db, metrics))
 
-    # Forecast risk (covariance matrix and specific risk)
-
-    # Optimizers
+    # Query cache hits and misses, to size cache_entries and cache_mb
+    for db, metrics in managerSQL.cache_metrics().items():
+        print('\nQuery cache {0}: {1}'.format(db, metrics))
 
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
-
-
-
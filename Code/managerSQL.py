@@ -1,67 +1,804 @@
-
+import io
+import os
+import re
+import operator
+import time
+import queue
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
 import pandas as pd
+import numpy as np
 import psycopg2
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from columnarStore import ColumnarStore
+import instrumentation
+
+
+class ConnectionPool:
+    """ Bounded pool of database connections shared by threads.
+        A thread blocks until a connection is free and keeps it until its outermost checkout ends.
+        Work not committed by then is rolled back.
+    """
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {'checkouts': 0, 'in_use': 0, 'max_in_use': 0,
+                      'wait_sec': 0.0, 'max_wait_sec': 0.0, 'query_sec': 0.0, 'max_query_sec': 0.0}
+
+    @contextmanager
+    def connection(self):
+        """ Checks out a connection for the current thread. Nested checkouts reuse it. """
+        if getattr(self.local, 'cnxn', None) is not None:
+            yield self.local.cnxn
+            return
+
+        t0 = time.perf_counter()
+        self.slots.acquire()
+        try:
+            cnxn = self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                cnxn = self.connect()
+            except Exception:
+                self.slots.release()
+                raise
+        t1 = time.perf_counter()
+        self._record(t1 - t0, None, 1)
+
+        self.local.cnxn = cnxn
+        broken = False
+        try:
+            yield cnxn
+        finally:
+            # Ends read transactions and discards uncommitted writes
+            try:
+                cnxn.rollback()
+            except Exception:
+                broken = True
+            self.local.cnxn = None
+            if broken:
+                cnxn.close()
+            else:
+                self.idle.put(cnxn)
+            self.slots.release()
+            self._record(None, time.perf_counter() - t1, -1)
+
+    def _record(self, wait, query, in_use):
+        with self.lock:
+            stats = self.stats
+            stats['in_use'] += in_use
+            stats['max_in_use'] = max(stats['max_in_use'], stats['in_use'])
+            if wait is not None:
+                stats['checkouts'] += 1
+                stats['wait_sec'] += wait
+                stats['max_wait_sec'] = max(stats['max_wait_sec'], wait)
+            if query is not None:
+                stats['query_sec'] += query
+                stats['max_query_sec'] = max(stats['max_query_sec'], query)
+
+    def metrics(self):
+        """ Pool usage. Waits close to query times mean the pool is too small for the number of workers. """
+        with self.lock:
+            stats = dict(self.stats)
+        n = max(stats['checkouts'], 1)
+        stats['size'] = self.size
+        stats['mean_wait_sec'] = stats['wait_sec'] / n
+        stats['mean_query_sec'] = stats['query_sec'] / n
+        return stats
+
+
+class QueryCache:
+    """ Results of reads, keyed by their SQL with whitespace normalized (see normalize_sql), shared by the
+        ManagerSQL of a database in the process. The least recently used results are evicted beyond max_entries
+        or max_mb.
+        A result is dropped when one of the tables it reads (or the tables behind a view it reads) is written through
+        a ManagerSQL of the process, and isn't cached if one of them was written while it was read. Writes by
+        other processes aren't seen.
+    """
+    def __init__(self, max_entries, max_mb):
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1e6
+        # sql: (tables, df, bytes)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # view: tables it reads, loaded by the first ManagerSQL that caches a result
+        self.views = None
+        # table: number of invalidations, and reads of the table running
+        self.generations = Counter()
+        self.reading = Counter()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'stale': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, sql):
+        """ Copy of the result of sql, None if it isn't cached. """
+        with self.lock:
+            entry = self.entries.get(sql)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(sql)
+            self.stats['hits'] += 1
+        return entry[1].copy()
+
+    def start_read(self, tables):
+        """ Registers a read of tables about to start. Returns their generations, to pass to put. end_read must be
+            called once the read is done.
+        """
+        with self.lock:
+            self.reading.update(tables)
+            return {table: self.generations[table] for table in tables}
+
+    def end_read(self, tables):
+        with self.lock:
+            self.reading.subtract(tables)
+            for table in tables:
+                if self.reading[table] <= 0:
+                    del self.reading[table]
+
+    def put(self, sql, tables, df, generations):
+        """ Caches a copy of df, the result of sql reading tables. Results larger than max_mb aren't cached, nor
+            results of reads that a write of one of their tables overlapped (generations, from start_read, changed):
+            they may hold the data from before the write, after its invalidate.
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        df = df.copy()
+        with self.lock:
+            if any(self.generations[table] != generation for table, generation in generations.items()):
+                self.stats['stale'] += 1
+                return
+            self._drop(sql)
+            self.entries[sql] = (tables, df, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def _drop(self, sql):
+        entry = self.entries.pop(sql, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def tables(self):
+        """ Tables read by the cached results and by the reads running. """
+        with self.lock:
+            return set(self.reading).union(*[entry[0] for entry in self.entries.values()])
+
+    def invalidate(self, table):
+        """ Drops the results that read table, and the results of the reads of table running. """
+        with self.lock:
+            self.generations[table] += 1
+            for sql in [sql for sql, entry in self.entries.items() if table in entry[0]]:
+                self._drop(sql)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            for table in self.reading:
+                self.generations[table] += 1
+            self.stats['invalidations'] += len(self.entries)
+            self.entries.clear()
+            self.bytes = 0
+
+    def metrics(self):
+        """ Hits, misses, evictions, invalidations and size. """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['mb'] = self.bytes / 1e6
+        stats['hit_rate'] = stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+        return stats
+
+
+# Quoted literals and identifiers of SQL, kept as they are by normalize_sql
+_sql_quoted = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(sql):
+    """ sql with runs of whitespace outside quotes replaced by a single space, so that the same query written
+        on several lines or indented differently has the same key in the QueryCache.
+    """
+    # Odd parts are the quoted ones
+    parts = _sql_quoted.split(sql)
+    return ''.join(part if i % 2 == 1 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)).strip()
+
+
+# Comparisons allowed in the where filter of select_partitions
+_operators = {'=': operator.eq, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# Types of the Queries/*.sql schemas and the compact dtypes their columns are loaded as. Integer columns that can
+# be null are loaded as float64, text and unknown types as objects.
+_sql_dtypes = [('character varying', 'category'), ('varchar', 'category'), ('timestamp', 'datetime64[ns]'),
+               ('date', 'datetime64[ns]'), ('real', 'float32'), ('double precision', 'float64'),
+               ('numeric', 'float64'), ('smallint', 'int16'), ('bigint', 'int64'), ('integer', 'int32'),
+               ('int', 'int32')]
+
+# Numeric values as floats instead of Decimal objects
+_dec2float = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'DEC2FLOAT', lambda value, cursor: float(value) if value is not None else None)
+
+_pools = {}
+_engines = {}
+_stores = {}
+_caches = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, connect, size):
+    """ Returns the process-wide pool of key, creating it the first time. """
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(connect, size)
+        return _pools[key]
+
+
+class _BorrowedPool(NullPool):
+    """ SQLAlchemy pool without connections of its own. It lends the connection the calling thread checked out
+        from a ConnectionPool and gives it back without closing it.
+    """
+    def _close_connection(self, connection, terminate=False):
+        pass
+
+
+def get_engine(db_url, pool):
+    """ Returns the process-wide SQLAlchemy engine of db_url, used by DataFrame.to_sql. It uses the connection
+        of pool checked out by the calling thread, so that pool_size bounds every connection of the process.
+    """
+    def borrow():
+        if getattr(pool.local, 'cnxn', None) is None:
+            raise RuntimeError('The engine of ' + db_url.split('@')[-1] + ' needs a connection checked out from the pool')
+        return pool.local.cnxn
+
+    with _pools_lock:
+        if db_url not in _engines:
+            _engines[db_url] = create_engine(db_url, creator=borrow, poolclass=_BorrowedPool)
+        return _engines[db_url]
+
+
+def get_cache(db_url, max_entries, max_mb):
+    """ Returns the process-wide QueryCache of db_url, creating it the first time. """
+    with _pools_lock:
+        if db_url not in _caches:
+            _caches[db_url] = QueryCache(max_entries, max_mb)
+        return _caches[db_url]
+
+
+def clear_caches():
+    """ Empties every QueryCache of the process, after writes it didn't see (e.g. by process pool workers). """
+    with _pools_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.clear()
+
+
+def get_store(root):
+    """ Returns the process-wide ColumnarStore of root, None if root is None. """
+    if root is None:
+        return None
+    with _pools_lock:
+        if root not in _stores:
+            _stores[root] = ColumnarStore(root)
+        return _stores[root]
+
+
+def schema_dtypes(path):
+    """ Compact dtype of every column of the CREATE TABLE statement in path (see _sql_dtypes).
+        Empty for files without one (views).
+    """
+    with open(path) as sql_file:
+        sql = sql_file.read()
+    if 'CREATE TABLE' not in sql.upper():
+        return {}
+    body = sql[sql.index('(', sql.upper().index('CREATE TABLE')) + 1:]
+    keys = re.search(r'PRIMARY KEY\s*\(([^)]*)\)', body, re.IGNORECASE)
+    keys = [key.strip().strip('"').lower() for key in keys.group(1).split(',')] if keys is not None else []
+    dtypes = {}
+    for line in body.split('\n'):
+        match = re.match(r'\s*"?(\w+)"?\s+(.*)', line)
+        if match is None or match.group(1).upper() in ('PRIMARY', 'FOREIGN', 'CONSTRAINT', 'REFERENCES', 'ON'):
+            continue
+        column = match.group(1).lower()
+        definition = match.group(2).lower()
+        for sql_type, dtype in _sql_dtypes:
+            if re.match(sql_type + r'\b', definition):
+                if dtype.startswith('int') and 'not null' not in definition and column not in keys:
+                    dtype = 'float64'
+                dtypes[column] = dtype
+                break
+        else:
+            dtypes[column] = 'object'
+    return dtypes
+
+
+def pool_metrics():
+    """ Returns metrics of every pool in the process. """
+    with _pools_lock:
+        pools = dict(_pools)
+    return {key.split('@')[-1]: pool.metrics() for key, pool in pools.items()}
+
+
+def cache_metrics():
+    """ Returns metrics of every query cache in the process. """
+    with _pools_lock:
+        caches = dict(_caches)
+    return {key.split('@')[-1]: cache.metrics() for key, cache in caches.items()}
+
+
+class _TypedColumns:
+    """ Preallocated arrays of the columns of a typed load, filled chunk by chunk.
+        Categorical columns keep integer codes and their categories; other columns are converted by numpy.
+    """
+    def __init__(self, columns, dtypes, n_rows):
+        self.columns = columns
+        self.dtypes = dtypes
+        self.n_rows = 0
+        self.arrays = [np.empty(n_rows, dtype=np.int32 if dtype == 'category' else dtype) for dtype in dtypes]
+        self.categories = [{} if dtype == 'category' else None for dtype in dtypes]
+
+    def add(self, rows):
+        start = self.n_rows
+        end = start + len(rows)
+        if end > self.arrays[0].shape[0]:
+            # Rows were added after the count
+            self.arrays = [np.resize(array, max(end, 2 * array.shape[0])) for array in self.arrays]
+        for i, values in enumerate(zip(*rows)):
+            # fromiter, np.array inspects every object (e.g. dates) as a possible sequence
+            objects = np.fromiter(values, dtype=object, count=len(values))
+            if self.dtypes[i] == 'category':
+                codes, uniques = pd.factorize(objects)
+                categories = self.categories[i]
+                lookup = np.array([categories.setdefault(value, len(categories)) for value in uniques] + [-1],
+                                  dtype=np.int32)
+                self.arrays[i][start:end] = lookup[codes]
+            elif self.dtypes[i].startswith('datetime'):
+                # Few distinct dates, converted once each
+                codes, uniques = pd.factorize(objects)
+                dates = np.append(pd.to_datetime(uniques).values, np.datetime64('NaT'))
+                self.arrays[i][start:end] = dates[codes]
+            else:
+                self.arrays[i][start:end] = objects
+        self.n_rows = end
+
+    def frame(self):
+        data = {}
+        for column, dtype, array, categories in zip(self.columns, self.dtypes, self.arrays, self.categories):
+            array = array[:self.n_rows]
+            if dtype == 'category':
+                # Sorted categories, codes renumbered accordingly
+                values = np.array(list(categories.keys()), dtype=object)
+                order = np.argsort(values, kind='mergesort')
+                rank = np.empty(len(values) + 1, dtype=np.int32)
+                rank[order] = np.arange(len(values), dtype=np.int32)
+                rank[-1] = -1
+                data[column] = pd.Categorical.from_codes(rank[array], values[order])
+            elif dtype == 'object':
+                data[column] = pd.Series(array).infer_objects()
+            else:
+                data[column] = array
+        return pd.DataFrame(data, columns=self.columns)
 
 
 class ManagerSQL:
     def __init__(self, sql_params):
+        self.sql_params = sql_params
         db_name = sql_params['db_name']
         user = sql_params['user']
         password = sql_params['password']
         port = sql_params['port']
+        # localhost, or the directory of the server socket
+        host = sql_params.get('host', 'localhost')
+        pool_size = sql_params.get('pool_size', 8)
 
-        # Connexion for downloading data
-        self.cnxn = psycopg2.connect(host="localhost", database=db_name, user=user, password=password)
-        self.cursor = self.cnxn.cursor()
-
-        # Connexion for uploading data
+        # Connexions for downloading data, shared by all ManagerSQL of the process
         self.db_url = 'postgresql://' + user + ':' + password + '@localhost/' + db_name
-        self.con = create_engine(self.db_url)
+        if host != 'localhost':
+            self.db_url += '?host=' + host
+
+        def connect():
+            return psycopg2.connect(host=host, port=port, database=db_name, user=user, password=password)
+        self.pool = get_pool(self.db_url, connect, pool_size)
+
+        # Engine for uploading data with to_sql, through the connections of the pool
+        self.con = get_engine(self.db_url, self.pool)
+
+        # Local Parquet copy of tables, read before the database
+        self.store = get_store(sql_params.get('store'))
+
+        # Results of repeated reads (select, select_query...), shared by all ManagerSQL of the process
+        self.cache = get_cache(self.db_url, sql_params.get('cache_entries', 256), sql_params.get('cache_mb', 64))
+
+        # Bulk upload: 'copy' streams data frames with COPY FROM STDIN, 'insert' uses DataFrame.to_sql
+        self.upload_mode = sql_params.get('upload_mode', 'insert')
+        self.chunk_size = sql_params.get('chunk_size', 100000)
+        self.upsert = sql_params.get('upsert', None)
+        self.column_types = {}
+
+        # Table schemas (Queries/*.sql), for typed loads
+        self.schema_path = sql_params.get('schema_path', '../Queries')
+        self.column_dtypes = {}
+
+    def __getstate__(self):
+        """ Connections can't be pickled. Process pool workers reconnect with the same parameters. """
+        return {'sql_params': self.sql_params}
+
+    def __setstate__(self, state):
+        self.__init__(state['sql_params'])
+
+    def _read(self, sql):
+        with instrumentation.timer('sql_read') as calls:
+            with self.pool.connection() as cnxn:
+                df = pd.read_sql(sql, cnxn)
+            calls['rows'] = df.shape[0]
+        return df
+
+    def _read_cached(self, sql):
+        """ _read through the query cache. Reads inside a transaction see its uncommitted writes and aren't cached. """
+        if not self.cache.enabled or self.in_transaction():
+            return self._read(sql)
+        key = normalize_sql(sql)
+        df = self.cache.get(key)
+        if df is None:
+            tables = self._read_tables(key)
+            if len(tables) == 0:
+                return self._read(sql)
+            generations = self.cache.start_read(tables)
+            try:
+                df = self._read(sql)
+                self.cache.put(key, tables, df, generations)
+            finally:
+                self.cache.end_read(tables)
+        return df
+
+    def _read_tables(self, sql):
+        """ Tables read by sql, with the tables behind the views it reads. """
+        if self.cache.views is None:
+            self.cache.views = self._view_tables()
+        tables = set()
+        for name in re.findall(r'\b(?:from|join)\s+([\w.]+)', sql, re.IGNORECASE):
+            table = name.lower().split('.')[-1]
+            tables.add(table)
+            tables.update(self.cache.views.get(table, set()))
+        return frozenset(tables)
+
+    def _view_tables(self):
+        """ Tables read by every view, directly or through other views. """
+        sql = 'select view_name, table_name from information_schema.view_table_usage'
+        df = self._read(sql)
+        views = {}
+        for view, table in zip(df.view_name, df.table_name):
+            views.setdefault(view, set()).add(table)
+        changed = True
+        while changed:
+            changed = False
+            for view, tables in views.items():
+                expanded = tables.union(*[views.get(table, set()) for table in tables])
+                if len(expanded) > len(tables):
+                    views[view] = expanded
+                    changed = True
+        return views
+
+    def pool_metrics(self):
+        """ Returns pool wait and query time metrics. """
+        return self.pool.metrics()
+
+    def cache_metrics(self):
+        """ Returns query cache hits, misses, evictions and size. """
+        return self.cache.metrics()
 
     def select(self, table):
         """ Returns table as DataFrame. """
         sql = 'select * from '+table
-        df = pd.read_sql(sql, self.cnxn)
+        df = self._read_cached(sql)
         return df
 
     def select_query(self, query):
         """ Returns query output as DataFrame. """
-        df = pd.read_sql(query, self.cnxn)
+        df = self._read_cached(query)
         return df
 
     def select_column_list(self, column, table):
         """ Returns column values as list. """
         sql = 'select '+column+' from '+table+' order by '+column
-        df = pd.read_sql(sql, self.cnxn)
+        df = self._read_cached(sql)
         lst = [element for element in df[column]]
         return lst
 
     def select_distinct_column_list(self, column, table):
         """ Returns unique values of column as list. """
         sql = 'select distinct '+column+' from '+table+' order by '+column
-        df = pd.read_sql(sql, self.cnxn)
+        df = self._read_cached(sql)
         lst = [element for element in df[column]]
         return lst
 
     def select_as_dictionary(self, column_key, column_value, table):
         """ Return dictionary column_key: column_value, column_key must have unique values. """
         sql = 'select '+column_key+', '+column_value+' from '+table
-        df = pd.read_sql(sql, self.cnxn)
+        df = self._read_cached(sql)
         assert df[column_key].is_unique, "Column "+column_key+" doesn't have unique values."
         return df.set_index(column_key).to_dict()[column_value]
 
+    def dtypes(self, table):
+        """ Compact dtypes of the columns of table, from its schema in schema_path. Empty if there is none. """
+        if table not in self.column_dtypes:
+            path = os.path.join(self.schema_path, table + '.sql')
+            self.column_dtypes[table] = schema_dtypes(path) if os.path.exists(path) else {}
+        return self.column_dtypes[table]
+
+    def astype_schema(self, table, df):
+        """ Converts the columns of df to the compact dtypes of table. Categories are sorted, so that categorical
+            columns sort as their values.
+        """
+        for column, dtype in self.dtypes(table).items():
+            if column not in df.columns or df[column].dtype == dtype:
+                continue
+            if dtype == 'category':
+                df[column] = pd.Categorical(np.asarray(df[column], dtype=object))
+            elif dtype.startswith('datetime'):
+                df[column] = pd.to_datetime(df[column])
+            elif dtype.startswith('int') and df[column].isna().any():
+                df[column] = df[column].astype('float64')
+            else:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def select_typed(self, table, columns=None, where=None, chunk_size=None):
+        """ Rows of table (where is an SQL condition) with the compact dtypes of its schema.
+            Rows are counted first and fetched in chunks of chunk_size rows into preallocated arrays, through a
+            server-side cursor, so that the result is never held as Python objects all at once.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        dtypes = self.dtypes(table)
+        condition = '' if where is None else ' where ' + where
+        with instrumentation.timer('sql_read') as calls, self.pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+            cursor.execute('select count(*) from ' + table + condition)
+            n_rows = cursor.fetchone()[0]
+            if columns is None:
+                cursor.execute('select * from ' + table + ' where 1 = 0')
+                columns = [description[0] for description in cursor.description]
+            cursor.close()
+
+            if isinstance(cnxn, psycopg2.extensions.connection):
+                cursor = cnxn.cursor(name='select_typed')
+                psycopg2.extensions.register_type(_dec2float, cursor)
+            else:
+                cursor = cnxn.cursor()
+            cursor.execute('select ' + ', '.join(columns) + ' from ' + table + condition)
+            loader = _TypedColumns(columns, [dtypes.get(column, 'object') for column in columns], n_rows)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                loader.add(rows)
+            cursor.close()
+            calls['rows'] = loader.n_rows
+        return loader.frame()
+
+    def select_partitions(self, table, column, values, columns=None, where=None, typed=False):
+        """ Returns rows of table with column in values.
+            Partitions in the local store are read from it, the rest from the database and then saved to the store.
+            where: optional (column, operator, value) filter, e.g. ('date', '>=', date).
+            typed: columns with the compact dtypes of the schema of table (see select_typed). The store keeps the
+            untyped layout, the conversion is done after reading it.
+        """
+        values = list(values)
+        cached = self.store.partitions(table) if self.store is not None else set()
+        missing = [value for value in values if str(value) not in cached]
+        frames = []
+        if len(missing) < len(values):
+            filters = [where] if where is not None else None
+            with instrumentation.timer('sql_read') as calls:
+                frames.append(self.store.read(table, column, [v for v in values if str(v) in cached], columns,
+                                              filters))
+                calls['rows'] = frames[-1].shape[0]
+        if len(missing) > 0:
+            condition = column + " in ('" + "', '".join(missing) + "')"
+            if self.store is None and where is not None:
+                condition += ' and ' + where[0] + ' ' + where[1] + " '" + str(where[2]) + "'"
+            if typed and self.store is None:
+                df = self.select_typed(table, where=condition)
+            else:
+                df = self._read('select * from ' + table + ' where ' + condition)
+            if self.store is not None:
+                # Whole partitions are saved, the filter is applied afterwards
+                self.store.write(table, column, df, missing)
+                if where is not None:
+                    df = df[_operators[where[1]](df[where[0]], where[2])]
+            frames.append(df if columns is None else df[columns])
+        df = pd.concat(frames, ignore_index=True)
+        return self.astype_schema(table, df) if typed else df
+
+    def store_partition(self, table, column, value, df):
+        """ Saves df as the partition value of table in the local store. """
+        if self.store is not None:
+            self.store.write(table, column, df, [value])
+
+    def _invalidate(self, table, df=None, keep_store=False):
+        """ Cached reads of table are dropped, and partitions of table changed by a write are no longer complete in
+            the local store. Rows without the partition column (SEC data sets) are kept in sync with store_partition
+            by the writer.
+        """
+        self.cache.invalidate(table)
+        if self.in_transaction():
+            # Other threads may cache the committed table until the transaction ends
+            self.pool.local.written.add(table)
+        if self.store is None or keep_store:
+            return
+        column = self.store.tables().get(table)
+        if column is not None:
+            if df is None:
+                self.store.invalidate(table)
+            elif column in df.columns:
+                self.store.invalidate(table, df[column].unique())
+
     def upload_df(self, table, df):
         """ Uploads data frame to table. Appends information. """
-        df.to_sql(name=table, con=self.con, if_exists='append', index=False)
+        with instrumentation.timer('sql_write', df.shape[0]):
+            if self.upload_mode == 'copy':
+                self.copy_df(table, df, upsert=self.upsert)
+            else:
+                self._to_sql(table, df)
+                self._invalidate(table, df)
+
+    def _to_sql(self, table, df):
+        if self.in_transaction():
+            # to_sql writes through its own engine connection, outside of the transaction. copy_df creates the
+            # table as to_sql would.
+            self.copy_df(table, df)
+        else:
+            with self.pool.connection():
+                df.to_sql(name=table, con=self.con, if_exists='append', index=False)
+
+    @contextmanager
+    def transaction(self):
+        """ Writes of the calling thread inside the block (upload_df, query, clean_table) go through a single
+            connection and are committed together at the end, or rolled back if the block fails.
+        """
+        with self.pool.connection() as cnxn:
+            self.pool.local.transaction = True
+            self.pool.local.written = set()
+            try:
+                yield
+                cnxn.commit()
+            except Exception:
+                # Tables created by the transaction are gone
+                for table in self.pool.local.written:
+                    self.column_types.pop(table, None)
+                raise
+            finally:
+                self.pool.local.transaction = False
+                for table in self.pool.local.written:
+                    self.cache.invalidate(table)
+
+    def in_transaction(self):
+        return getattr(self.pool.local, 'transaction', False)
+
+    def _commit(self, cnxn):
+        """ Commits, unless the write is part of a transaction committed at its end. """
+        if not self.in_transaction():
+            cnxn.commit()
+
+    def copy_df(self, table, df, chunk_size=None, upsert=None):
+        """ Uploads data frame to table with COPY FROM STDIN, streamed by chunks of rows in a single transaction,
+            so that a failed upload leaves nothing behind (as to_sql).
+            upsert=None appends, so rows with existing keys fail as with to_sql.
+            upsert='ignore' or 'update' copies into a staging table and then inserts on conflict do nothing / update.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        stage = table + '_stage'
+        with self.pool.connection() as cnxn:
+            created = self._create_table(cnxn, table, df)
+            try:
+                df = self._copy_format(table, df)
+                columns = ', '.join(df.columns)
+                conflict = self._on_conflict(table, df.columns, upsert) if upsert is not None else None
+                cursor = cnxn.cursor()
+                if upsert is not None:
+                    # Calls of a transaction share the connection and its temp table
+                    cursor.execute('drop table if exists ' + stage)
+                    cursor.execute(
+                        'create temp table ' + stage + ' (like ' + table + ' including defaults) on commit drop')
+                for start in range(0, df.shape[0], chunk_size):
+                    buffer = io.StringIO()
+                    df.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False, na_rep='\\N')
+                    buffer.seek(0)
+                    if upsert is None:
+                        cursor.copy_expert(
+                            'copy ' + table + ' (' + columns + ") from stdin with (format csv, null '\\N')", buffer)
+                    else:
+                        cursor.copy_expert(
+                            'copy ' + stage + ' (' + columns + ") from stdin with (format csv, null '\\N')", buffer)
+                        cursor.execute(
+                            'insert into ' + table + ' (' + columns + ') select ' + columns + ' from ' + stage + ' ' +
+                            conflict)
+                        cursor.execute('truncate ' + stage)
+                self._commit(cnxn)
+            except Exception:
+                if created:
+                    # Rolled back with the upload
+                    self.column_types.pop(table, None)
+                raise
+        self._invalidate(table, df)
+
+    def _create_table(self, cnxn, table, df):
+        """ Creates table with the types to_sql would give the columns of df if it doesn't exist yet (tables without
+            a schema in Queries, e.g. sec_num_bal on a fresh database), committed with the upload. True if created.
+        """
+        if len(self.columns(table)) > 0:
+            return False
+        sql = pd.io.sql.get_schema(df, table, con=self.con)
+        cnxn.cursor().execute(sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+        return True
+
+    def columns(self, table):
+        """ Data types of the columns of table in the database, empty if the table doesn't exist yet. """
+        if table not in self.column_types:
+            sql = "select column_name, data_type from information_schema.columns where table_name = '" + table + "'"
+            # Not through the query cache, which doesn't see tables being created
+            df = self._read(sql)
+            column_types = dict(zip(df.column_name, df.data_type))
+            if len(column_types) == 0:
+                return column_types
+            self.column_types[table] = column_types
+        return self.column_types[table]
+
+    def _copy_format(self, table, df):
+        """ COPY doesn't cast text like '12.5' into integer columns as inserts do. Rounds them beforehand. """
+        column_types = self.columns(table)
+        integers = [col for col in df.columns
+                    if column_types.get(col) in ('smallint', 'integer', 'bigint')
+                    and df[col].dtype.kind == 'f']
+        if len(integers) > 0:
+            df = df.copy()
+            for col in integers:
+                df[col] = np.round(df[col]).astype('Int64')
+        return df
+
+    def _on_conflict(self, table, columns, upsert):
+        if upsert == 'ignore':
+            return 'on conflict do nothing'
+        sql = "select a.attname from pg_index i " + \
+              "inner join pg_attribute a on a.attrelid = i.indrelid and a.attnum = any(i.indkey) " + \
+              "where i.indrelid = '" + table + "'::regclass and i.indisprimary"
+        keys = list(self.select_query(sql).attname)
+        if len(keys) == 0:
+            raise ValueError("Upsert 'update' needs a primary key, table " + table + ' has none')
+        updates = ', '.join([col + ' = excluded.' + col for col in columns if col not in keys])
+        if updates == '':
+            # Only key columns: existing rows are already up to date
+            return 'on conflict (' + ', '.join(keys) + ') do nothing'
+        return 'on conflict (' + ', '.join(keys) + ') do update set ' + updates
 
     def query(self, query):
         """ Executes query. Doesn't return anything.
             Intended for customized delete queries. """
-        self.cursor.execute(query)
-        self.cnxn.commit()
+        with instrumentation.timer('sql_write'):
+            with self.pool.connection() as cnxn:
+                cnxn.cursor().execute(query)
+                self._commit(cnxn)
+        tables = self.cache.tables()
+        if self.store is not None:
+            tables.update(self.store.tables())
+        for table in tables:
+            if re.search(r'\b' + table + r'\b', query, re.IGNORECASE):
+                self._invalidate(table)
 
-    def clean_table(self, table):
-        """ Delete all information from the table. """
-        self.cursor.execute('delete from ' + table)
-        self.cnxn.commit()
+    def clean_table(self, table, keep_store=False):
+        """ Delete all information from the table.
+            keep_store keeps its partitions in the local store, to restore them later without downloading.
+        """
+        with self.pool.connection() as cnxn:
+            cnxn.cursor().execute('delete from ' + table)
+            self._commit(cnxn)
+        self._invalidate(table, keep_store=keep_store)
@@ -0,0 +1,113 @@
+import pandas as pd
+import numpy as np
+import cvxpy as cp
+from datetime import datetime
+import managerSQL
+import regression
+import riskModel
+import alpha
+
+
+class Optimizer:
+    """ Mean-variance portfolio: maximize alpha'w - risk_aversion * w'(X F X' + D)w subject to budget, long only,
+        position limit and turnover constraints.
+        The covariance stays in factor form: the k factor exposures y = X'w are variables, so the problem has n + k
+        variables and O(nk) nonzeros instead of an (n x n) quadratic form.
+    """
+    def __init__(self, params):
+        self.params = params['optimizer']
+        self.sql_manager = managerSQL.ManagerSQL(params['db'])
+        self.risk_aversion = self.params.get('risk_aversion', 1.0)
+        self.max_weight = self.params.get('max_weight', 0.02)
+        self.long_only = self.params.get('long_only', True)
+        self.turnover = self.params.get('turnover', None)
+        self.solver = self.params.get('solver', 'CLARABEL')
+        self.styles = self.params.get('styles', ['mcap', 'pb', 'mom'])
+        self.alpha_store = alpha.AlphaStore(params['alpha'].get('store_path', '../Alpha'))
+
+    def process(self):
+        """ Main execution of Optimizer class. Weights of date are saved in portfolio_weights. """
+        t0 = datetime.now()
+        date = self.get_date()
+        if date is None:
+            print('Optimization skipped: no risk model in risk_specific')
+            return
+
+        try:
+            industries = regression.get_industries(self.sql_manager, self.params.get('industry', 'office'))
+            cov = riskModel.load_asset_covariance(self.sql_manager, date, industries, self.styles)
+            alpha = self.get_alpha(date, cov.symbols)
+            w0, sold = self.get_previous_weights(date, cov.symbols)
+            weights = self.solve(alpha, cov, w0, sold)
+
+            df = pd.DataFrame({'date': pd.Timestamp(date).date(), 'symbol': cov.symbols, 'weight': weights})
+            df = df[np.abs(df.weight) > 1e-6]
+
+            # Upload data to db
+            self.sql_manager.query("delete from portfolio_weights where date = '" + date + "'")
+            self.sql_manager.upload_df('portfolio_weights', df)
+
+            t1 = datetime.now()
+            print('Optimization successful for {0}: {1} positions, alpha {2:.4f}, risk {3:.4f} ({4:.2f} sec)'.format(
+                date, df.shape[0], alpha.dot(weights), np.sqrt(cov.variance(weights)), (t1 - t0).total_seconds()))
+
+        except Exception:
+            t1 = datetime.now()
+            print('Optimization failed for {0} ({1:.2f} sec)'.format(date, (t1 - t0).total_seconds()))
+            raise
+
+    def get_date(self):
+        """ date in params, or the last date of the risk model. None if there is no risk model yet. """
+        if self.params.get('date') is not None:
+            return str(self.params['date'])
+        date = self.sql_manager.select_query('select max(date) date from risk_specific').date[0]
+        return None if pd.isnull(date) else str(date)
+
+    def get_alpha(self, date, symbols):
+        """ Last alpha forecast of every symbol up to date, from the alpha store, zero if there is none. """
+        forecasts = self.alpha_store.read(date)
+        return pd.Series(symbols).map(forecasts).fillna(0).values
+
+    def get_previous_weights(self, date, symbols):
+        """ Last portfolio before date, as weights of symbols, and the weight of its positions outside symbols,
+            which are sold and use part of the turnover. None if there is no previous portfolio.
+        """
+        df = self.sql_manager.select_query(
+            "select symbol, weight from portfolio_weights where date = (select max(date) from portfolio_weights "
+            "where date < '" + date + "')")
+        if df.shape[0] == 0:
+            return None, 0.0
+        previous = df.set_index('symbol').weight
+        w0 = pd.Series(symbols).map(previous).fillna(0).values
+        sold = np.abs(previous[~previous.index.isin(symbols)]).sum()
+        return w0, sold
+
+    def solve(self, alpha, cov, w0=None, sold=0.0):
+        """ Optimal weights for alpha and FactorCovariance cov, starting from weights w0 (turnover). """
+        n = len(alpha)
+        w = cp.Variable(n)
+        y = cp.Variable(len(cov.factors))
+
+        # F = L L' so the factor risk is a sum of squares of k terms. F is PSD up to rounding.
+        values, vectors = np.linalg.eigh(cov.cov)
+        root = vectors * np.sqrt(np.clip(values, 0, None))
+        risk = cp.sum_squares(root.T @ y) + cp.sum_squares(cp.multiply(np.sqrt(cov.specific), w))
+
+        constraints = [y == cov.exposures.T @ w, cp.sum(w) == 1]
+        if self.long_only:
+            constraints += [w >= 0, w <= self.max_weight]
+        else:
+            constraints.append(cp.abs(w) <= self.max_weight)
+        if self.turnover is not None and w0 is not None:
+            # Forced sales use part of the budget. Reinvesting them to be fully invested again needs at least
+            # |1 - sum(w0)|, so the budget is never below that (the problem would be infeasible).
+            budget = max(self.turnover - sold, abs(1 - w0.sum()))
+            if budget > self.turnover - sold:
+                print('Turnover budget raised to {0:.4f}: forced sales of {1:.4f}'.format(budget, sold))
+            constraints.append(cp.norm1(w - w0) <= budget)
+
+        problem = cp.Problem(cp.Maximize(alpha @ w - self.risk_aversion * risk), constraints)
+        problem.solve(solver=self.solver)
+        if problem.status not in ('optimal', 'optimal_inaccurate'):
+            raise ValueError('Optimization ' + problem.status)
+        return w.value
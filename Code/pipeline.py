@@ -0,0 +1,324 @@
+from concurrent import futures
+from datetime import datetime
+from utilities import compute, unit_key, range_key
+import webScraper
+import dataProcessing
+import regression
+import alpha
+import riskModel
+import optimizer
+import managerSQL
+import instrumentation
+
+
+class Checkpoints:
+    """ Work units (symbols, quarters, dates) completed by every stage of a run, in table pipeline_units.
+        A run is identified by run_id, so a run that failed can be repeated skipping what it already did.
+    """
+    def __init__(self, sql_manager, run_id):
+        self.sql_manager = sql_manager
+        self.run_id = run_id
+
+    def completed(self, stage):
+        df = self.sql_manager.select_query(
+            "select unit from pipeline_units where run_id = '{0}' and stage = '{1}'".format(self.run_id, stage))
+        return set(df.unit)
+
+    def record(self, stage, *units):
+        values = ', '.join("('{0}', '{1}', '{2}', now())".format(self.run_id, stage, unit.replace("'", "''"))
+                           for unit in units)
+        self.sql_manager.query("insert into pipeline_units (run_id, stage, unit, completed) values " + values +
+                               " on conflict do nothing")
+
+    def clean(self):
+        self.sql_manager.query("delete from pipeline_units where run_id = '" + self.run_id + "'")
+
+    def start(self):
+        self.sql_manager.query("insert into pipeline_runs (run_id, started) values ('{0}', now()) "
+                               "on conflict do nothing".format(self.run_id))
+
+    def finish(self):
+        self.sql_manager.query("update pipeline_runs set finished = now() where run_id = '" + self.run_id + "'")
+
+    @staticmethod
+    def unfinished(sql_manager):
+        """ run_id of the last run that was started and did not finish, None if there is none. """
+        df = sql_manager.select_query(
+            "select run_id from pipeline_runs where finished is null order by started desc limit 1")
+        return df.run_id.iloc[0] if df.shape[0] > 0 else None
+
+
+class UnitsFailed(Exception):
+    """ Raised by a stage when some of its units failed, so that the stages after it are skipped. """
+    pass
+
+
+class _Recorded:
+    """ fun of a stage, recording the first argument (the unit) once fun returns.
+        Picklable, so units processed in process pools are recorded by the workers.
+    """
+    def __init__(self, fun, checkpoints, stage, key):
+        self.fun = fun
+        self.checkpoints = checkpoints
+        self.stage = stage
+        self.key = key
+
+    def __call__(self, unit, *args):
+        result = self.fun(unit, *args)
+        self.checkpoints.record(self.stage, self.key(unit))
+        return result
+
+
+class _RecordedEach(_Recorded):
+    """ fun of a stage taking a list of units (e.g. a panel of symbols), recording every unit of the list. """
+    def __call__(self, units, *args):
+        result = self.fun(units, *args)
+        self.checkpoints.record(self.stage, *[self.key(unit) for unit in units])
+        return result
+
+
+class StageRun:
+    """ Passed to the function of a stage to skip the units already completed and record the new ones.
+        max_failed: fraction of units that can fail (e.g. symbols delisted by the vendor) without failing the stage.
+    """
+    def __init__(self, stage, checkpoints, max_failed=0.0):
+        self.stage = stage
+        self.checkpoints = checkpoints
+        self.max_failed = max_failed
+        self.done = checkpoints.completed(stage.name)
+
+    def pending(self, units, key=unit_key):
+        pending = [unit for unit in units if key(unit) not in self.done]
+        if len(pending) < len(units):
+            print('{0}: skipping {1} completed units'.format(self.stage.name, len(units) - len(pending)))
+        return pending
+
+    def recorded(self, fun, key=unit_key):
+        return _Recorded(fun, self.checkpoints, self.stage.name, key)
+
+    def check(self, summary):
+        """ Raises UnitsFailed if more than max_failed of the units of the ComputeSummary failed, so that the stage
+            is not done. Units that failed are not recorded: they are computed again by the next run.
+        """
+        if summary is None or len(summary.errors) == 0:
+            return summary
+        n_failed = len(summary.errors)
+        n_units = n_failed + len(summary.results)
+        message = '{0} of {1} units failed: {2}'.format(
+            n_failed, n_units, ', '.join(str(key) for key in list(summary.errors)[:5]))
+        if n_failed > self.max_failed * n_units:
+            raise UnitsFailed(message)
+        print('{0}: {1} (up to {2:.0%} allowed)'.format(self.stage.name, message, self.max_failed))
+        return summary
+
+    def compute(self, units, fun, key=unit_key, **execution):
+        """ utilities.compute of the pending units. Raises UnitsFailed if too many of them failed. """
+        return self.check(compute(self.pending(units, key), self.recorded(fun, key), key=key, **execution))
+
+    def compute_lists(self, lists, fun, key=unit_key, **execution):
+        """ utilities.compute of lists of units (e.g. panels of symbols) built from pending units. Every unit of a
+            list is recorded once fun(list) returns, so resuming does not depend on how the units were split.
+        """
+        return self.check(compute(lists, _RecordedEach(fun, self.checkpoints, self.stage.name, key), key=range_key,
+                                  **execution))
+
+    def sequential(self, units, fun, key=unit_key):
+        """ Pending units one by one, in order. Stops at the first failure, for stages whose state is carried from
+            one unit to the next.
+        """
+        recorded = self.recorded(fun, key)
+        for unit in self.pending(units, key):
+            recorded(unit)
+
+
+class Stage:
+    """ Step of the pipeline. It runs after the active stages that write its inputs (tables or stores).
+        run(params, stage_run) does the work, through stage_run so that completed units are skipped.
+    """
+    def __init__(self, name, inputs, outputs, active, run):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.active = active
+        self.run = run
+
+
+def _run_scraper(cls, name):
+    def run(params, stage_run):
+        config = params['scrapers'][name]
+        scraper = cls(config, params['db'])
+        scraper.build()
+        if config.get('backfill', {}).get('activate', False):
+            # Quarters are recorded when they are written, by this thread
+            scraper.elements = stage_run.pending(scraper.elements)
+            stage_run.check(scraper.process_backfill(stage_run.recorded(scraper.write_quarter)))
+        elif config.get('async', False):
+            # Elements are recorded when they are written, by the single writer thread
+            scraper.elements = stage_run.pending(scraper.elements)
+            scraper.upload = stage_run.recorded(scraper.upload)
+            stage_run.check(scraper.process_async())
+        else:
+            stage_run.compute(scraper.elements, scraper.scrape, **config.get('execution', {}))
+    return run
+
+
+def _run_raw_factors(params, stage_run):
+    params = dict(params, data_processing=dict(params['data_processing'], scale_factors=False))
+    processor = dataProcessing.DataProcessing(params)
+    execution = processor.params.get('execution', {}).get('raw_factors', {})
+    if processor.params.get('raw_factors_mode', 'symbol') == 'panel':
+        # Symbols are checkpointed one by one: panels change with the symbols left to compute
+        processor.elements = stage_run.pending(processor.elements)
+        stage_run.compute_lists(processor.get_panels(), processor.compute_raw_factors_panel, **execution)
+    else:
+        stage_run.compute(processor.elements, processor.compute_raw_factors, **execution)
+
+
+def _run_scaling(params, stage_run):
+    params = dict(params, data_processing=dict(params['data_processing'], compute_raw_factors=False))
+    processor = dataProcessing.DataProcessing(params)
+    execution = processor.params.get('execution', {})
+    if processor.params.get('cross_section_mode', 'date') == 'batch':
+        stage_run.compute(processor.get_date_blocks(), processor.process_cross_section_batch, range_key,
+                          **execution.get('cross_section_batch', {}))
+    else:
+        stage_run.compute(processor.dates, processor.process_cross_section, **execution.get('cross_section', {}))
+
+
+def _run_regression(params, stage_run):
+    reg = regression.Regression(params)
+    stage_run.compute(reg.blocks, reg.regress, range_key, **reg.params.get('execution', {}))
+
+
+def _run_alpha(params, stage_run):
+    forecaster = alpha.Alpha(params)
+    stage_run.sequential(forecaster.get_date_blocks(), forecaster.process_block, range_key)
+
+
+def _run_risk(params, stage_run):
+    risk = riskModel.RiskModel(params)
+    stage_run.sequential(risk.get_date_blocks(), risk.process_block, range_key)
+
+
+def _run_optimizer(params, stage_run):
+    opt = optimizer.Optimizer(params)
+    date = opt.get_date()
+    stage_run.sequential([date] if date is not None else [], lambda date: opt.process())
+
+
+def get_stages(params):
+    """ Stages of main, with the tables they read and write. """
+    scrapers = params['scrapers']
+    processing = params['data_processing']
+    return [
+        Stage('tiingo', ['symbols'], ['prices'], scrapers['tiingo']['activate'],
+              _run_scraper(webScraper.TiingoScraper, 'tiingo')),
+        Stage('iex', ['symbols'], ['prices'], scrapers['iex']['activate'],
+              _run_scraper(webScraper.IexScraper, 'iex')),
+        Stage('sec', ['sec_tags_main', 'sec_cik_symbol'],
+              ['sec_sub', 'sec_num', 'sec_fundamentals_pit', 'reg_factors_dirty'],
+              scrapers['sec']['activate'], _run_scraper(webScraper.SecScraper, 'sec')),
+        Stage('raw_factors', ['prices', 'sec_fundamentals_pit', 'reg_factors_dirty'],
+              ['reg_factors', 'reg_factors_long'],
+              processing['activate'] and processing['compute_raw_factors'], _run_raw_factors),
+        Stage('scaling', ['reg_factors'], ['reg_factors_scaled'],
+              processing['activate'] and processing['scale_factors'], _run_scaling),
+        Stage('regression', ['reg_factors_scaled', 'symbol_general_info'], ['reg_factor_returns', 'reg_residuals'],
+              params['regression']['activate'], _run_regression),
+        Stage('alpha', ['reg_factor_returns', 'reg_factors_scaled'], ['alpha_store'],
+              params['alpha']['activate'], _run_alpha),
+        Stage('risk', ['reg_factor_returns', 'reg_residuals', 'reg_factors_scaled'],
+              ['risk_factor_cov', 'risk_specific'], params['risk']['activate'], _run_risk),
+        Stage('optimizer', ['alpha_store', 'risk_factor_cov', 'risk_specific', 'portfolio_weights'],
+              ['portfolio_weights'], params['optimizer']['activate'], _run_optimizer),
+    ]
+
+
+class Pipeline:
+    """ Runs the active stages as a graph: a stage starts when the stages writing its inputs are done, and
+        independent stages (e.g. the Tiingo and SEC scrapers, or alpha and risk) run at the same time, up to
+        max_stages (profiled stages run alone). A stage fails when more than max_failed of its units fail, and the
+        stages after a failed one are skipped. Completed units are checkpointed, so running again with the same
+        run_id resumes where it stopped. Without a run_id, the last run that did not finish is resumed, or a new
+        run is started.
+    """
+    def __init__(self, params, stages=None):
+        self.params = params
+        self.config = params.get('pipeline', {})
+        self.stages = [stage for stage in (stages or get_stages(params)) if stage.active]
+        sql_manager = managerSQL.ManagerSQL(params['db'])
+        self.run_id = self.get_run_id(sql_manager)
+        self.checkpoints = Checkpoints(sql_manager, self.run_id)
+        if not self.config.get('resume', True):
+            self.checkpoints.clean()
+        self.checkpoints.start()
+        self.dependencies = self.get_dependencies()
+
+    def get_run_id(self, sql_manager):
+        """ run_id of the config, else the last unfinished run when resuming, else a new one. """
+        if self.config.get('run_id'):
+            return str(self.config['run_id'])
+        run_id = Checkpoints.unfinished(sql_manager) if self.config.get('resume', True) else None
+        if run_id is not None:
+            print('Resuming run ' + run_id)
+            return run_id
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def get_dependencies(self):
+        """ Names of the stages every stage waits for: earlier stages writing one of its inputs. """
+        dependencies = {}
+        for i, stage in enumerate(self.stages):
+            dependencies[stage.name] = {other.name for other in self.stages[:i]
+                                        if set(other.outputs) & set(stage.inputs)}
+        return dependencies
+
+    @staticmethod
+    def can_start(stage, running):
+        """ Profiled stages (instrumentation.exclusive) start when nothing else runs, and nothing starts with them. """
+        running = list(running)
+        return len(running) == 0 or not (instrumentation.exclusive(stage.name) or
+                                         any(instrumentation.exclusive(other.name) for other in running))
+
+    def run_stage(self, stage):
+        t0 = datetime.now()
+        print('\nStage {0} started'.format(stage.name))
+        try:
+            with instrumentation.profile(stage.name):
+                stage.run(self.params, StageRun(stage, self.checkpoints, self.config.get('max_failed', 0.05)))
+            t1 = datetime.now()
+            print('Stage {0} successful ({1:.2f} sec)'.format(stage.name, (t1 - t0).total_seconds()))
+        except Exception:
+            t1 = datetime.now()
+            print('Stage {0} failed ({1:.2f} sec)'.format(stage.name, (t1 - t0).total_seconds()))
+            raise
+
+    def run(self):
+        """ Runs every stage. Returns the names of the stages done, failed and skipped. """
+        done, failed, skipped = set(), set(), set()
+        waiting = list(self.stages)
+        running = {}
+        with futures.ThreadPoolExecutor(max_workers=self.config.get('max_stages', 3)) as ex:
+            while len(waiting) > 0 or len(running) > 0:
+                for stage in list(waiting):
+                    dependencies = self.dependencies[stage.name]
+                    if dependencies & (failed | skipped):
+                        print('Stage {0} skipped'.format(stage.name))
+                        skipped.add(stage.name)
+                        waiting.remove(stage)
+                    elif dependencies <= done and self.can_start(stage, running.values()):
+                        running[ex.submit(self.run_stage, stage)] = stage
+                        waiting.remove(stage)
+                if len(running) == 0:
+                    continue
+                finished, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+                for task in finished:
+                    stage = running.pop(task)
+                    if task.exception() is None:
+                        done.add(stage.name)
+                    else:
+                        print('Stage {0}: {1}: {2}'.format(stage.name, type(task.exception()).__name__,
+                                                            task.exception()))
+                        failed.add(stage.name)
+        if len(failed) == 0 and len(skipped) == 0:
+            self.checkpoints.finish()
+        return done, failed, skipped
@@ -0,0 +1,58 @@
+import pandas as pd
+import numpy as np
+
+
+class PointInTime:
+    """ Fundamentals sorted and indexed by (symbol, key) once, to be attached as-of to daily data.
+        key='ddate' uses the end date of the reported period.
+        key='filed' uses the filing date instead, so a value is only used once it was public (no look-ahead).
+    """
+    def __init__(self, df, columns, key='ddate'):
+        self.key = key
+        self.columns = list(columns)
+        keys = ['symbol', 'ddate'] if key == 'ddate' else ['symbol', 'ddate', key]
+        data = df[keys + self.columns].dropna(subset=keys)
+        data['ddate'] = pd.to_datetime(data['ddate'])
+        data[key] = pd.to_datetime(data[key])
+        if key == 'ddate':
+            data = data.sort_values(['symbol', 'ddate'], kind='mergesort')
+            data = data.drop_duplicates(subset=['symbol', 'ddate'], keep='first')
+        else:
+            # A filing about an older period (amendments) doesn't replace a newer period already published
+            data = data.sort_values(['symbol', key, 'ddate'], kind='mergesort')
+            data = data[data.ddate >= data.groupby('symbol').ddate.cummax()]
+            data = data.drop_duplicates(subset=['symbol', key], keep='last')
+        self.data = data[['symbol', key] + self.columns].reset_index(drop=True)
+
+        # Row range of every symbol in self.data
+        symbols, starts = np.unique(self.data.symbol.values, return_index=True)
+        ends = np.append(starts[1:], self.data.shape[0])
+        self.bounds = {s: (a, b) for s, a, b in zip(symbols, starts, ends)}
+
+    def get(self, symbols):
+        """ Returns the indexed rows of symbols. """
+        ranges = [self.bounds[s] for s in symbols if s in self.bounds]
+        if len(ranges) == len(self.bounds):
+            return self.data
+        if len(ranges) == 0:
+            return self.data.iloc[:0]
+        rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+        return self.data.iloc[rows]
+
+    def join(self, df, on='date'):
+        """ Attaches to every row of df the latest values with key strictly before df[on].
+            Rows keep their original order.
+        """
+        left = pd.DataFrame({
+            'symbol': np.asarray(df.symbol, dtype=object),
+            '_date': pd.to_datetime(df[on]).values,
+            '_row': np.arange(df.shape[0])})
+        left.sort_values('_date', kind='mergesort', inplace=True)
+        right = self.get(left.symbol.unique()).sort_values(self.key, kind='mergesort')
+        merged = pd.merge_asof(left, right, left_on='_date', right_on=self.key, by='symbol',
+                               allow_exact_matches=False, direction='backward')
+        merged.sort_values('_row', inplace=True)
+        df = df.copy()
+        for column in self.columns:
+            df[column] = merged[column].values
+        return df
@@ -1,10 +1,160 @@
-
 import pandas as pd
 import numpy as np
-from utilities import compute, compute_loop
+from datetime import datetime
+from utilities import compute, compute_loop, range_key
 import managerSQL
 
 
+def get_industries(sql_manager, column='office'):
+    """ Industry of every symbol, column ('office' or 'industry') of symbol_general_info. """
+    df = sql_manager.select_query('select symbol, ' + column + ' industry from symbol_general_info')
+    df = df.dropna().drop_duplicates(subset=['symbol'])
+    return dict(zip(df.symbol, df.industry))
+
+
+def exposure_matrix(df, industries, factors, styles):
+    """ Exposures (rows of df x factors): dummies of the industries in factors and the styles columns of df.
+        Symbols without industry are in 'Other', as in the regressions.
+    """
+    position = {factor: i for i, factor in enumerate(factors)}
+    x = np.zeros((df.shape[0], len(factors)))
+    industry = df.symbol.map(industries).fillna('Other')
+    cols = industry.map(position)
+    known = cols.notna().values
+    x[np.flatnonzero(known), cols[known].astype(int).values] = 1
+    for style in styles:
+        x[:, position[style]] = df[style].values
+    return x
+
+
 class Regression:
+    """ Cross-sectional regressions of returns on factor exposures, a weighted least squares problem per date.
+        Exposures are the scaled style factors of reg_factors_scaled and industry dummies. Dummies add up to one,
+        so there is no intercept.
+    """
     def __init__(self, params):
-        pass
+        self.params = params['regression']
+        self.sql_manager = managerSQL.ManagerSQL(params['db'])
+        self.styles = self.params.get('styles', ['mcap', 'pb', 'mom'])
+        if self.params.get('clean_regression', False):
+            self.sql_manager.clean_table('reg_factor_returns')
+            self.sql_manager.clean_table('reg_residuals')
+        self.industries = self.get_industries()
+        self.blocks = self.get_date_blocks()
+
+    def get_industries(self):
+        return get_industries(self.sql_manager, self.params.get('industry', 'office'))
+
+    def get_date_blocks(self):
+        """ [start, end] of every year from start_date to end_date with dates of reg_factors_scaled that are not in
+            reg_factor_returns yet. Blocks are checked one by one, as they may have run in any order.
+        """
+        start = pd.Timestamp(self.params['start_date'])
+        end = pd.Timestamp(self.params['end_date'])
+        scaled = self._dates('reg_factors_scaled', start, end)
+        done = self._dates('reg_factor_returns', start, end)
+        blocks = []
+        for year in range(start.year, end.year + 1):
+            block_start = max(start, pd.Timestamp(year, 1, 1))
+            block_end = min(end, pd.Timestamp(year, 12, 31))
+            pending = scaled[(scaled >= block_start) & (scaled <= block_end)].difference(done)
+            if block_start <= block_end and len(pending) > 0:
+                blocks.append([str(block_start.date()), str(block_end.date())])
+        return blocks
+
+    def _dates(self, table, start, end):
+        """ Distinct dates of table from start to end. """
+        df = self.sql_manager.select_query("select distinct date from {0} where date >= '{1}' and date <= '{2}'".format(
+            table, start.date(), end.date()))
+        return pd.DatetimeIndex(pd.to_datetime(df.date))
+
+    def process(self):
+        """ Main execution of Regression class. """
+        execution = self.params.get('execution', {})
+        compute(self.blocks, self.regress, key=range_key, **execution)
+
+    def regress(self, block):
+        """ Regressions of the dates of block not in reg_factor_returns yet. Residuals and factor returns are uploaded
+            in a single transaction, so a block is either done or left for the next run.
+        """
+        t0 = datetime.now()
+        label = '{0}..{1}'.format(block[0], block[1])
+
+        try:
+            query = "select * from reg_factors_scaled where date >= '{0}' and date <= '{1}'".format(block[0], block[1])
+            df = self.sql_manager.select_query(query)
+            df = df.dropna(subset=['ret', 'weight'] + self.styles)
+            done = self._dates('reg_factor_returns', pd.Timestamp(block[0]), pd.Timestamp(block[1]))
+            df = df[~pd.to_datetime(df.date).isin(done)]
+
+            if df.shape[0] > 0:
+                factor_returns, residuals = self.solve(df)
+
+                # Upload data to db
+                with self.sql_manager.transaction():
+                    self.sql_manager.upload_df('reg_residuals', residuals)
+                    self.sql_manager.upload_df('reg_factor_returns', factor_returns)
+
+            t1 = datetime.now()
+            print('Processing successful for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+
+        except Exception:
+            t1 = datetime.now()
+            print('Processing failed for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+            raise
+
+    def solve(self, df):
+        """ Weighted least squares of every date of df, stacked.
+            X'WX and X'Wy of all dates are accumulated with bincounts over (date, industry) cells, without building
+            the dummies, and the (dates x k x k) systems are solved at once with the pseudo-inverse
+            (industries missing on a date have zero rows and get no return).
+            Returns factor returns and t-stats in long format (date, factor, ret, tstat) and residuals.
+        """
+        codes, dates = pd.factorize(df.date)
+        industry = df.symbol.map(self.industries).fillna('Other')
+        ind_codes, industries = pd.factorize(industry, sort=True)
+        cells = codes * len(industries) + ind_codes
+        n_dates = len(dates)
+        n_ind = len(industries)
+        n_cells = n_dates * n_ind
+        k = n_ind + len(self.styles)
+
+        y = df.ret.values.astype(float)
+        w = df.weight.values.astype(float)
+        x = df[self.styles].values.astype(float)
+
+        xtwx = np.zeros((n_dates, k, k))
+        xtwy = np.zeros((n_dates, k))
+        counts = np.bincount(cells, weights=w, minlength=n_cells).reshape(n_dates, n_ind)
+        xtwx[:, np.arange(n_ind), np.arange(n_ind)] = counts
+        xtwy[:, :n_ind] = np.bincount(cells, weights=w * y, minlength=n_cells).reshape(n_dates, n_ind)
+        for a in range(len(self.styles)):
+            wa = w * x[:, a]
+            xtwx[:, :n_ind, n_ind + a] = np.bincount(cells, weights=wa, minlength=n_cells).reshape(n_dates, n_ind)
+            xtwx[:, n_ind + a, :n_ind] = xtwx[:, :n_ind, n_ind + a]
+            xtwy[:, n_ind + a] = np.bincount(codes, weights=wa * y, minlength=n_dates)
+            for b in range(a, len(self.styles)):
+                xtwx[:, n_ind + a, n_ind + b] = np.bincount(codes, weights=wa * x[:, b], minlength=n_dates)
+                xtwx[:, n_ind + b, n_ind + a] = xtwx[:, n_ind + a, n_ind + b]
+
+        inverse = np.linalg.pinv(xtwx)
+        beta = np.einsum('tab,tb->ta', inverse, xtwy)
+        resid = y - beta[codes, ind_codes] - np.einsum('ij,ij->i', x, beta[codes, n_ind:])
+
+        # Standard errors, observations with zero weight (outliers) don't count
+        n_obs = np.bincount(codes, weights=(w > 0), minlength=n_dates)
+        dof = n_obs - np.linalg.matrix_rank(xtwx)
+        sigma2 = np.bincount(codes, weights=w * resid ** 2, minlength=n_dates) / np.maximum(dof, 1)
+        variance = sigma2[:, None] * np.diagonal(inverse, axis1=1, axis2=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tstat = np.where((dof[:, None] > 0) & (variance > 0), beta / np.sqrt(variance), np.nan)
+
+        present = np.concatenate([counts > 0, np.ones((n_dates, len(self.styles)), dtype=bool)], axis=1)
+        factor_returns = pd.DataFrame({
+            'date': np.repeat(np.asarray(dates), k),
+            'factor': np.tile(list(industries) + self.styles, n_dates),
+            'ret': beta.ravel(),
+            'tstat': tstat.ravel()})
+        factor_returns = factor_returns[present.ravel()].reset_index(drop=True)
+        residuals = pd.DataFrame({'symbol': df.symbol.values, 'date': df.date.values, 'resid': resid, 'weight': w})
+        return factor_returns, residuals
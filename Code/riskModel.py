@@ -0,0 +1,280 @@
+import os
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import managerSQL
+import regression
+
+
+class FactorCovariance:
+    """ Asset covariance X F X' + D in factor form, never built as an (n x n) matrix.
+        symbols (n), factors (k), exposures X (n x k), cov F (k x k) and specific variances D (n).
+    """
+    def __init__(self, symbols, factors, exposures, cov, specific):
+        self.symbols = list(symbols)
+        self.factors = list(factors)
+        self.exposures = exposures
+        self.cov = cov
+        self.specific = specific
+
+    def dot(self, w):
+        """ Covariance times w in O(nk + k^2). """
+        return self.exposures.dot(self.cov.dot(self.exposures.T.dot(w))) + self.specific * w
+
+    def variance(self, w):
+        """ Variance of portfolio w. """
+        y = self.exposures.T.dot(w)
+        return y.dot(self.cov).dot(y) + (self.specific * w * w).sum()
+
+    def dense(self):
+        """ (n x n) covariance, only for small universes and checks. """
+        return self.exposures.dot(self.cov).dot(self.exposures.T) + np.diag(self.specific)
+
+
+class RiskModel:
+    """ Exponentially weighted factor covariance, with Newey-West lags, and specific variances of the residuals.
+        The model is a state of exponentially weighted sums updated with every date of reg_factor_returns and
+        reg_residuals in O(k^2) (O(n) for residuals), checkpointed to state_path after every year of dates.
+    """
+    def __init__(self, params):
+        self.params = params['risk']
+        self.sql_manager = managerSQL.ManagerSQL(params['db'])
+        self.lags = self.params.get('newey_west_lags', 2)
+        self.decay = 0.5 ** (1.0 / self.params.get('half_life', 90))
+        self.decay_specific = 0.5 ** (1.0 / self.params.get('half_life_specific', 42))
+        self.min_obs = self.params.get('min_specific_obs', 20)
+        self.state_path = self.params.get('state_path', '../Risk/risk_state.npz')
+        if self.params.get('clean_risk', False):
+            self.sql_manager.clean_table('risk_factor_cov')
+            self.sql_manager.clean_table('risk_specific')
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+        self.load_state()
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with np.load(self.state_path, allow_pickle=False) as state:
+                self.factors = list(state['factors'])
+                self.sums = state['sums']
+                self.mean_sum = state['mean_sum']
+                self.weight_sum = float(state['weight_sum'])
+                self.recent = state['recent']
+                self.n_days = int(state['n_days'])
+                self.last_date = str(state['last_date'])
+                self.symbols = list(state['symbols'])
+                self.specific_sums = state['specific_sums']
+                self.specific_weights = state['specific_weights']
+                self.specific_obs = state['specific_obs']
+                self.specific_last = state['specific_last']
+        else:
+            self.factors = []
+            self.sums = np.zeros((self.lags + 1, 0, 0))
+            self.mean_sum = np.zeros(0)
+            self.weight_sum = 0.0
+            self.recent = np.zeros((self.lags, 0))
+            self.n_days = 0
+            self.last_date = ''
+            self.symbols = []
+            self.specific_sums = np.zeros(0)
+            self.specific_weights = np.zeros(0)
+            self.specific_obs = np.zeros(0, dtype=np.int64)
+            self.specific_last = np.zeros(0, dtype=np.int64)
+        self.factor_index = {factor: i for i, factor in enumerate(self.factors)}
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def save_state(self):
+        """ Written to a temporary file and renamed, so a crash leaves the previous checkpoint. """
+        folder = os.path.dirname(self.state_path)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+        tmp = self.state_path + '.tmp.npz'
+        np.savez(tmp, factors=np.array(self.factors, dtype=str), sums=self.sums, mean_sum=self.mean_sum,
+                 weight_sum=self.weight_sum, recent=self.recent, n_days=self.n_days, last_date=self.last_date,
+                 symbols=np.array(self.symbols, dtype=str), specific_sums=self.specific_sums,
+                 specific_weights=self.specific_weights, specific_obs=self.specific_obs,
+                 specific_last=self.specific_last)
+        os.replace(tmp, self.state_path)
+
+    def get_date_blocks(self):
+        """ [start, end] of every year from start_date to end_date, after the last date of the state. """
+        start = pd.Timestamp(self.params['start_date'])
+        end = pd.Timestamp(self.params['end_date'])
+        if self.last_date != '':
+            start = max(start, pd.Timestamp(self.last_date) + pd.Timedelta(days=1))
+        blocks = []
+        for year in range(start.year, end.year + 1):
+            block_start = max(start, pd.Timestamp(year, 1, 1))
+            block_end = min(end, pd.Timestamp(year, 12, 31))
+            if block_start <= block_end:
+                blocks.append([str(block_start.date()), str(block_end.date())])
+        return blocks
+
+    def process(self):
+        """ Main execution of RiskModel class. Dates are processed in order, each year is uploaded and checkpointed. """
+        for block in self.get_date_blocks():
+            self.process_block(block)
+
+    def process_block(self, block):
+        t0 = datetime.now()
+        label = '{0}..{1}'.format(block[0], block[1])
+
+        try:
+            dates_range = "date >= '{0}' and date <= '{1}'".format(block[0], block[1])
+            factor_returns = self.sql_manager.select_query(
+                'select date, factor, ret from reg_factor_returns where ' + dates_range)
+            residuals = self.sql_manager.select_query(
+                'select symbol, date, resid from reg_residuals where weight > 0 and ' + dates_range)
+
+            if factor_returns.shape[0] > 0:
+                # Factors missing on a date (industry without symbols) have a zero return
+                returns = factor_returns.pivot(index='date', columns='factor', values='ret').fillna(0).sort_index()
+                self.add_factors(list(returns.columns))
+                self.add_symbols(residuals.symbol.unique())
+                columns = [self.factor_index[factor] for factor in returns.columns]
+                residuals = residuals[residuals.date.isin(returns.index)].sort_values('date')
+                dates = np.asarray(returns.index)
+                values = returns.values
+                starts = np.searchsorted(residuals.date.values, dates, 'left')
+                ends = np.searchsorted(residuals.date.values, dates, 'right')
+                rows = residuals.symbol.map(self.symbol_index).values
+                resid = residuals.resid.values.astype(float)
+
+                covariances = []
+                specifics = []
+                month = pd.DatetimeIndex(dates).month
+                for i, date in enumerate(dates):
+                    f = np.zeros(len(self.factors))
+                    f[columns] = values[i]
+                    self.update_factors(f)
+                    self.update_specific(rows[starts[i]:ends[i]], resid[starts[i]:ends[i]])
+                    self.last_date = str(date)
+                    covariances.append(self.factor_cov_long(date))
+                    if i == len(dates) - 1 or month[i + 1] != month[i]:
+                        specifics.append(self.specific_long(date))
+
+                # Upload data to db, replacing outputs of a run that failed before its checkpoint
+                self.sql_manager.query('delete from risk_factor_cov where ' + dates_range)
+                self.sql_manager.query('delete from risk_specific where ' + dates_range)
+                self.sql_manager.upload_df('risk_factor_cov', pd.concat(covariances, ignore_index=True))
+                self.sql_manager.upload_df('risk_specific', pd.concat(specifics, ignore_index=True))
+                self.save_state()
+
+            t1 = datetime.now()
+            print('Processing successful for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+
+        except Exception:
+            t1 = datetime.now()
+            print('Processing failed for {0} ({1:.2f} sec)'.format(label, (t1 - t0).total_seconds()))
+            raise
+
+    def add_factors(self, factors):
+        """ Factors seen for the first time start with zero sums. """
+        new = [factor for factor in factors if factor not in self.factor_index]
+        if len(new) > 0:
+            self.sums = np.pad(self.sums, [(0, 0), (0, len(new)), (0, len(new))], 'constant')
+            self.mean_sum = np.pad(self.mean_sum, (0, len(new)), 'constant')
+            self.recent = np.pad(self.recent, [(0, 0), (0, len(new))], 'constant')
+            self.factors += new
+            self.factor_index = {factor: i for i, factor in enumerate(self.factors)}
+
+    def add_symbols(self, symbols):
+        new = [symbol for symbol in symbols if symbol not in self.symbol_index]
+        if len(new) > 0:
+            self.specific_sums = np.pad(self.specific_sums, (0, len(new)), 'constant')
+            self.specific_weights = np.pad(self.specific_weights, (0, len(new)), 'constant')
+            self.specific_obs = np.pad(self.specific_obs, (0, len(new)), 'constant')
+            self.specific_last = np.pad(self.specific_last, (0, len(new)), 'constant')
+            self.symbols += new
+            self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def update_factors(self, f):
+        """ Adds the factor returns f of a new date to the sums of f_t f_{t-l}' (l = 0..lags) in O(k^2). """
+        self.sums *= self.decay
+        self.sums[0] += np.outer(f, f)
+        for lag in range(1, self.lags + 1):
+            if lag <= self.n_days:
+                self.sums[lag] += np.outer(f, self.recent[lag - 1])
+        self.mean_sum = self.decay * self.mean_sum + f
+        self.weight_sum = self.decay * self.weight_sum + 1
+        if self.lags > 0:
+            self.recent = np.vstack([f[None, :], self.recent[:-1]])
+        self.n_days += 1
+
+    def update_specific(self, rows, resid):
+        """ Adds the residuals of a new date. Sums of a symbol are decayed lazily, for the dates since its last one. """
+        decay = self.decay_specific ** (self.n_days - self.specific_last[rows])
+        self.specific_sums[rows] = self.specific_sums[rows] * decay + resid ** 2
+        self.specific_weights[rows] = self.specific_weights[rows] * decay + 1
+        self.specific_obs[rows] += 1
+        self.specific_last[rows] = self.n_days
+
+    def factor_cov(self):
+        """ Newey-West factor covariance: C_0 + sum_l (1 - l / (lags + 1)) (C_l + C_l'). """
+        if self.weight_sum == 0:
+            return np.zeros((len(self.factors), len(self.factors)))
+        mean = self.mean_sum / self.weight_sum
+        cov = self.sums[0] / self.weight_sum - np.outer(mean, mean)
+        for lag in range(1, self.lags + 1):
+            c = self.sums[lag] / self.weight_sum - np.outer(mean, mean)
+            cov += (1 - lag / (self.lags + 1.0)) * (c + c.T)
+        return cov
+
+    def specific_var(self):
+        """ Specific variance of every symbol, nan for symbols with less than min_obs residuals. """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = self.specific_sums / self.specific_weights
+        return np.where(self.specific_obs >= self.min_obs, var, np.nan)
+
+    def factor_cov_long(self, date):
+        """ Upper triangle of the factor covariance as (date, factor_1, factor_2, cov) rows. """
+        i, j = np.triu_indices(len(self.factors))
+        factors = np.array(self.factors)
+        return pd.DataFrame({'date': date, 'factor_1': factors[i], 'factor_2': factors[j],
+                             'cov': self.factor_cov()[i, j]})
+
+    def specific_long(self, date):
+        var = self.specific_var()
+        valid = ~np.isnan(var)
+        return pd.DataFrame({'symbol': np.array(self.symbols)[valid], 'date': date, 'var': var[valid]})
+
+    def asset_covariance(self, date=None, industries=None, styles=None):
+        """ FactorCovariance on date, from the state for its last date (default) and from the database otherwise. """
+        if industries is None:
+            industries = regression.get_industries(self.sql_manager, self.params.get('industry', 'office'))
+        date = str(date) if date is not None else self.last_date
+        if date != self.last_date:
+            return load_asset_covariance(self.sql_manager, date, industries, styles)
+        specific = pd.Series(self.specific_var(), index=self.symbols).dropna()
+        return build_asset_covariance(self.sql_manager, date, industries, styles, self.factors, self.factor_cov(),
+                                      specific)
+
+
+def load_asset_covariance(sql_manager, date, industries, styles=None):
+    """ FactorCovariance on date, with the last factor covariance and specific variances saved up to date. """
+    date = str(date)
+    df_cov = sql_manager.select_query(
+        "select * from risk_factor_cov where date = (select max(date) from risk_factor_cov where date <= '" +
+        date + "')")
+    factors = sorted(set(df_cov.factor_1) | set(df_cov.factor_2))
+    cov = df_cov.pivot(index='factor_1', columns='factor_2', values='cov').reindex(
+        index=factors, columns=factors).fillna(0).values
+    # Upper triangle in the model's order, which isn't sorted: fold both halves
+    cov = np.where(cov != 0, cov, cov.T)
+    df_var = sql_manager.select_query(
+        "select symbol, var from risk_specific where date = (select max(date) from risk_specific "
+        "where date <= '" + date + "')")
+    specific = df_var.set_index('symbol')['var']
+    return build_asset_covariance(sql_manager, date, industries, styles, factors, cov, specific)
+
+
+def build_asset_covariance(sql_manager, date, industries, styles, factors, cov, specific):
+    """ FactorCovariance of the symbols of reg_factors_scaled on date.
+        Symbols without specific variance get the median of the rest.
+    """
+    if styles is None:
+        styles = ['mcap', 'pb', 'mom']
+    df = sql_manager.select_query("select * from reg_factors_scaled where date = '" + str(date) + "'")
+    df = df.dropna(subset=styles).sort_values('symbol')
+    exposures = regression.exposure_matrix(df, industries, factors, styles)
+    var = df.symbol.map(specific).fillna(specific.median()).values
+    return FactorCovariance(df.symbol.values, factors, exposures, cov, var)
@@ -0,0 +1,152 @@
+import numpy as np
+
+
+def medcouple(y):
+    """ Medcouple of y, as statsmodels.stats.stattools.medcouple for 1-d data, in O(n log n) time and O(n) memory.
+        The median of the kernel matrix h(i, j) = (upper[i] + lower[j]) / (upper[i] - lower[j]) is found by
+        selection (Johnson and Mizoguchi) without building the matrix, whose rows are sorted.
+        Based on https://wis.kuleuven.be/stat/robust/papers/2004/medcouple.pdf
+    """
+    y = np.sort(np.asarray(y, dtype=float).ravel())
+    n = y.shape[0]
+    if n == 0:
+        return np.nan
+    if n % 2 == 0:
+        mf = (y[n // 2 - 1] + y[n // 2]) / 2
+    else:
+        mf = y[(n - 1) // 2]
+    z = y - mf
+    lower = z[z < 0]
+    upper = z[z > 0]
+    ties = n - lower.size - upper.size
+
+    # The matrix has a row for every z >= 0 and a column for every z <= 0
+    n_pairs = (upper.size + ties) * (lower.size + ties)
+    if n_pairs % 2 == 1:
+        return _kth(upper, lower, ties, n_pairs // 2)
+    return (_kth(upper, lower, ties, n_pairs // 2 - 1) + _kth(upper, lower, ties, n_pairs // 2)) / 2
+
+
+def _kernel(upper, lower):
+    return (upper + lower) / (upper - lower)
+
+
+def _kth(upper, lower, ties, k):
+    """ k-th smallest entry (from 0) of the kernel matrix.
+        Entries with a zero are constant: -1 for (0, lower), 1 for (upper, 0), and for the ties block (0, 0)
+        -1 above the anti-diagonal, 0 on it and 1 below. The rest of the matrix lies strictly between -1 and 1.
+    """
+    n_minus = ties * lower.size + ties * (ties - 1) // 2
+    n_strict = upper.size * lower.size
+
+    # Strict entries below zero (upper + lower < 0) and equal to zero
+    strict_less = np.searchsorted(lower, -upper, 'left').sum()
+    strict_zero = np.searchsorted(lower, -upper, 'right').sum() - strict_less
+
+    r = k - n_minus
+    if r < 0:
+        return -1.0
+    if r < strict_less:
+        return _select(upper, lower, r)
+    if r < strict_less + strict_zero + ties:
+        return 0.0
+    if r - ties < n_strict:
+        return _select(upper, lower, r - ties)
+    return 1.0
+
+
+def _select(upper, lower, k):
+    """ k-th smallest entry (from 0) of the strict kernel matrix, rows upper > 0 and columns lower < 0.
+        Rows increase along columns, and h < t if and only if lower < upper * (t - 1) / (t + 1), so the entries of
+        every row below a pivot are counted with a binary search on lower.
+    """
+    p = upper.size
+    lo = np.zeros(p, dtype=np.int64)
+    hi = np.full(p, lower.size, dtype=np.int64)
+    while True:
+        # Candidates of row i are columns lo[i] to hi[i] - 1, lo.sum() entries are below them
+        width = hi - lo
+        n_candidates = width.sum()
+        if n_candidates <= max(4 * p, 4096):
+            rows = np.repeat(np.arange(p), width)
+            cols = np.arange(n_candidates) - np.repeat(np.cumsum(width) - width - lo, width)
+            h = _kernel(upper[rows], lower[cols])
+            return np.partition(h, k - lo.sum())[k - lo.sum()]
+
+        # Pivot: median of the row medians weighted by the number of candidates of each row
+        active = width > 0
+        medians = _kernel(upper[active], lower[(lo[active] + hi[active] - 1) // 2])
+        order = np.argsort(medians)
+        weights = np.cumsum(width[active][order])
+        pivot = medians[order][np.searchsorted(weights, weights[-1] / 2.0)]
+
+        with np.errstate(divide='ignore'):
+            bound = upper * (pivot - 1) / (pivot + 1)
+        less = np.clip(np.searchsorted(lower, bound, 'left'), lo, hi)
+        less_equal = np.clip(np.searchsorted(lower, bound, 'right'), lo, hi)
+        if k < less.sum():
+            new_lo, new_hi = lo, less
+        elif k >= less_equal.sum():
+            new_lo, new_hi = less_equal, hi
+        else:
+            return pivot
+
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            # Rounding puts the pivot on the wrong side of itself, gather the candidates left
+            width = hi - lo
+            rows = np.repeat(np.arange(p), width)
+            cols = np.arange(width.sum()) - np.repeat(np.cumsum(width) - width - lo, width)
+            h = _kernel(upper[rows], lower[cols])
+            return np.partition(h, k - lo.sum())[k - lo.sum()]
+        lo, hi = new_lo, new_hi
+
+
+def subsample(y, n_sample=None):
+    """ n_sample evenly spaced order statistics of y, or y if it has at most n_sample values.
+        Deterministic, and it keeps the shape of the distribution (tails included).
+    """
+    y = np.asarray(y, dtype=float)
+    if n_sample is None or y.shape[0] <= n_sample:
+        return y
+    positions = np.round(np.linspace(0, y.shape[0] - 1, n_sample)).astype(np.int64)
+    return np.sort(y)[positions]
+
+
+def grouped_quantiles(values, codes, qs):
+    """ Quantiles qs of values within every group, interpolated linearly as np.percentile.
+        codes are group numbers from 0 to n_groups - 1 (pd.factorize). Every group must have values.
+        Returns an array (n_groups x len(qs)). Values are sorted once for all groups.
+    """
+    values = np.asarray(values, dtype=float)
+    codes = np.asarray(codes)
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    counts = np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    output = np.empty((counts.shape[0], len(qs)))
+    for j, q in enumerate(qs):
+        position = starts + q * (counts - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        output[:, j] = sorted_values[below] + (sorted_values[above] - sorted_values[below]) * (position - below)
+    return output
+
+
+def grouped_medcouple(values, codes, n_sample=None):
+    """ Medcouple of values within every group (see grouped_quantiles), each of at most n_sample values. """
+    values = np.asarray(values, dtype=float)
+    codes = np.asarray(codes)
+    order = np.argsort(codes, kind='mergesort')
+    counts = np.bincount(codes)
+    groups = np.split(values[order], np.cumsum(counts)[:-1])
+    return np.array([medcouple(subsample(group, n_sample)) for group in groups])
+
+
+def adjusted_fences(q1, q3, mc, a=1.5):
+    """ Bounds of the boxplot adjusted for skewness by the medcouple mc. Works on scalars and arrays.
+        Based on https://wis.kuleuven.be/stat/robust/papers/2008/outlierdetectionskeweddata-revision.pdf
+    """
+    iqr = q3 - q1
+    lo = np.where(mc > 0, q1 - a * np.exp(-4 * mc) * iqr, q1 - a * np.exp(-3 * mc) * iqr)
+    up = np.where(mc > 0, q3 + a * np.exp(3 * mc) * iqr, q3 + a * np.exp(4 * mc) * iqr)
+    return lo, up
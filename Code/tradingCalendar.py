@@ -0,0 +1,86 @@
+import threading
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import AbstractHolidayCalendar, Holiday, GoodFriday, USPresidentsDay, USMemorialDay, \
+    USLaborDay, USThanksgivingDay, nearest_workday, sunday_to_monday
+from pandas.tseries.offsets import DateOffset
+from dateutil.relativedelta import MO
+
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """ Full day holidays of the NYSE, with the current rules. Years before the 1990s are approximate. """
+    rules = [
+        Holiday('New Years Day', month=1, day=1, observance=sunday_to_monday),
+        Holiday('Martin Luther King Jr. Day', start_date='1998-01-01', month=1, day=1,
+                offset=DateOffset(weekday=MO(3))),
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', start_date='2022-01-01', month=6, day=19, observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas', month=12, day=25, observance=nearest_workday)]
+
+
+# Unscheduled closures (weather, national days of mourning, September 11)
+SPECIAL_CLOSURES = ['1985-09-27', '1994-04-27', '2001-09-11', '2001-09-12', '2001-09-13', '2001-09-14',
+                    '2004-06-11', '2007-01-02', '2012-10-29', '2012-10-30', '2018-12-05', '2025-01-09']
+
+
+class TradingCalendar:
+    """ NYSE sessions from start to end, numbered 0, 1, 2... once, so that lags in sessions (1 day, 1 month,
+        12 months) are integer offsets of these numbers instead of business day arithmetic.
+        Dates that are not sessions (weekends, holidays) have no number.
+    """
+    def __init__(self, start='1960-01-01', end=None):
+        end = end or pd.Timestamp.today().normalize() + pd.DateOffset(years=2)
+        holidays = NYSEHolidayCalendar().holidays(start, end).union(pd.to_datetime(SPECIAL_CLOSURES))
+        self.sessions = pd.bdate_range(start, end, freq='C', holidays=holidays)
+        self.values = self.sessions.values
+
+    def index(self, dates):
+        """ Session numbers of dates, -1 for dates that are not sessions. """
+        values = pd.to_datetime(np.asarray(dates)).values
+        positions = np.searchsorted(self.values, values)
+        found = np.take(self.values, positions, mode='clip') == values
+        return np.where(found, positions, -1)
+
+    def shift(self, dates, n):
+        """ Sessions n sessions after dates (before if n < 0), as datetime64. NaT for dates that are not sessions
+            or out of the calendar.
+        """
+        positions = self.index(dates)
+        shifted = positions + n
+        valid = (positions >= 0) & (shifted >= 0) & (shifted < len(self.values))
+        return np.where(valid, np.take(self.values, shifted, mode='clip'), np.datetime64('NaT'))
+
+    def offset(self, date, n):
+        """ Session n sessions after the last session on or before date (before if n < 0). """
+        position = np.searchsorted(self.values, np.datetime64(pd.Timestamp(date)), 'right') - 1 + n
+        return self.sessions[min(max(position, 0), len(self.values) - 1)]
+
+    def between(self, start, end):
+        """ Sessions from start to end, both included. """
+        return self.sessions[(self.sessions >= pd.Timestamp(start)) & (self.sessions <= pd.Timestamp(end))]
+
+    def previous(self, date):
+        """ Last session strictly before date (a session or not). """
+        return self.sessions[np.searchsorted(self.values, np.datetime64(pd.Timestamp(date)), 'left') - 1]
+
+    def next(self, date):
+        """ First session strictly after date (a session or not). """
+        return self.sessions[np.searchsorted(self.values, np.datetime64(pd.Timestamp(date)), 'right')]
+
+
+_calendar = None
+_calendar_lock = threading.Lock()
+
+
+def get_calendar():
+    """ Returns the process-wide TradingCalendar, building it the first time. """
+    global _calendar
+    with _calendar_lock:
+        if _calendar is None:
+            _calendar = TradingCalendar()
+        return _calendar
@@ -1,16 +1,155 @@
-
+import multiprocessing
+import pandas as pd
 from concurrent import futures
+from datetime import datetime
+import instrumentation
+import managerSQL
+
+# Function run by process pool workers, set once per worker to avoid pickling it with every chunk
+_worker_fun = None
+
+
+class ComputeSummary:
+    """ Results and exceptions of every element processed by compute, by the name key(element) gives it. """
+    def __init__(self, key=None):
+        self.key = key or _key
+        self.results = {}
+        self.errors = {}
+        self.n_chunks = 0
+        self.seconds = 0.0
+
+    def add(self, outputs):
+        self.n_chunks += 1
+        for arg, result, error in outputs:
+            key = self.key(arg)
+            if error is None:
+                self.results[key] = result
+            else:
+                self.errors[key] = error
+
+    def __str__(self):
+        lines = ['Processed {0} elements in {1} chunks ({2:.2f} sec): {3} successful, {4} failed'.format(
+            len(self.results) + len(self.errors), self.n_chunks, self.seconds, len(self.results), len(self.errors))]
+        for key, error in list(self.errors.items())[:20]:
+            lines.append('\t{0}: {1}'.format(key, error))
+        if len(self.errors) > 20:
+            lines.append('\t...')
+        return '\n'.join(lines)
+
+
+def _key(arg):
+    """ Hashable name of an element of args (symbols come as [symbol, last_date] lists). Lists of units (panels,
+        blocks of dates) are named by range_key.
+    """
+    if isinstance(arg, (list, tuple)):
+        return arg[0] if len(arg) > 0 else None
+    return arg
+
+
+def unit_key(unit):
+    """ Name of a unit: the symbol or quarter of scraper elements ([symbol, last_date]) and the date of dates. """
+    if isinstance(unit, (list, tuple)):
+        unit = unit[0]
+    if isinstance(unit, pd.Timestamp):
+        return str(unit.date())
+    return str(unit)
+
+
+def range_key(units):
+    """ Name of a list of units (a panel of symbols, a block of dates): its first and last elements. """
+    if len(units) == 0:
+        return ''
+    return '{0}..{1}'.format(unit_key(units[0]), unit_key(units[-1]))
+
+
+def _init_worker(fun):
+    global _worker_fun
+    _worker_fun = fun
+
+
+def _run_worker_chunk(chunk):
+    """ _run_chunk in a process pool worker. The measures of the chunk are sent back with its outputs. """
+    return _run_chunk(chunk), instrumentation.drain()
+
+
+def _run_chunk(chunk, fun=None):
+    """ Applies fun to every element of chunk. Returns (element, result, error) tuples. """
+    fun = fun or _worker_fun
+    outputs = []
+    for arg in chunk:
+        try:
+            outputs.append((arg, fun(arg), None))
+        except Exception as e:
+            outputs.append((arg, None, '{0}: {1}'.format(type(e).__name__, e)))
+    return outputs
+
+
+class SerialExecutor(futures.Executor):
+    """ Executor running every task in the calling thread when it is submitted, for profiled stages. """
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def compute(args, fun, max_workers=6, backend='thread', chunk_size=1, key=None):
+    """ General purpose parallel computing function.
+        backend: 'thread' (I/O bound work), 'process' (CPU bound work) or 'serial' (debugging).
+        Elements are sent to workers in chunks of chunk_size. Blocks until all work is done.
+        Stages under cProfile or tracemalloc always run serially (instrumentation.serial).
+        key(element) names the elements in the summary, range_key for lists of units.
+    """
+    if instrumentation.serial():
+        # Profiled stage: worker threads and processes would be missing from the profile
+        backend = 'serial'
+    print("\nProcessing {0} elements ({1}, {2} workers, chunks of {3})".format(
+        len(args), backend, max_workers, chunk_size))
+    t0 = datetime.now()
+    args = list(args)
+    chunks = [args[i:i + chunk_size] for i in range(0, len(args), chunk_size)]
+    summary = ComputeSummary(key)
 
+    if backend == 'serial':
+        for chunk in chunks:
+            summary.add(_run_chunk(chunk, fun))
+    else:
+        if backend == 'process':
+            # Spawned workers start clean, without connections inherited from this process
+            ex = futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(fun,))
+            tasks = [ex.submit(_run_worker_chunk, chunk) for chunk in chunks]
+        elif backend == 'thread':
+            ex = futures.ThreadPoolExecutor(max_workers=max_workers)
+            tasks = [ex.submit(_run_chunk, chunk, fun) for chunk in chunks]
+        else:
+            raise ValueError('Unknown backend ' + str(backend))
+        with ex:
+            for task, chunk in zip(tasks, chunks):
+                try:
+                    if backend == 'process':
+                        outputs, measures = task.result()
+                        instrumentation.merge(measures)
+                        summary.add(outputs)
+                    else:
+                        summary.add(task.result())
+                except Exception as e:
+                    # The worker itself failed (e.g. a killed process), every element of the chunk failed
+                    error = '{0}: {1}'.format(type(e).__name__, e)
+                    summary.add([(arg, None, error) for arg in chunk])
+        if backend == 'process':
+            # Writes of the workers didn't go through the query cache of this process
+            managerSQL.clear_caches()
 
-def compute(args, fun, max_workers=6):
-    """ General purpose parallel computing function. """
-    print("\nProcessing symbols in parallel")
-    ex = futures.ThreadPoolExecutor(max_workers=max_workers)
-    ex.map(fun, args)
+    summary.seconds = (datetime.now() - t0).total_seconds()
+    print(summary)
+    return summary
 
 
 def compute_loop(args, fun):
     """ For debugging purposes. """
     print("\nProcessing symbols one by one")
     for symbol in args:
-        fun(symbol)
\ No newline at end of file
+        fun(symbol)
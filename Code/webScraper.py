@@ -4,16 +4,28 @@ import numpy as np
 from datetime import datetime
 import requests
 import json
-from pandas.tseries.offsets import BDay
 import pandas_datareader as pdr
 import zipfile
 import io
-from utilities import compute, compute_loop
+import tempfile
+import multiprocessing
+from concurrent import futures
+from utilities import compute, compute_loop, ComputeSummary, SerialExecutor
+from downloader import AsyncDownloader
 import managerSQL
+import instrumentation
+from tradingCalendar import get_calendar
 
 pd.options.mode.chained_assignment = None
 
 
+def _download_quarter(scraper, period):
+    """ SecScraper.download_quarter in a process pool worker. The measures are sent back with the data. """
+    with instrumentation.unit('scrape', period):
+        data = scraper.download_quarter(period)
+    return data, instrumentation.drain()
+
+
 # noinspection PyAttributeOutsideInit
 class WebScraper:
     def __init__(self, scraper_config, sql_config):
@@ -21,7 +33,8 @@ class WebScraper:
         self.limit_reached = False
         self.sql_manager = managerSQL.ManagerSQL(sql_config)
         self.today = pd.datetime.today().date()
-        self.last_business_date = (self.today - BDay(1)).date()
+        self.calendar = get_calendar()
+        self.last_business_date = self.calendar.previous(self.today).date()
         self.min_date = pd.to_datetime('1960-01-01').date()
 
     def build(self):
@@ -36,55 +49,94 @@ class WebScraper:
         return lst
 
     def process(self):
-        compute(self.elements, self.scrape)
+        if self.scraper_config.get('async', False):
+            self.process_async()
+        else:
+            compute(self.elements, self.scrape, **self.scraper_config.get('execution', {}))
+
+    def process_async(self):
+        """ Downloads all elements with an AsyncDownloader, decoupled from the uploads to the db. """
+        downloader = AsyncDownloader(**self.scraper_config.get('downloader', {}))
+        summary = downloader.run(self.elements, self.request_url, self.parse, self.upload)
+        self.limit_reached = downloader.limit_reached
+        return summary
 
     def scrape(self, args):
         """ Overwrite this method with child class definition. """
         pass
 
+    def request_url(self, args):
+        """ Url to download for args, None if there is nothing to download. Overwrite for async downloads. """
+        return None
+
+    def parse(self, args, payload):
+        """ DataFrame to upload from the downloaded JSON payload. Overwrite for async downloads. """
+        return None
+
+    def upload(self, args, data):
+        self.sql_manager.upload_df('prices', data)
+        print('Download successful for {0} ({1} rows)'.format(args[0], data.shape[0]))
+
 
 # noinspection PyAttributeOutsideInit
 class IexScraper(WebScraper):
     def build(self):
         super().build()
-        self.base_url = r'https://cloud.iexapis.com/stable/stock/'
+        self.base_url = self.scraper_config.get('base_url', r'https://cloud.iexapis.com/stable/stock/')
         self.api_key = self.scraper_config['api_key']
 
+    @instrumentation.measured('scrape')
     def scrape(self, args):
         symbol = args[0]
         last_date = args[1]
         if not self.limit_reached:
-            if last_date is None or last_date < self.last_business_date:
-                horizon = self.get_horizon(last_date)
-                daily_url = self.base_url + symbol + '/chart/' + horizon + '?token=' + self.api_key
+            daily_url = self.request_url(args)
+            if daily_url is not None:
                 try:
                     # Download data
                     t0 = datetime.now()
-                    with requests.Session() as s:
+                    with instrumentation.timer('network'), requests.Session() as s:
                         download = s.get(daily_url)
-                        decoded_content = download.content.decode('utf-8')
-                        data = json.loads(decoded_content)
-                        data = pd.DataFrame(data)[['date', 'open', 'close', 'volume']]
-                        if last_date is not None:
-                            data = data[pd.to_datetime(data.date) > pd.Timestamp(last_date)]
-                        data.rename(columns={
-                            'date': 'trade_date',
-                            'open': 'open_price',
-                            'close': 'close_price'}, inplace=True)
-                        data['symbol'] = symbol
-                        data['data_source'] = 'iex'
-                        columns = ['symbol', 'trade_date', 'open_price', 'close_price', 'volume', 'data_source']
-                        data = data[columns]
+                        if download.status_code in (402, 429):
+                            self.limit_reached = True
+                    instrumentation.count('bytes', len(download.content))
+                    decoded_content = download.content.decode('utf-8')
+                    data = self.parse(args, json.loads(decoded_content))
+                    instrumentation.count('rows', data.shape[0])
 
                     # Upload data to db
                     self.sql_manager.upload_df('prices', data)
 
                     t1 = datetime.now()
-                    print('Download successful for {0} ({1:.2f} sec)'.format(symbol, (t1 - t0).total_seconds()))
+                    instrumentation.log('Download successful for {0} ({1:.2f} sec)'.format(
+                        symbol, (t1 - t0).total_seconds()))
 
-                except Exception as e:
-                    print('Download failed for {}. Tried: {}'.format(symbol, daily_url))
-                    print(e)
+                except Exception:
+                    instrumentation.log('Download failed for {}. Tried: {}'.format(symbol, daily_url))
+                    raise
+
+    def request_url(self, args):
+        symbol = args[0]
+        last_date = args[1]
+        if last_date is None or last_date < self.last_business_date:
+            horizon = self.get_horizon(last_date)
+            return self.base_url + symbol + '/chart/' + horizon + '?token=' + self.api_key
+        return None
+
+    def parse(self, args, payload):
+        symbol = args[0]
+        last_date = args[1]
+        data = pd.DataFrame(payload)[['date', 'open', 'close', 'volume']]
+        if last_date is not None:
+            data = data[pd.to_datetime(data.date) > pd.Timestamp(last_date)]
+        data.rename(columns={
+            'date': 'trade_date',
+            'open': 'open_price',
+            'close': 'close_price'}, inplace=True)
+        data['symbol'] = symbol
+        data['data_source'] = 'iex'
+        columns = ['symbol', 'trade_date', 'open_price', 'close_price', 'volume', 'data_source']
+        return data[columns]
 
     def get_horizon(self, last_date):
         # 5y, 2y, 1y, ytd, 6m, 3m, 1m, 5d
@@ -109,8 +161,33 @@ class IexScraper(WebScraper):
 class TiingoScraper(WebScraper):
     def build(self):
         super().build()
+        self.base_url = self.scraper_config.get('base_url', r'https://api.tiingo.com/tiingo/daily/')
         self.api_key = self.scraper_config['api_key']
 
+    def request_url(self, args):
+        symbol = args[0]
+        last_date = args[1]
+        if last_date is None or last_date < self.last_business_date:
+            if last_date is None:
+                min_date = self.min_date
+            else:
+                min_date = self.calendar.next(last_date).date()
+            return self.base_url + symbol + '/prices?startDate=' + str(min_date) + \
+                '&endDate=' + str(self.last_business_date) + '&token=' + self.api_key
+        return None
+
+    def parse(self, args, payload):
+        if len(payload) == 0:
+            return None
+        cols = ['date', 'open', 'close', 'adjClose', 'divCash', 'volume', 'splitFactor']
+        data = pd.DataFrame(payload)[cols]
+        data.insert(0, 'symbol', args[0])
+        data['date'] = pd.to_datetime(data['date']).dt.date
+        data.rename(columns={'splitFactor': 'split'}, inplace=True)
+        data.columns = [col.lower() for col in data.columns]
+        return data
+
+    @instrumentation.measured('scrape')
     def scrape(self, args):
         symbol = args[0]
         last_date = args[1]
@@ -121,28 +198,34 @@ class TiingoScraper(WebScraper):
                     if last_date is None:
                         min_date = self.min_date
                     else:
-                        min_date = last_date + BDay(1)
-                    data = pdr.get_data_tiingo(symbol, min_date, self.last_business_date, api_key=self.api_key)
+                        min_date = self.calendar.next(last_date).date()
+                    with instrumentation.timer('network'):
+                        data = pdr.get_data_tiingo(symbol, min_date, self.last_business_date, api_key=self.api_key)
                     # adjClose adjHigh adjLow adjOpen adjVolume close divCash high low open splitFactor volume
                     cols = ['symbol', 'date', 'open', 'close', 'adjClose', 'divCash', 'volume', 'splitFactor']
                     data = data.reset_index()[cols]
                     data['date'] = data['date'].dt.date
                     data.rename(columns={'splitFactor': 'split'}, inplace=True)
                     data.columns = [col.lower() for col in data.columns]
+                    instrumentation.count('rows', data.shape[0])
 
                     # Upload data to db
                     self.sql_manager.upload_df('prices', data)
 
                     t1 = datetime.now()
-                    print('Download successful for {0} ({1:.2f} sec)'.format(symbol, (t1 - t0).total_seconds()))
+                    instrumentation.log('Download successful for {0} ({1:.2f} sec)'.format(
+                        symbol, (t1 - t0).total_seconds()))
 
-                except Exception as e:
-                    print('Download failed for {}'.format(symbol))
-                    print(e)
+                except Exception:
+                    instrumentation.log('Download failed for {}'.format(symbol))
+                    raise
 
 
 # noinspection PyAttributeOutsideInit
 class SecScraper(WebScraper):
+    # Data sets of a quarter, written together
+    tables = ['sec_sub', 'sec_num_bal', 'sec_num_res', 'sec_num_shr']
+
     def build(self):
         self.sub_files = self.sql_manager.select_distinct_column_list('query', 'sec_sub')
         df = self.sql_manager.select('sec_tags_main').iloc[:, :]
@@ -150,7 +233,11 @@ class SecScraper(WebScraper):
         self.col_bal = list(df[df.tab == 'bal']['col'])
         self.col_res = list(df[df.tab == 'res']['col'])
         self.col_shr = list(df[df.tab == 'shr']['col'])
+        self.cik_symbol = self.sql_manager.select_as_dictionary('cik', 'symbol', 'sec_cik_symbol')
         self.elements = self.get_elements_to_download()
+        if len(self.sub_files) > 0 and self.sql_manager.select_query(
+                'select 1 from sec_fundamentals_pit limit 1').shape[0] == 0:
+            self.backfill_fundamentals()
 
     def get_elements_to_download(self):
         now = datetime.now()
@@ -170,41 +257,150 @@ class SecScraper(WebScraper):
             lst.remove(['2009q1'])
         return lst
 
+    def process(self):
+        if self.scraper_config.get('backfill', {}).get('activate', False):
+            self.process_backfill()
+        else:
+            super().process()
+
+    @instrumentation.measured('scrape')
     def scrape(self, args):
         period = args[0]
-        sec_quarter_url = 'https://www.sec.gov/files/dera/data/financial-statement-data-sets/' + period + '.zip'
-
+        t0 = datetime.now()
         try:
-            print('Downloading {0}'.format(period))
-            t0 = datetime.now()
-            with requests.Session() as s:
-                download = s.get(sec_quarter_url)
-                zip_file = zipfile.ZipFile(io.BytesIO(download.content))
-                zip_file.extractall()
-                sub_file = zip_file.open('sub.txt')
-                num_file = zip_file.open('num.txt')
-                sub_type = {'adsh': str, 'cik': int, 'name': str, 'sic': object, 'countryba': str, 'stprba': str,
-                            'fye': str, 'form': str, 'period': str, 'fy': object, 'fp': str, 'filed': str}
-                num_type = {'adsh': str, 'tag': str, 'version': str, 'ddate': str, 'qtrs': int, 'uom': str,
-                            'coreg': str, 'value': float}
-                sub_df = pd.read_csv(sub_file, sep='\t', encoding='ISO-8859-1', dtype=sub_type)
-                num_df = pd.read_csv(num_file, sep='\t', encoding='ISO-8859-1', dtype=num_type)
-
-                if period not in self.sub_files:
-                    # Submission data set
-                    self.upload_sub(sub_df, period)
-
-                    # Number data set
-                    self.upload_num(num_df, period)
-
+            self.write_quarter(period, self.download_quarter(period))
+            t1 = datetime.now()
+            instrumentation.log('Download successful for {0} ({1:.2f} sec)'.format(
+                period, (t1 - t0).total_seconds()))
+
+        except Exception:
+            instrumentation.log('Download failed for {}'.format(period))
+            raise
+
+    def process_backfill(self, write=None):
+        """ Loads many quarters (e.g. 2009 to today) at once. Quarters are downloaded and parsed in max_workers
+            processes, and written by this process alone as they arrive, each in a single transaction
+            (write, write_quarter by default). Quarters that fail are downloaded again up to retries times.
+            A failed quarter leaves nothing behind, so the next run loads it again.
+        """
+        write = write or self.write_quarter
+        config = self.scraper_config.get('backfill', {})
+        retries = config.get('retries', 2)
+        periods = [element[0] for element in self.elements]
+        print('\nBackfilling {0} quarters ({1} workers)'.format(len(periods), config.get('max_workers', 4)))
+        t0 = datetime.now()
+        summary = ComputeSummary()
+        attempts = {period: 0 for period in periods}
+        if instrumentation.serial():
+            ex = SerialExecutor()
+        else:
+            ex = futures.ProcessPoolExecutor(max_workers=config.get('max_workers', 4),
+                                             mp_context=multiprocessing.get_context('spawn'))
+        with ex:
+            running = {ex.submit(_download_quarter, self, period): period for period in periods}
+            while len(running) > 0:
+                finished, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+                for task in finished:
+                    period = running.pop(task)
+                    attempts[period] += 1
                     t1 = datetime.now()
-                    print('Download successful for {0} ({1:.2f} sec)'.format(period, (t1 - t0).total_seconds()))
-
-        except Exception as e:
-            print('Download failed for {}'.format(period))
-            print(e)
+                    try:
+                        data, measures = task.result()
+                        instrumentation.merge(measures)
+                        write(period, data)
+                        summary.add([(period, None, None)])
+                        instrumentation.log('Quarter {0} written ({1}/{2}, {3:.2f} sec)'.format(
+                            period, len(summary.results), len(periods), (datetime.now() - t1).total_seconds()))
+                    except Exception as e:
+                        error = '{0}: {1}'.format(type(e).__name__, e)
+                        if attempts[period] <= retries:
+                            instrumentation.log('Quarter {0} failed, retrying ({1})'.format(period, error))
+                            running[ex.submit(_download_quarter, self, period)] = period
+                        else:
+                            instrumentation.log('Quarter {0} failed ({1})'.format(period, error))
+                            summary.add([(period, None, error)])
+        summary.seconds = (datetime.now() - t0).total_seconds()
+        print(summary)
+        return summary
+
+    def download_quarter(self, period):
+        """ Data sets of a quarter ready to upload (see parse_quarter). Restored from the local store if a previous
+            run saved it, downloaded otherwise.
+        """
+        data = self.read_store(period)
+        if data is not None:
+            instrumentation.log('Restored {0} from local store'.format(period))
+            return data
 
-    def upload_sub(self, sub_df, period):
+        sec_quarter_url = 'https://www.sec.gov/files/dera/data/financial-statement-data-sets/' + period + '.zip'
+        instrumentation.log('Downloading {0}'.format(period))
+        with requests.Session() as s:
+            if self.scraper_config.get('streaming', False):
+                # Zip spilled to a temporary file instead of memory
+                with tempfile.TemporaryFile() as zip_file:
+                    with instrumentation.timer('network'), s.get(sec_quarter_url, stream=True) as download:
+                        download.raise_for_status()
+                        for block in download.iter_content(chunk_size=1 << 20):
+                            zip_file.write(block)
+                    instrumentation.count('bytes', zip_file.tell())
+                    zip_file.seek(0)
+                    return self.parse_quarter(zip_file, period)
+            else:
+                with instrumentation.timer('network'):
+                    download = s.get(sec_quarter_url)
+                instrumentation.count('bytes', len(download.content))
+                return self.parse_quarter(io.BytesIO(download.content), period)
+
+    def ingest(self, file, period):
+        """ Uploads the sub and num data sets of a quarterly zip file. """
+        if period not in self.sub_files:
+            self.write_quarter(period, self.parse_quarter(file, period))
+
+    def parse_quarter(self, file, period):
+        """ Data sets of a quarterly zip file, as the rows of sec_sub, sec_num_bal, sec_num_res and sec_num_shr.
+            With streaming, num.txt is read in chunks of chunk_size rows and aggregated chunk by chunk.
+        """
+        zip_file = zipfile.ZipFile(file)
+        sub_file = zip_file.open('sub.txt')
+        num_file = zip_file.open('num.txt')
+        sub_type = {'adsh': str, 'cik': int, 'name': str, 'sic': object, 'countryba': str, 'stprba': str,
+                    'fye': str, 'form': str, 'period': str, 'fy': object, 'fp': str, 'filed': str}
+        num_type = {'adsh': str, 'tag': str, 'version': str, 'ddate': str, 'qtrs': int, 'uom': str,
+                    'coreg': str, 'value': float}
+        sub_df = pd.read_csv(sub_file, sep='\t', encoding='ISO-8859-1', dtype=sub_type)
+
+        # Submission data set
+        data = {'sec_sub': self.parse_sub(sub_df, period)}
+
+        # Number data set
+        if self.scraper_config.get('streaming', False):
+            num_chunks = pd.read_csv(num_file, sep='\t', encoding='ISO-8859-1', dtype=num_type,
+                                     chunksize=self.scraper_config.get('chunk_size', 500000))
+            data_num = self.parse_num_stream(num_chunks)
+        else:
+            num_df = pd.read_csv(num_file, sep='\t', encoding='ISO-8859-1', dtype=num_type)
+            data_num = self.parse_num(num_df)
+        data.update(zip(['sec_num_bal', 'sec_num_res', 'sec_num_shr'], data_num))
+        return data
+
+    @instrumentation.measured('write_quarter')
+    def write_quarter(self, period, data):
+        """ Uploads the data sets of a quarter, with its fundamentals and dirty flags, in a single transaction.
+            A quarter is only counted as loaded (in sec_sub) once all of it is. Saved to the local store afterwards.
+        """
+        with self.sql_manager.transaction():
+            for table in self.tables:
+                self.sql_manager.upload_df(table, data[table])
+            self.upload_fundamentals(data['sec_sub'], data['sec_num_bal'], data['sec_num_shr'])
+            self.mark_dirty(data['sec_sub'], data['sec_num_bal'], data['sec_num_shr'])
+        store = self.sql_manager.store
+        for table in self.tables:
+            if store is None or period not in store.partitions(table):
+                self.sql_manager.store_partition(table, 'query', period, data[table])
+        self.sub_files.append(period)
+        instrumentation.log('\tUpload successful for {0} ({1} filings)'.format(period, data['sec_sub'].shape[0]))
+
+    def parse_sub(self, sub_df, period):
         """
         adsh: Identifier of the submission.
         cik: Central Index Key. Identifier of the registrant.
@@ -230,13 +426,18 @@ class SecScraper(WebScraper):
         data = data.astype(values)
         data['period'] = data['period'].apply(lambda r: r[:8])
         data['fye'] = data['fye'].apply(lambda r: r[:4])
-
-        # Upload data to db
-        self.sql_manager.upload_df('sec_sub', data)
-
-        print('\tDownload successful for sub {0}'.format(period))
+        return data
 
     def upload_num(self, num_df, period):
+        """ Uploads the num data set of a quarter (sec_num_bal, sec_num_res and sec_num_shr) in a transaction. """
+        data = self.parse_num(num_df)
+        with self.sql_manager.transaction():
+            for table, data_num in zip(['sec_num_bal', 'sec_num_res', 'sec_num_shr'], data):
+                self.sql_manager.upload_df(table, data_num)
+        return data
+
+    @instrumentation.measured('parse_num')
+    def parse_num(self, num_df):
         """
         adsh: Identifier of the submission.
         tag: Identifier (name) for an account.
@@ -247,44 +448,189 @@ class SecScraper(WebScraper):
         coreg: Coregistrant of the parent company registrant.
         value: The value.
         """
-        columns = ['adsh', 'tag', 'version', 'ddate', 'qtrs', 'uom', 'coreg', 'value']
-        data = num_df[columns]
-        data = data[data.tag.isin(self.tags.keys())]
-        data.dropna(subset=['adsh', 'version', 'tag', 'ddate', 'qtrs', 'uom', 'value'], inplace=True)
-        values = {'ddate': str, 'qtrs': int, 'coreg': str}
-        data = data.astype(values)
+        instrumentation.count('rows', num_df.shape[0])
+        data = self._filter_num(num_df)
+        data_bal_pvt, data_res_pvt, data_shr_pvt = self._pivot_num(data)
+        return self._format_num_pivots(data_bal_pvt, data_res_pvt, data_shr_pvt)
+
+    @staticmethod
+    def _pivot_num(data):
+        """ Mean value per index and tag of the bal (qtrs 0), res and shr (uom shares) rows of data, in one pass.
+            Same tables as pivot_table(values='value', columns='tag', aggfunc=np.mean) with index
+            [adsh, uom, ddate], [adsh, uom, ddate, qtrs] and [adsh, ddate, qtrs].
+            Columns are encoded as sorted integer codes and every (table, index, tag) cell as a single int64 key,
+            so a single groupby mean replaces the three pivots. Keys sort as the values, so rows and columns come in
+            the order of pivot_table.
+        """
+        adsh_codes, adsh = pd.factorize(data.adsh, sort=True)
+        uom_codes, uom = pd.factorize(data.uom, sort=True)
+        ddate_codes, ddate = pd.factorize(data.ddate, sort=True)
+        qtrs_codes, qtrs = pd.factorize(data.qtrs, sort=True)
+        tag_codes, tags = pd.factorize(data.tag, sort=True)
+        shares = (data.uom == 'shares').values
+        table = np.where(shares, 2, np.where(data.qtrs.values == 0, 0, 1))
+
+        # Shares don't have uom in their index, bal rows have a single qtrs
+        dims = (max(len(adsh), 1), max(len(uom), 1), max(len(ddate), 1), max(len(qtrs), 1))
+        rows = np.ravel_multi_index((adsh_codes, np.where(shares, 0, uom_codes), ddate_codes, qtrs_codes), dims)
+        n_rows = int(np.prod(dims))
+        n_tags = max(len(tags), 1)
+        keys = (table * n_rows + rows) * n_tags + tag_codes
+        means = data.value.groupby(keys, sort=True).mean()
+
+        keys = means.index.values
+        cell_tags = keys % n_tags
+        cell_rows = keys // n_tags % n_rows
+        cell_tables = keys // n_tags // n_rows
+        indexes = [['adsh', 'uom', 'ddate'], ['adsh', 'uom', 'ddate', 'qtrs'], ['adsh', 'ddate', 'qtrs']]
+        pivots = []
+        for t, names in enumerate(indexes):
+            selected = cell_tables == t
+            index, positions = np.unique(cell_rows[selected], return_inverse=True)
+            columns = np.unique(cell_tags[selected])
+            values = np.full((len(index), len(columns)), np.nan)
+            values[positions, np.searchsorted(columns, cell_tags[selected])] = means.values[selected]
+            a, u, d, q = np.unravel_index(index, dims)
+            levels = {'adsh': adsh[a], 'uom': uom[u], 'ddate': ddate[d], 'qtrs': qtrs[q]}
+            pivots.append(pd.DataFrame(values, columns=pd.Index(tags[columns], name='tag'),
+                                       index=pd.MultiIndex.from_arrays([levels[name] for name in names], names=names)))
+        return pivots
+
+    @instrumentation.measured('parse_num')
+    def parse_num_stream(self, num_chunks):
+        """ Same as parse_num, for num.txt read in chunks.
+            Each chunk is filtered to self.tags and reduced to sums and counts per (adsh, uom, ddate, qtrs, tag),
+            so memory doesn't grow with the size of the file.
+        """
+        index = ['adsh', 'uom', 'ddate', 'qtrs', 'tag']
+        partials = []
+        for num_df in num_chunks:
+            instrumentation.count('rows', num_df.shape[0])
+            data = self._filter_num(num_df)
+            if not data.empty:
+                partials.append(data.groupby(index).value.agg(['sum', 'count']))
+        if len(partials) == 0:
+            # num.txt without data rows, or none with a tag in self.tags
+            empty = pd.MultiIndex.from_arrays([[]] * len(index), names=index)
+            partials.append(pd.DataFrame({'sum': [], 'count': []}, index=empty))
+        totals = pd.concat(partials).groupby(level=index).sum()
+        data = (totals['sum'] / totals['count']).rename('value').reset_index()
         data_shr = data[data.uom == 'shares']
         data_mon = data[data.uom != 'shares']
         data_bal = data_mon[data_mon.qtrs == 0]
         data_res = data_mon[data_mon.qtrs != 0]
 
-        # Pivot
-        index_bal = ['adsh', 'uom', 'ddate']
-        index_res = ['adsh', 'uom', 'ddate', 'qtrs']
-        index_shr = ['adsh', 'ddate', 'qtrs']
-        data_bal_pvt = data_bal.pivot_table(values='value', index=index_bal, columns='tag', aggfunc=np.mean)
-        data_res_pvt = data_res.pivot_table(values='value', index=index_res, columns='tag', aggfunc=np.mean)
-        data_shr_pvt = data_shr.pivot_table(values='value', index=index_shr, columns='tag', aggfunc=np.mean)
+        # Pivot, values are already unique per index and tag
+        data_bal_pvt = data_bal.set_index(['adsh', 'uom', 'ddate', 'tag']).value.unstack('tag')
+        data_res_pvt = data_res.set_index(['adsh', 'uom', 'ddate', 'qtrs', 'tag']).value.unstack('tag')
+        data_shr_pvt = data_shr.set_index(['adsh', 'ddate', 'qtrs', 'tag']).value.unstack('tag')
+        return self._format_num_pivots(data_bal_pvt, data_res_pvt, data_shr_pvt)
+
+    def _filter_num(self, num_df):
+        """ Rows of num_df with tags in self.tags and no missing values. """
+        columns = ['adsh', 'tag', 'version', 'ddate', 'qtrs', 'uom', 'coreg', 'value']
+        data = num_df.loc[num_df.tag.isin(self.tags.keys()).values, columns]
+        # Column by column, dropna would turn the mixed columns into a single object array
+        required = ['adsh', 'version', 'tag', 'ddate', 'qtrs', 'uom', 'value']
+        data = data[np.logical_and.reduce([data[col].notna().values for col in required])]
+        values = {'ddate': str, 'qtrs': int, 'coreg': str}
+        return data.astype(values)
+
+    def _format_num_pivots(self, data_bal_pvt, data_res_pvt, data_shr_pvt):
         data_bal_pvt.rename(columns=self.tags, inplace=True)
         data_res_pvt.rename(columns=self.tags, inplace=True)
         data_shr_pvt.rename(columns=self.tags, inplace=True)
         data_bal_pvt = data_bal_pvt.div(1000)
         data_res_pvt = data_res_pvt.div(1000)
         data_shr_pvt = data_shr_pvt.div(1000)
-        data_bal_pvt = data_bal_pvt[self.col_bal].reset_index()
-        data_res_pvt = data_res_pvt[self.col_res].reset_index()
-        data_shr_pvt = data_shr_pvt[self.col_shr].reset_index()
-
-        # Upload data to db
-        self.sql_manager.upload_df('sec_num_bal', data_bal_pvt)
-        self.sql_manager.upload_df('sec_num_res', data_res_pvt)
-        self.sql_manager.upload_df('sec_num_shr', data_shr_pvt)
-
-        print('\tDownload successful for num {0}'.format(period))
+        # Tags missing from the quarter (or every tag, when it has no data) are empty columns
+        data_bal_pvt = data_bal_pvt.reindex(columns=self.col_bal).reset_index()
+        data_res_pvt = data_res_pvt.reindex(columns=self.col_res).reset_index()
+        data_shr_pvt = data_shr_pvt.reindex(columns=self.col_shr).reset_index()
+        return data_bal_pvt, data_res_pvt, data_shr_pvt
+
+    def get_fundamentals(self, data_sub, data_bal, data_shr):
+        """ Rows of sec_fundamentals_pit of a quarter: equity (USD) and non-zero basic shares of every symbol, ddate
+            and filing date. When a symbol has several filings on a date, values come from the first one by adsh.
+        """
+        equity = data_bal.loc[data_bal.uom == 'USD', ['adsh', 'ddate', 'equity']]
+        shares = data_shr[['adsh', 'ddate', 'qtrs', 'shares_basic']].replace({'shares_basic': {0: np.nan}})
+        data = pd.concat([equity, shares], ignore_index=True)
+        data = data.merge(data_sub[['adsh', 'cik', 'filed']], on='adsh')
+        data['symbol'] = data.cik.map(self.cik_symbol)
+        data['ddate'] = pd.to_datetime(data.ddate, format='%Y%m%d', errors='coerce')
+        data['filed'] = pd.to_datetime(data.filed, format='%Y%m%d', errors='coerce')
+        data = data.dropna(subset=['symbol', 'ddate', 'filed']).sort_values(['adsh', 'qtrs'], kind='mergesort')
+        data = data.groupby(['symbol', 'ddate', 'filed'])[['equity', 'shares_basic']].first().reset_index()
+        data = data.dropna(subset=['equity', 'shares_basic'], how='all')
+        data['ddate'] = data.ddate.dt.date
+        data['filed'] = data.filed.dt.date
+        return data
+
+    def upload_fundamentals(self, data_sub, data_bal, data_shr):
+        """ Adds the equity and shares of a quarter to sec_fundamentals_pit. """
+        data = self.get_fundamentals(data_sub, data_bal, data_shr)
+        if data.shape[0] > 0:
+            self.sql_manager.upload_df('sec_fundamentals_pit', data)
+
+    def backfill_fundamentals(self):
+        """ Fills sec_fundamentals_pit from the quarters already in sec_sub, sec_num_bal and sec_num_shr, with the
+            same values as get_fundamentals.
+        """
+        print('Building sec_fundamentals_pit')
+        self.sql_manager.query(
+            """
+            insert into sec_fundamentals_pit (symbol, ddate, filed, equity, shares_basic)
+            select
+                symbol, ddate, filed,
+                (array_agg(equity order by adsh, qtrs) filter (where equity is not null))[1],
+                (array_agg(shares_basic order by adsh, qtrs) filter (where shares_basic is not null))[1]
+                from
+                (
+                    select
+                        b.symbol, cast(c.ddate as date) ddate, cast(a.filed as date) filed, a.adsh,
+                        cast(null as integer) qtrs, c.equity, cast(null as double precision) shares_basic
+                        from sec_sub a
+                        inner join sec_cik_symbol b
+                        on a.cik = b.cik
+                        inner join sec_num_bal c
+                        on a.adsh = c.adsh and c.uom = 'USD'
+                    union all
+                    select
+                        b.symbol, cast(c.ddate as date) ddate, cast(a.filed as date) filed, a.adsh,
+                        c.qtrs, cast(null as double precision) equity, nullif(c.shares_basic, 0) shares_basic
+                        from sec_sub a
+                        inner join sec_cik_symbol b
+                        on a.cik = b.cik
+                        inner join sec_num_shr c
+                        on a.adsh = c.adsh
+                ) a
+            group by symbol, ddate, filed
+            having count(equity) > 0 or count(shares_basic) > 0
+            on conflict do nothing
+            """)
+
+    def mark_dirty(self, data_sub, data_bal, data_shr):
+        """ Flags the symbols with new equity or shares figures in reg_factors_dirty, from their earliest ddate.
+            Incremental DataProcessing computes their raw factors again after that date.
+        """
+        ddates = pd.concat([data_bal[['adsh', 'ddate']], data_shr[['adsh', 'ddate']]])
+        ddates = ddates.merge(data_sub[['adsh', 'cik']], on='adsh')
+        ddates['symbol'] = ddates.cik.map(self.cik_symbol)
+        dirty = ddates.dropna(subset=['symbol']).groupby('symbol').ddate.min().reset_index()
+        if dirty.shape[0] > 0:
+            dirty['date'] = pd.to_datetime(dirty.ddate, format='%Y%m%d').dt.date
+            self.sql_manager.upload_df('reg_factors_dirty', dirty[['symbol', 'date']])
+
+    def read_store(self, period):
+        """ Data sets of a quarter saved in the local store by a previous run, None if it isn't there. """
+        store = self.sql_manager.store
+        if store is None or not all(period in store.partitions(table) for table in self.tables):
+            return None
+        return {table: store.read(table, 'query', [period]) for table in self.tables}
 
     def clean(self):
         print('Cleaning SEC tables')
-        self.sql_manager.clean_table('sec_sub')
-        self.sql_manager.clean_table('sec_num_bal')
-        self.sql_manager.clean_table('sec_num_res')
-        self.sql_manager.clean_table('sec_num_shr')
+        for table in self.tables:
+            self.sql_manager.clean_table(table, keep_store=True)
+        self.sql_manager.clean_table('sec_fundamentals_pit')
@@ -0,0 +1,10 @@
+--drop table pipeline_runs
+
+-- Runs of the pipeline. A run without finished failed or was interrupted, and is resumed by the next run without run_id
+CREATE TABLE public.pipeline_runs
+(
+    run_id character varying(50) COLLATE pg_catalog."default" NOT NULL,
+    started timestamp without time zone,
+    finished timestamp without time zone,
+    PRIMARY KEY (run_id)
+)
@@ -0,0 +1,11 @@
+--drop table pipeline_units
+
+-- Work units (symbols, quarters, dates) completed by every stage of a pipeline run, skipped when the run is resumed
+CREATE TABLE public.pipeline_units
+(
+    run_id character varying(50) COLLATE pg_catalog."default" NOT NULL,
+    stage character varying(50) COLLATE pg_catalog."default" NOT NULL,
+    unit character varying(100) COLLATE pg_catalog."default" NOT NULL,
+    completed timestamp without time zone,
+    PRIMARY KEY (run_id, stage, unit)
+)
@@ -0,0 +1,14 @@
+--drop table portfolio_weights
+
+-- Optimal portfolio of every date the optimizer ran
+CREATE TABLE public.portfolio_weights
+(
+    date date NOT NULL,
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    weight double precision,
+    PRIMARY KEY (date, symbol),
+    FOREIGN KEY (symbol)
+        REFERENCES public.symbols (symbol) MATCH SIMPLE
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+)
@@ -0,0 +1,11 @@
+--drop table reg_factor_returns
+
+-- Factor returns of the cross-sectional regressions, one row per date and factor (style or industry)
+CREATE TABLE public.reg_factor_returns
+(
+    date date NOT NULL,
+    factor character varying(100) COLLATE pg_catalog."default" NOT NULL,
+    ret real,
+    tstat real,
+    PRIMARY KEY (date, factor)
+)
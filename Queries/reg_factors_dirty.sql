@@ -0,0 +1,8 @@
+--drop table reg_factors_dirty
+
+-- Symbols with new SEC figures. Their raw factors after date are computed again by incremental DataProcessing.
+CREATE TABLE public.reg_factors_dirty
+(
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    date date NOT NULL
+)
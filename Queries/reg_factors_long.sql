@@ -0,0 +1,14 @@
+--drop table reg_factors_long
+
+CREATE TABLE public.reg_factors_long
+(
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    date date NOT NULL,
+    factor character varying(32) NOT NULL,
+	value double precision,
+	PRIMARY KEY (symbol, date, factor),
+    FOREIGN KEY (symbol)
+        REFERENCES public.symbols (symbol) MATCH SIMPLE
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+)
@@ -0,0 +1,15 @@
+--drop table reg_residuals
+
+-- Residuals (specific returns) of the cross-sectional regressions
+CREATE TABLE public.reg_residuals
+(
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    date date NOT NULL,
+    resid real,
+    weight real,
+    PRIMARY KEY (symbol, date),
+    FOREIGN KEY (symbol)
+        REFERENCES public.symbols (symbol) MATCH SIMPLE
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+)
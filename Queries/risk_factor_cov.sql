@@ -0,0 +1,11 @@
+--drop table risk_factor_cov
+
+-- Factor covariance of the risk model by date, upper triangle (factor_1 <= factor_2 in the model's order)
+CREATE TABLE public.risk_factor_cov
+(
+    date date NOT NULL,
+    factor_1 character varying(100) COLLATE pg_catalog."default" NOT NULL,
+    factor_2 character varying(100) COLLATE pg_catalog."default" NOT NULL,
+    cov double precision,
+    PRIMARY KEY (date, factor_1, factor_2)
+)
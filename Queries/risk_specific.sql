@@ -0,0 +1,14 @@
+--drop table risk_specific
+
+-- Specific variance of the risk model at month ends and at the last date of every run
+CREATE TABLE public.risk_specific
+(
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    date date NOT NULL,
+    var real,
+    PRIMARY KEY (symbol, date),
+    FOREIGN KEY (symbol)
+        REFERENCES public.symbols (symbol) MATCH SIMPLE
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+)
@@ -0,0 +1,13 @@
+--drop table sec_fundamentals_pit
+
+-- Equity (USD) and basic shares of every symbol, period end date (ddate) and filing date, from sec_sub and
+-- sec_num_bal / sec_num_shr. Maintained by SecScraper as quarters are ingested.
+CREATE TABLE public.sec_fundamentals_pit
+(
+    symbol character varying(10) COLLATE pg_catalog."default" NOT NULL,
+    ddate date NOT NULL,
+    filed date NOT NULL,
+    equity double precision,
+    shares_basic double precision,
+    PRIMARY KEY (symbol, ddate, filed)
+)